@@ -0,0 +1,124 @@
+"""Reproducible import/cold-start benchmark for the Cloud Function.
+
+Every run starts a fresh Python interpreter (like a new Cloud Function instance) and measures
+- the `python -X importtime` breakdown of `import main`,
+- the wall time of `import main` and of the first (cold) and second (warm) call of each step a first invocation pays
+  for: importing a script module and, with `--clients`, creating the API clients (needs GCP credentials).
+
+Results are printed as JSON (median over `--runs` runs). Pass `--baseline` with the JSON of an earlier run to fail
+(exit code 1) if a step got slower by more than `--max-regression` percent.
+
+Run from the repository root:
+    python benchmarks/cold_start.py --runs 5 --output cold_start.json
+    python benchmarks/cold_start.py --runs 5 --baseline cold_start.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# executed in a fresh interpreter, prints a JSON dict of step -> seconds
+FIRST_CALL_PROBE = '''
+import json, sys, time
+timings = {}
+start = time.perf_counter()
+import main
+timings["import main"] = time.perf_counter() - start
+from gcf_src import script_runner
+for script in script_runner.SCRIPTS:
+    for call in ("cold", "warm"):
+        start = time.perf_counter()
+        script_runner.get_script(script)
+        timings[f"get_script {script} ({call})"] = time.perf_counter() - start
+if "--clients" in sys.argv:
+    from gcf_src.config import cfg
+    from gcf_src.storage import gcs
+    from gcf_src.workflows import helpers
+    for name, create in (("storage client", gcs.get_storage_client), ("secret manager client", cfg.secret_mgr_client),
+                         ("callback client", helpers.callback_client)):
+        for call in ("cold", "warm"):
+            start = time.perf_counter()
+            create()
+            timings[f"{name} ({call})"] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def parse_importtime(stderr: str) -> dict:
+    """Parses `-X importtime` output into module -> cumulative seconds."""
+    cumulative = {}
+    for line in stderr.splitlines():
+        # eg. "import time:       812 |      12345 |   google.cloud.storage"
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _self_us, cumulative_us, module = line[len("import time:"):].split("|", 2)
+        cumulative[module.strip()] = int(cumulative_us) / 1e6
+    return cumulative
+
+
+def run_python(args: list) -> subprocess.CompletedProcess:
+    """Runs a fresh interpreter from the repository root (without writing .pyc files, so every run is comparable)."""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    process = subprocess.run([sys.executable] + args, cwd=REPO_ROOT, env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise Exception(f"Benchmark subprocess failed: {process.stderr[-2000:]}")
+    return process
+
+
+def run_once(clients: bool) -> dict:
+    importtime = run_python(["-X", "importtime", "-c", "import main"])
+    probe = run_python(["-c", FIRST_CALL_PROBE] + (["--clients"] if clients else []))
+    first_calls = json.loads(probe.stdout.strip().splitlines()[-1])
+    return {"imports": parse_importtime(importtime.stderr), "first_calls": first_calls}
+
+
+def median_of(runs: list, key: str) -> dict:
+    names = set().union(*(run[key] for run in runs))
+    return {name: statistics.median(run[key].get(name, 0.0) for run in runs) for name in sorted(names)}
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list:
+    """Returns the steps that got slower than `max_regression` percent compared to `baseline`."""
+    regressions = []
+    for step, seconds in result["first_calls"].items():
+        before = baseline.get("first_calls", {}).get(step)
+        if before and seconds > before * (1 + max_regression / 100) and seconds - before > 0.005:
+            regressions.append(f"{step}: {before * 1000:.1f} ms -> {seconds * 1000:.1f} ms")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--runs", type=int, default=5, help="number of fresh interpreters to measure")
+    arg_parser.add_argument("--clients", action="store_true", help="also measure API client creation")
+    arg_parser.add_argument("--top", type=int, default=15, help="number of slowest imports to report")
+    arg_parser.add_argument("--output", help="write the JSON result to this file")
+    arg_parser.add_argument("--baseline", help="JSON result of an earlier run to compare against")
+    arg_parser.add_argument("--max-regression", type=float, default=20.0, help="allowed slowdown in percent")
+    args = arg_parser.parse_args()
+
+    runs = [run_once(args.clients) for _ in range(args.runs)]
+    imports = median_of(runs, "imports")
+    slowest = dict(sorted(imports.items(), key=lambda item: item[1], reverse=True)[:args.top])
+    result = {"python": sys.version.split()[0], "runs": args.runs, "first_calls": median_of(runs, "first_calls"),
+              "slowest_imports": slowest}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        if regressions:
+            print("Cold start regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No cold start regressions.")
+
+
+if __name__ == "__main__":
+    main()
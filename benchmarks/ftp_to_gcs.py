@@ -0,0 +1,670 @@
+"""End-to-end benchmark of the `ftp_to_gcs` script against a local FTP server and a fake GCS.
+
+No GCP project or partner FTP is needed:
+- the FTP server is pyftpdlib (`pip install pyftpdlib`), running in its own process,
+- GCS is an in-process fake of the `google.cloud.storage` surface that `gcf_src/storage/gcs.py` uses, plus a local
+  HTTP server for resumable upload sessions (so uploads really go through `requests`). Checksums are computed and
+  validated like GCS does, but file data is not kept (only small files such as manifests and checkpoints). Parallel
+  composite uploads are composed like in GCS, with the CRC32C of the composite combined from those of its parts.
+
+For every combination of `--files` (file sets, eg. "20x1MB") and `--payload` (payload options, eg. '{"engine":
+"asyncio"}'), a fresh interpreter runs `run_script` `--runs` times (after `--warmup` runs) and reports:
+- wall time and throughput (MB of source files per second) of the runs,
+- latency percentiles of the files (seconds from the start of a run until all GCS locations of a file exist),
+- peak RSS of the interpreter,
+- FTP logins and connections (total and max. at the same time), GCS API calls, upload sessions and HTTP connections,
+- the time per phase (see `gcf_src/monitoring/metrics.py`) of the median run.
+
+Bandwidth and latency of both sides can be shaped to resemble real links (`--ftp-bandwidth`, `--ftp-latency`,
+`--gcs-bandwidth`, `--gcs-latency`). Bandwidth limits apply per connection.
+
+Results are printed as JSON. Pass `--baseline` with the JSON of an earlier run to fail (exit code 1) if the
+throughput of a case dropped by more than `--max-regression` percent.
+
+Run from the repository root:
+    python benchmarks/ftp_to_gcs.py --files 50x100KB --files 2x50MB --runs 3 --output ftp_to_gcs.json
+    python benchmarks/ftp_to_gcs.py --files 50x100KB --files 2x50MB --runs 3 --baseline ftp_to_gcs.json
+    python benchmarks/ftp_to_gcs.py --files 10x10MB --payload '{"engine": "asyncio", "max_parallel_transfers": 4}' \\
+        --ftp-bandwidth 20 --ftp-latency 30
+    python benchmarks/ftp_to_gcs.py --files 2x100MB --payload '{}' \\
+        --payload '{"composite_upload_threshold": 33554432}' --gcs-bandwidth 20
+"""
+import argparse
+import base64
+import contextlib
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FTP_USER = "benchmark"
+FTP_PASSWD = "benchmark"
+BUCKET = "benchmark-bucket"
+# files up to this size are kept by the fake GCS, so that manifests and checkpoints can be read again
+KEEP_DATA_BYTES = 1024 * 1024
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+# payload of every run; --payload options are applied on top
+BASE_PAYLOAD = {
+    "script": "ftp_to_gcs",
+    "source_ftp": "benchmark_ftp",
+    "source_file_name_re": r"^bench_\d+\.csv$",
+    "gcs_bucket": BUCKET,
+    "gcs_folders": ["benchmark"],
+    "keep_file_on_ftp": True,  # every run imports the same files
+}
+# indexes of the FTP counters shared with the server process
+LOGINS, CONNECTIONS, ACTIVE_CONNECTIONS, MAX_CONNECTIONS = range(4)
+
+
+def parse_file_set(spec: str) -> tuple:
+    """Parses a file set like "20x1MB" into (count, size in bytes)."""
+    match = re.fullmatch(r"(\d+)x(\d+(?:\.\d+)?)(B|KB|MB|GB)", spec.strip(), flags=re.IGNORECASE)
+    if match is None:
+        raise Exception(f"File set must look like 20x1MB, got {spec}.")
+    return int(match.group(1)), int(float(match.group(2)) * SIZE_UNITS[match.group(3).upper()])
+
+
+def write_csv_file(path: str, size: int, rnd: random.Random):
+    """Writes `size` bytes of CSV-like rows (compressible like real exports, unlike random bytes)."""
+    words = ["home", "product", "checkout", "search", "cart", "account", "help", "blog"]
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            rows = "".join(f"{rnd.randrange(10 ** 9)},{rnd.choice(words)},{rnd.randrange(1000)},"
+                           f"{rnd.random():.6f}\n" for _ in range(2000)).encode()
+            rows = rows[:size - written]
+            f.write(rows)
+            written += len(rows)
+
+
+def generate_file_set(work_dir: str, spec: str) -> str:
+    """Creates the files of the file set `spec` (once per `work_dir`) with a modification date in the past, so that
+    they count as ready.
+    :return: the folder of the files (= root of the FTP server)
+    """
+    count, size = parse_file_set(spec)
+    folder = os.path.join(work_dir, spec)
+    if os.path.isdir(folder) and len(os.listdir(folder)) == count:
+        return folder
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    rnd = random.Random(spec)  # the same file set always has the same content
+    modified = time.time() - 3600
+    for i in range(count):
+        path = os.path.join(folder, f"bench_{i:05d}.csv")
+        write_csv_file(path, size, rnd)
+        os.utime(path, (modified, modified))
+    return folder
+
+
+def serve_ftp(root: str, port, counters, ready, bandwidth: float, latency: float):
+    """Runs the FTP server (in its own process, so that it does not compete with the benchmarked code for the GIL)."""
+    import logging
+    from pyftpdlib.authorizers import DummyAuthorizer
+    from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+    from pyftpdlib.log import config_logging
+    from pyftpdlib.servers import ThreadedFTPServer
+
+    config_logging(level=logging.WARNING)
+
+    class Handler(FTPHandler):
+        def on_connect(self):
+            with counters.get_lock():
+                counters[CONNECTIONS] += 1
+                counters[ACTIVE_CONNECTIONS] += 1
+                counters[MAX_CONNECTIONS] = max(counters[MAX_CONNECTIONS], counters[ACTIVE_CONNECTIONS])
+
+        def on_disconnect(self):
+            with counters.get_lock():
+                counters[ACTIVE_CONNECTIONS] -= 1
+
+        def on_login(self, username):
+            with counters.get_lock():
+                counters[LOGINS] += 1
+
+        def process_command(self, cmd, *args, **kwargs):
+            if latency:
+                time.sleep(latency)  # every connection has its own thread, so this only delays this client
+            return super().process_command(cmd, *args, **kwargs)
+
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(FTP_USER, FTP_PASSWD, root, perm="elradfmwMT")
+    Handler.authorizer = authorizer
+    if bandwidth:
+        Handler.dtp_handler = type("ShapedDTPHandler", (ThrottledDTPHandler,),
+                                   {"read_limit": int(bandwidth), "write_limit": int(bandwidth)})
+    server = ThreadedFTPServer(("127.0.0.1", 0), Handler)
+    port.value = server.address[1]
+    ready.set()
+    server.serve_forever(handle_exit=False)
+
+
+class FakeObject:
+    """An object in the fake GCS."""
+
+    def __init__(self, data: bytes or None, size: int, crc32c: str, md5_hash: str, generation: int,
+                 content_type: str = None, content_encoding: str = None, metadata: dict = None,
+                 component_count: int = None):
+        self.data = data
+        self.size = size
+        self.crc32c = crc32c
+        self.md5_hash = md5_hash
+        self.generation = generation
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.metadata = metadata
+        self.component_count = component_count  # number of uploaded objects a composite object consists of
+
+
+def _gf2_times(matrix: list, vector: int) -> int:
+    result = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return result
+
+
+def _gf2_square(matrix: list) -> list:
+    return [_gf2_times(matrix, matrix[row]) for row in range(32)]
+
+
+def crc32c_combine(crc1: int, crc2: int, len2: int) -> int:
+    """CRC32C of the concatenation of two blocks from their CRC32Cs and the length of the second one (like zlib's
+    `crc32_combine`), so that composing objects does not need their data."""
+    if len2 == 0:
+        return crc1
+    odd = [0x82F63B78] + [1 << row for row in range(31)]  # operator for one zero bit (reversed Castagnoli polynomial)
+    even = _gf2_square(odd)  # two zero bits
+    odd = _gf2_square(even)  # four zero bits
+    while True:  # apply len2 zero bytes to crc1
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+class Hasher:
+    """CRC32C and MD5 (base64, like in GCS object resources) of data passed block by block."""
+
+    def __init__(self):
+        import google_crc32c
+        self._crc32c = google_crc32c.Checksum()
+        self._md5 = hashlib.md5()
+
+    def update(self, data: bytes):
+        self._crc32c.update(data)
+        self._md5.update(data)
+
+    def checksums(self) -> tuple:
+        return (base64.b64encode(self._crc32c.digest()).decode(), base64.b64encode(self._md5.digest()).decode())
+
+
+class FakeStorage:
+    """State of the fake GCS: objects, open resumable upload sessions and counters. `bandwidth` (bytes per second)
+    and `latency` (seconds) are applied to every API call and upload request."""
+
+    def __init__(self, bandwidth: float = None, latency: float = None):
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.upload_url = None  # set by `start_upload_server`
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.objects = {}  # (bucket, name) -> FakeObject
+            self.sessions = {}  # session id -> upload state
+            self.created = {}  # (bucket, name) -> time.monotonic() of the last write
+            self.counters = {"api_calls": 0, "upload_sessions": 0, "upload_requests": 0, "http_connections": 0}
+
+    def count(self, counter: str):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def delay(self, nbytes: int = 0):
+        seconds = (self.latency or 0) + (nbytes / self.bandwidth if self.bandwidth else 0)
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def api_call(self, nbytes: int = 0):
+        self.count("api_calls")
+        self.delay(nbytes)
+
+    def get(self, bucket: str, name: str) -> FakeObject or None:
+        with self._lock:
+            return self.objects.get((bucket, name))
+
+    def put(self, bucket: str, name: str, data: bytes or None, size: int, checksums: tuple,
+            if_generation_match: int = None, **properties) -> FakeObject:
+        from google.api_core.exceptions import PreconditionFailed
+        with self._lock:
+            existing = self.objects.get((bucket, name))
+            generation = existing.generation if existing is not None else 0
+            if if_generation_match is not None and if_generation_match != generation:
+                raise PreconditionFailed(f"{name} has generation {generation}, not {if_generation_match}")
+            stored = FakeObject(data if size <= KEEP_DATA_BYTES else None, size, checksums[0], checksums[1],
+                                generation + 1, **properties)
+            self.objects[(bucket, name)] = stored
+            self.created[(bucket, name)] = time.monotonic()
+            return stored
+
+    def delete(self, bucket: str, name: str):
+        from google.api_core.exceptions import NotFound
+        with self._lock:
+            if self.objects.pop((bucket, name), None) is None:
+                raise NotFound(f"{name} does not exist in bucket {bucket}")
+
+    def open_session(self, bucket: str, name: str, **properties) -> str:
+        with self._lock:
+            self.counters["upload_sessions"] += 1
+            session_id = str(self.counters["upload_sessions"])
+            self.sessions[session_id] = {"bucket": bucket, "name": name, "properties": properties,
+                                         "hasher": Hasher(), "size": 0, "data": bytearray()}
+        return f"{self.upload_url}/upload/{session_id}"
+
+
+class FakeBlob:
+    """The parts of `google.cloud.storage.Blob` that gcs.py uses."""
+
+    def __init__(self, bucket, name: str):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_type = None
+        self.content_encoding = None
+        self.cache_control = None
+        self._load(bucket.storage.get(bucket.name, name))
+
+    def _load(self, stored: FakeObject or None):
+        self.size = stored.size if stored is not None else None
+        self.generation = stored.generation if stored is not None else None
+        self.crc32c = stored.crc32c if stored is not None else None
+        self.md5_hash = stored.md5_hash if stored is not None else None
+        self.component_count = stored.component_count if stored is not None else None
+        if stored is not None:
+            self.metadata = stored.metadata
+            self.content_type = stored.content_type
+            self.content_encoding = stored.content_encoding
+
+    @property
+    def self_link(self) -> str:
+        return f"https://www.googleapis.com/storage/v1/b/{self.bucket.name}/o/{self.name}"
+
+    def _store(self, data: bytes, content_type: str = None, if_generation_match: int = None):
+        storage = self.bucket.storage
+        storage.api_call(len(data))
+        hasher = Hasher()
+        hasher.update(data)
+        self._load(storage.put(self.bucket.name, self.name, data, len(data), hasher.checksums(),
+                               if_generation_match=if_generation_match, content_type=content_type,
+                               content_encoding=self.content_encoding, metadata=self.metadata))
+
+    def upload_from_file(self, file_obj, content_type: str = None, **kwargs):
+        self._store(file_obj.read(), content_type=content_type)
+
+    def upload_from_string(self, data, content_type: str = None, if_generation_match: int = None, **kwargs):
+        self._store(data.encode() if isinstance(data, str) else bytes(data), content_type=content_type,
+                    if_generation_match=if_generation_match)
+
+    def create_resumable_upload_session(self, content_type: str = None, **kwargs) -> str:
+        self.bucket.storage.api_call()
+        return self.bucket.storage.open_session(self.bucket.name, self.name, content_type=content_type,
+                                                content_encoding=self.content_encoding, metadata=self.metadata)
+
+    def patch(self):
+        self.bucket.storage.api_call()
+        stored = self.bucket.storage.get(self.bucket.name, self.name)
+        if stored is not None:
+            stored.metadata = self.metadata
+
+    def exists(self) -> bool:
+        self.bucket.storage.api_call()
+        return self.bucket.storage.get(self.bucket.name, self.name) is not None
+
+    def download_as_bytes(self, if_generation_match: int = None, **kwargs) -> bytes:
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+        stored = self.bucket.storage.get(self.bucket.name, self.name)
+        if stored is None:
+            raise NotFound(f"{self.name} does not exist in bucket {self.bucket.name}")
+        if if_generation_match is not None and if_generation_match != stored.generation:
+            raise PreconditionFailed(f"{self.name} has generation {stored.generation}, not {if_generation_match}")
+        if stored.data is None:
+            raise Exception(f"The fake GCS does not keep files bigger than {KEEP_DATA_BYTES} bytes ({self.name}).")
+        self.bucket.storage.api_call(stored.size)
+        return bytes(stored.data)
+
+    download_as_string = download_as_bytes
+
+    def delete(self, **kwargs):
+        self.bucket.storage.api_call()
+        self.bucket.storage.delete(self.bucket.name, self.name)
+
+    def rewrite(self, source, token: str = None, **kwargs) -> tuple:
+        from google.api_core.exceptions import NotFound
+        storage = self.bucket.storage
+        storage.api_call()  # server-side copy: no data passes through the client
+        stored = storage.get(source.bucket.name, source.name)
+        if stored is None:
+            raise NotFound(f"{source.name} does not exist in bucket {source.bucket.name}")
+        self._load(storage.put(self.bucket.name, self.name, stored.data, stored.size,
+                               (stored.crc32c, stored.md5_hash), content_type=stored.content_type,
+                               content_encoding=stored.content_encoding, metadata=stored.metadata))
+        return None, stored.size, stored.size
+
+    def compose(self, sources: list, **kwargs):
+        """Like GCS: the CRC32C of the composite object is combined from those of the sources, it has no MD5."""
+        from google.api_core.exceptions import NotFound
+        storage = self.bucket.storage
+        storage.api_call()  # server-side, like `rewrite`
+        stored_sources = []
+        for source in sources:
+            stored = storage.get(source.bucket.name, source.name)
+            if stored is None:
+                raise NotFound(f"{source.name} does not exist in bucket {source.bucket.name}")
+            stored_sources.append(stored)
+        crc32c = 0
+        for stored in stored_sources:
+            crc32c = crc32c_combine(crc32c, int.from_bytes(base64.b64decode(stored.crc32c), "big"), stored.size)
+        size = sum(stored.size for stored in stored_sources)
+        data = None
+        if size <= KEEP_DATA_BYTES and all(stored.data is not None for stored in stored_sources):
+            data = b"".join(stored.data for stored in stored_sources)
+        self._load(storage.put(self.bucket.name, self.name, data, size,
+                               (base64.b64encode(crc32c.to_bytes(4, "big")).decode(), None),
+                               content_type=self.content_type, content_encoding=self.content_encoding,
+                               metadata=self.metadata,
+                               component_count=sum(stored.component_count or 1 for stored in stored_sources)))
+
+
+class FakeBucket:
+    def __init__(self, storage: FakeStorage, name: str):
+        self.storage = storage
+        self.name = name
+
+    def blob(self, blob_name: str, **kwargs) -> FakeBlob:
+        return FakeBlob(self, blob_name)
+
+    def get_blob(self, blob_name: str, **kwargs) -> FakeBlob or None:
+        self.storage.api_call()
+        if self.storage.get(self.name, blob_name) is None:
+            return None
+        return FakeBlob(self, blob_name)
+
+
+class FakeStorageClient:
+    """Stands in for `google.cloud.storage.Client`."""
+
+    def __init__(self, storage: FakeStorage):
+        self.storage = storage
+
+    def bucket(self, bucket_name: str) -> FakeBucket:
+        return FakeBucket(self.storage, bucket_name)
+
+
+def start_upload_server(storage: FakeStorage) -> ThreadingHTTPServer:
+    """Serves the resumable upload sessions of `storage` (PUT with Content-Range, like the GCS JSON API)."""
+
+    class UploadHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like GCS
+
+        def setup(self):
+            super().setup()
+            storage.count("http_connections")
+
+        def log_message(self, *args):
+            pass
+
+        def respond(self, status: int, headers: dict = None, body: dict = None):
+            data = json.dumps(body).encode() if body is not None else b""
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_PUT(self):
+            data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            storage.count("upload_requests")
+            storage.delay(len(data))
+            session = storage.sessions.get(self.path.rsplit("/", 1)[-1])
+            if session is None:
+                return self.respond(404)
+            # "bytes 0-8388607/*", "bytes 8388608-9000000/9000001" or "bytes */9000001"
+            byte_range, total = self.headers["Content-Range"].split(" ", 1)[1].split("/")
+            if byte_range != "*":
+                start = int(byte_range.split("-")[0])
+                if start != session["size"]:
+                    return self.respond(400, body={"error": f"expected offset {session['size']}, got {start}"})
+                session["hasher"].update(data)
+                session["size"] += len(data)
+                if session["size"] <= KEEP_DATA_BYTES:
+                    session["data"] += data
+            if total == "*":
+                headers = {"Range": f"bytes=0-{session['size'] - 1}"} if session["size"] else {}
+                return self.respond(308, headers=headers)
+            crc32c, md5_hash = session["hasher"].checksums()
+            expected_hash = self.headers.get("X-Goog-Hash")
+            if expected_hash is not None and expected_hash != f"crc32c={crc32c},md5={md5_hash}":
+                return self.respond(400, body={"error": f"checksum mismatch: {expected_hash}"})
+            storage.sessions.pop(self.path.rsplit("/", 1)[-1], None)
+            stored = storage.put(session["bucket"], session["name"], bytes(session["data"]), session["size"],
+                                 (crc32c, md5_hash), **session["properties"])
+            self.respond(200, body={"name": session["name"], "bucket": session["bucket"], "size": str(stored.size),
+                                    "generation": str(stored.generation), "crc32c": crc32c, "md5Hash": md5_hash})
+
+        def do_DELETE(self):
+            storage.sessions.pop(self.path.rsplit("/", 1)[-1], None)
+            self.respond(499)  # what GCS answers to a cancelled upload
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), UploadHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-gcs", daemon=True).start()
+    storage.upload_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+
+def percentile(values: list, percent: float) -> float or None:
+    """Nearest-rank percentile."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def peak_rss_mb() -> float:
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(maxrss / 1024 ** 2 if sys.platform == "darwin" else maxrss / 1024, 1)  # bytes on macOS, KiB else
+
+
+def run_case(case: dict) -> dict:
+    """Runs one file set with one payload in this interpreter (called with --worker)."""
+    sys.path.insert(0, REPO_ROOT)
+    mp_context = multiprocessing.get_context("spawn")
+    counters = mp_context.Array("i", 4)
+    port = mp_context.Value("i", 0)
+    ready = mp_context.Event()
+    ftp_server = mp_context.Process(target=serve_ftp, daemon=True,
+                                    args=(case["ftp_root"], port, counters, ready, case["ftp_bandwidth"],
+                                          case["ftp_latency"]))
+    ftp_server.start()
+    if not ready.wait(30):
+        raise Exception("FTP server did not start.")
+
+    storage = FakeStorage(bandwidth=case["gcs_bandwidth"], latency=case["gcs_latency"])
+    start_upload_server(storage)
+
+    from gcf_src.config import cfg
+    from gcf_src.monitoring import metrics
+    from gcf_src.storage import ftp_to_gcs, gcs
+    gcs._storage_client = FakeStorageClient(storage)
+    cfg.FTP_SERVERS["benchmark_ftp"] = {"secret_id": "benchmark_ftp"}
+    login = {"address": f"127.0.0.1:{port.value}", "user": FTP_USER, "passwd": FTP_PASSWD, "ftp_folder": "/"}
+    cfg._secret_cache[("benchmark_ftp", "latest")] = (float("inf"), json.dumps(login))
+    payload = dict(BASE_PAYLOAD, **case["payload"])
+    source_files = [name for name in os.listdir(case["ftp_root"]) if name.startswith("bench_")]
+    total_bytes = sum(os.path.getsize(os.path.join(case["ftp_root"], name)) for name in source_files)
+
+    runs = []
+    for run in range(case["warmup"] + case["runs"]):
+        storage.reset()
+        with counters.get_lock():
+            for counter in (LOGINS, CONNECTIONS, MAX_CONNECTIONS):
+                counters[counter] = 0
+        output = contextlib.nullcontext() if case["verbose"] else contextlib.redirect_stdout(open(os.devnull, "w"))
+        started = time.monotonic()
+        with output, metrics.run("ftp_to_gcs") as run_metrics:
+            result = ftp_to_gcs.run_script(payload=dict(payload))
+        wall_seconds = time.monotonic() - started
+        if result.get("result") != "done":
+            raise Exception(f"Benchmark run failed: {result}")
+        if run < case["warmup"]:
+            continue
+        latencies = [max(storage.created[(BUCKET, location)] for location in file_result["gcs_locations"]) - started
+                     for file_result in result.get("files", [])]
+        runs.append({"wall_seconds": wall_seconds, "latencies": latencies,
+                     "ftp": {"logins": counters[LOGINS], "connections": counters[CONNECTIONS],
+                             "max_connections": counters[MAX_CONNECTIONS]},
+                     "gcs": dict(storage.counters), "phases": run_metrics.to_dict()["phases"]})
+    ftp_server.terminate()
+
+    wall_times = [run["wall_seconds"] for run in runs]
+    latencies = [latency for run in runs for latency in run["latencies"]]
+    median_run = sorted(runs, key=lambda run: run["wall_seconds"])[len(runs) // 2]
+    return {
+        "files": case["files"],
+        "payload": case["payload"],
+        "file_count": len(source_files),
+        "total_bytes": total_bytes,
+        "runs": len(runs),
+        "wall_seconds": {"median": round(statistics.median(wall_times), 4), "min": round(min(wall_times), 4),
+                         "max": round(max(wall_times), 4)},
+        "throughput_mb_per_s": round(total_bytes / statistics.median(wall_times) / 1e6, 2),
+        "file_latency_seconds": {f"p{percent}": round(percentile(latencies, percent), 4)
+                                 for percent in (50, 90, 99)} if latencies else {},
+        "peak_rss_mb": peak_rss_mb(),
+        "ftp": median_run["ftp"],
+        "gcs": median_run["gcs"],
+        "phases": median_run["phases"],
+    }
+
+
+def run_worker(case: dict) -> dict:
+    """Runs `case` in a fresh interpreter, so that peak RSS and imports are measured per case."""
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker"], input=json.dumps(case),
+                             cwd=REPO_ROOT, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise Exception(f"Benchmark case {case['files']} {case['payload']} failed: {process.stderr[-3000:]}")
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def case_key(case: dict) -> str:
+    return f"{case['files']} {json.dumps(case['payload'], sort_keys=True)}"
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list:
+    """Returns the cases whose throughput dropped by more than `max_regression` percent compared to `baseline`."""
+    baseline_cases = {case_key(case): case for case in baseline.get("cases", [])}
+    regressions = []
+    for case in result["cases"]:
+        before = baseline_cases.get(case_key(case))
+        if before and case["throughput_mb_per_s"] < before["throughput_mb_per_s"] * (1 - max_regression / 100):
+            regressions.append(f"{case_key(case)}: {before['throughput_mb_per_s']} MB/s -> "
+                               f"{case['throughput_mb_per_s']} MB/s")
+    return regressions
+
+
+def git_commit() -> str or None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    if "--worker" in sys.argv:
+        print(json.dumps(run_case(json.load(sys.stdin))))
+        return
+
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--files", action="append", help="file set COUNTxSIZE, eg. 20x1MB (repeatable)")
+    arg_parser.add_argument("--payload", action="append", help="JSON payload options to compare (repeatable)")
+    arg_parser.add_argument("--runs", type=int, default=3, help="number of measured runs per case")
+    arg_parser.add_argument("--warmup", type=int, default=1, help="number of runs before measuring")
+    arg_parser.add_argument("--ftp-bandwidth", type=float, help="FTP bandwidth per connection in MB/s")
+    arg_parser.add_argument("--ftp-latency", type=float, default=0, help="FTP latency per command in ms")
+    arg_parser.add_argument("--gcs-bandwidth", type=float, help="GCS bandwidth per connection in MB/s")
+    arg_parser.add_argument("--gcs-latency", type=float, default=0, help="GCS latency per request in ms")
+    arg_parser.add_argument("--work-dir", help="folder for the generated files (kept, so later runs can reuse them)")
+    arg_parser.add_argument("--verbose", action="store_true", help="show the output of the script")
+    arg_parser.add_argument("--output", help="write the JSON result to this file")
+    arg_parser.add_argument("--baseline", help="JSON result of an earlier run to compare against")
+    arg_parser.add_argument("--max-regression", type=float, default=20.0, help="allowed throughput drop in percent")
+    args = arg_parser.parse_args()
+
+    file_sets = args.files or ["50x100KB", "10x10MB", "1x100MB"]
+    payloads = [json.loads(payload) for payload in args.payload or ["{}"]]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="ftp_to_gcs_benchmark_")
+    settings = {"ftp_bandwidth": args.ftp_bandwidth and args.ftp_bandwidth * 1e6,
+                "ftp_latency": args.ftp_latency / 1000,
+                "gcs_bandwidth": args.gcs_bandwidth and args.gcs_bandwidth * 1e6,
+                "gcs_latency": args.gcs_latency / 1000}
+    try:
+        cases = []
+        for file_set, payload in itertools.product(file_sets, payloads):
+            case = {"files": file_set, "payload": payload, "ftp_root": generate_file_set(work_dir, file_set),
+                    "runs": args.runs, "warmup": args.warmup, "verbose": args.verbose, **settings}
+            print(f"Benchmarking {case_key(case)}", file=sys.stderr)
+            cases.append(run_worker(case))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = {"python": sys.version.split()[0], "commit": git_commit(),
+              "shaping": {"ftp_bandwidth_mb_per_s": args.ftp_bandwidth, "ftp_latency_ms": args.ftp_latency,
+                          "gcs_bandwidth_mb_per_s": args.gcs_bandwidth, "gcs_latency_ms": args.gcs_latency},
+              "cases": cases}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        if regressions:
+            print("Throughput regressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+        print("No throughput regressions.")
+
+
+if __name__ == "__main__":
+    main()
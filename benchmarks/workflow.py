@@ -0,0 +1,474 @@
+"""Local simulation of the ftp-to-gcs workflow (`gcf_src/workflows/ftp-to-gcs.yaml`) to measure and tune its
+end-to-end latency without deploying.
+
+The control loop of the workflow is replayed in-process against `main.main_handler`:
+- attempts, retries (with the sleep between them), exits, continuations and `next_pubsub_payloads` chaining follow
+  the semantics of the workflow, and its defaults (`fallback_cfg`, `max_attempts`, `max_continuations`, the retry
+  sleep) are read from the YAML file, so the simulation stays in sync with it,
+- Pub/Sub is replaced by calling `main.main_handler` in its own thread with the base64-encoded message,
+- the callback endpoint of the workflow is a local HTTP server, so callbacks really go through
+  `gcf_src/workflows/helpers.py` (only the access token is faked); the workflow waits for them up to
+  `callback_timeout` like `events.await_callback`,
+- the FTP server (pyftpdlib, `pip install pyftpdlib`) and GCS are the ones of `benchmarks/ftp_to_gcs.py`, with the
+  same bandwidth and latency shaping.
+
+Latencies of the platform (`--publish-latency`, `--delivery-latency`, `--callback-latency`, `--step-latency`) and the
+sleep before retries are simulated: they are added to the clock of the workflow instead of being waited for (unless
+`--real-time`), so a simulation only takes as long as the runs of the function. `--failing-runs` makes the first runs
+fail with an FTP error to compare retry policies, `--function-timeout` shortens the time budget of a run to provoke
+continuations.
+
+For every `--input` (workflow input, eg. '{"import_cfg": {"max_files": 5}, "max_attempts": 5}'), the workflow runs
+once on a fresh copy of the file set and the result contains its status, the seconds from the start of the workflow
+until it completed (and until the runs of chained payloads completed), the number of runs, attempts and
+continuations, a timeline of all steps and the seconds per step. Results are printed as JSON.
+
+Run from the repository root:
+    python benchmarks/workflow.py --files 20x1MB --input '{}' --input '{"import_cfg": {"max_files": 5}}'
+    python benchmarks/workflow.py --files 10x10MB --failing-runs 2 --retry-sleep 1 --ftp-bandwidth 20
+    python benchmarks/workflow.py --files 50x100KB --function-timeout 35 --delivery-latency 200 --output wf.json
+"""
+import argparse
+import base64
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from ftp_to_gcs import (BUCKET, FTP_PASSWD, FTP_USER, REPO_ROOT, FakeStorage, FakeStorageClient, generate_file_set,
+                        git_commit, serve_ftp, start_upload_server)
+
+WORKFLOW_FILE = os.path.join(REPO_ROOT, "gcf_src", "workflows", "ftp-to-gcs.yaml")
+# import_cfg of every simulation; the import_cfg of --input is applied on top
+BASE_IMPORT_CFG = {
+    "source_ftp": "benchmark_ftp",
+    "source_file_name_re": r"^bench_\d+\.csv$",
+    "gcs_bucket": BUCKET,
+    "gcs_folders": ["benchmark"],
+}
+# `name: ${default(map.get(import_cfg, "name"), value)}` lines of the workflow
+DEFAULT_RE = re.compile(r'^\s*-?\s*(\w+): \$\{default\(map\.get\((input|import_cfg), "\w+"\), (.*)\)\}',
+                        flags=re.MULTILINE)
+
+
+def read_workflow_defaults(workflow_file: str = WORKFLOW_FILE) -> dict:
+    """Reads the defaults of the workflow from its YAML file.
+    :return: {"input": {name: default of the workflow input}, "import_cfg": {name: default of fallback_cfg},
+              "retry_sleep": seconds of the sleep before a retry}
+    """
+    with open(workflow_file) as f:
+        workflow = f.read()
+    defaults = {"input": {}, "import_cfg": {}}
+    for name, source, value in DEFAULT_RE.findall(workflow):
+        defaults[source][name] = json.loads(value)
+    retry_sleep = re.search(r"wait_before_retry:.*?seconds: (\d+)", workflow, flags=re.DOTALL)
+    defaults["retry_sleep"] = float(retry_sleep.group(1)) if retry_sleep else 0.0
+    return defaults
+
+
+def with_fallbacks(import_cfg: dict, fallback_cfg: dict) -> dict:
+    """Returns `import_cfg` with the defaults of `fallback_cfg` for missing or null values (`merge_fallback_cfg_into_
+    import_cfg` of the workflow)."""
+    merged = dict(import_cfg)
+    for name, value in fallback_cfg.items():
+        merged[name] = import_cfg[name] if import_cfg.get(name) is not None else value
+    return merged
+
+
+class Clock:
+    """Seconds since the start of the workflow: real time plus the simulated waits (see `wait`)."""
+
+    def __init__(self, real_time: bool = False):
+        self.real_time = real_time
+        self.started = time.monotonic()
+        self.skipped = 0.0
+
+    def now(self) -> float:
+        return time.monotonic() - self.started + self.skipped
+
+    def wait(self, seconds: float):
+        """Waits `seconds` (really with `real_time`, otherwise only on this clock)."""
+        if seconds <= 0:
+            return
+        if self.real_time:
+            time.sleep(seconds)
+        else:
+            self.skipped += seconds
+
+
+class CallbackEndpoint:
+    """Stands in for the callback endpoints of the workflow (`events.create_callback_endpoint`): a local HTTP server
+    that queues the body of each POST to a callback URL until the workflow awaits it."""
+
+    def __init__(self, clock: Clock, timeline: "Timeline"):
+        self.clock = clock
+        self.timeline = timeline
+        self.callbacks = {}  # callback id -> queue of (clock time, body)
+        self.awaited = set()  # ids of the callbacks the workflow is (still) waiting for
+        endpoint = self
+
+        class CallbackHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"null")
+                callback_id = self.path.rsplit("/", 1)[-1]
+                received = endpoint.clock.now()
+                if callback_id not in endpoint.callbacks:
+                    status = 404
+                else:
+                    status = 200
+                    if callback_id not in endpoint.awaited:
+                        # the workflow stopped waiting (callback_timeout) or the callback was sent twice
+                        endpoint.timeline.add("late_callback", received, received, callback=callback_id,
+                                              result=(body or {}).get("result"))
+                    endpoint.callbacks[callback_id].put((received, body))
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), CallbackHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="callback-endpoint", daemon=True).start()
+
+    def create(self) -> str:
+        """Creates a callback endpoint and returns its URL."""
+        callback_id = uuid.uuid4().hex
+        self.callbacks[callback_id] = queue.Queue()
+        self.awaited.add(callback_id)
+        return f"http://127.0.0.1:{self.server.server_address[1]}/callbacks/{callback_id}"
+
+    def await_callback(self, url: str, timeout: float) -> dict or None:
+        """Waits up to `timeout` seconds for the callback to `url`.
+        :return: the body of the callback or None after the timeout
+        """
+        callback_id = url.rsplit("/", 1)[-1]
+        try:
+            _, body = self.callbacks[callback_id].get(timeout=max(0.0, timeout))
+            return body
+        except queue.Empty:
+            return None
+        finally:
+            self.awaited.discard(callback_id)
+
+    def close(self):
+        self.server.shutdown()
+
+
+class Timeline:
+    """The steps of a simulation with their start and end on the `Clock` (thread-safe, runs overlap)."""
+
+    def __init__(self):
+        self.steps = []
+        self._lock = threading.Lock()
+
+    def add(self, step: str, start: float, end: float, **details):
+        with self._lock:
+            self.steps.append({"step": step, "start": round(start, 4), "seconds": round(end - start, 4),
+                               **{name: value for name, value in details.items() if value is not None}})
+
+    def seconds_per_step(self) -> dict:
+        totals = {}
+        for step in self.steps:
+            totals[step["step"]] = round(totals.get(step["step"], 0.0) + step["seconds"], 4)
+        return totals
+
+
+class WorkflowSimulator:
+    """Runs the control loop of the ftp-to-gcs workflow for one workflow `workflow_input` (see the module docstring).
+
+    Usage:
+        simulator = WorkflowSimulator({"import_cfg": {...}}, read_workflow_defaults())
+        result = simulator.run()
+    """
+
+    def __init__(self, workflow_input: dict, defaults: dict, retry_sleep: float = None, publish_latency: float = 0,
+                 delivery_latency: float = 0, callback_latency: float = 0, step_latency: float = 0,
+                 failing_runs: int = 0, follow_chain: bool = True, real_time: bool = False):
+        self.workflow_input = workflow_input
+        self.defaults = defaults
+        self.retry_sleep = defaults["retry_sleep"] if retry_sleep is None else retry_sleep
+        self.publish_latency = publish_latency
+        self.delivery_latency = delivery_latency
+        self.callback_latency = callback_latency
+        self.step_latency = step_latency
+        self.failing_runs = failing_runs
+        self.follow_chain = follow_chain
+        self.clock = Clock(real_time=real_time)
+        self.timeline = Timeline()
+        self.endpoint = CallbackEndpoint(self.clock, self.timeline)
+        self.runs = 0
+        self._runs_lock = threading.Lock()
+        self._invocations = []  # threads of the function invocations
+
+    def input_value(self, name: str):
+        value = self.workflow_input.get(name)
+        return self.defaults["input"].get(name) if value is None else value
+
+    def step(self, name: str, seconds: float = 0, **details):
+        """Adds step `name` of the workflow (which takes `step_latency` plus `seconds`) to the timeline."""
+        start = self.clock.now()
+        self.clock.wait(self.step_latency + seconds)
+        self.timeline.add(name, start, self.clock.now(), **details)
+
+    def invoke(self, msg: dict, shift: float = 0) -> threading.Thread:
+        """Delivers `msg` to `main.main_handler` like Pub/Sub does (in its own thread). The run is shifted by `shift`
+        simulated seconds on the timeline (for deliveries that the workflow does not wait for)."""
+        import main
+
+        event = {"data": base64.b64encode(json.dumps(msg).encode("utf-8"))}
+        context = SimpleNamespace(event_id=uuid.uuid4().hex, timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        with self._runs_lock:
+            self.runs += 1
+            run_number = self.runs
+
+        def run_function():
+            start = self.clock.now()
+            started = time.monotonic()  # the clock also moves with the simulated waits of the workflow meanwhile
+            result = None
+            try:
+                if run_number <= self.failing_runs:
+                    from gcf_src.storage import ftp
+                    with failing_ftp_listing(ftp):
+                        result = main.main_handler(event, context)
+                else:
+                    result = main.main_handler(event, context)
+            finally:
+                end = start + shift + time.monotonic() - started
+                self.timeline.add("function_run", start + shift, end, run=run_number, script=msg.get("script"),
+                                  result=result.get("result") if isinstance(result, dict) else None)
+
+        invocation = threading.Thread(target=run_function, name=f"function-run-{run_number}", daemon=True)
+        self._invocations.append(invocation)
+        invocation.start()
+        return invocation
+
+    def publish(self, msg: dict, callback_url: str or None, attempt: int = None, chained: bool = False):
+        """`pubsub_publisher` of the workflow."""
+        msg = dict(msg, workflow_callback_url=callback_url)
+        self.step("publish", seconds=self.publish_latency, attempt=attempt, chained=chained)
+        if chained:
+            self.invoke(msg, shift=0 if self.clock.real_time else self.delivery_latency)
+        else:
+            self.step("pubsub_delivery", seconds=self.delivery_latency, attempt=attempt)
+            self.invoke(msg)
+
+    def run(self) -> dict:
+        """Runs the workflow and returns its result (see the module docstring)."""
+        attempt = 1
+        max_attempts = self.input_value("max_attempts")
+        continuations = 0
+        max_continuations = self.input_value("max_continuations")
+        next_pubsub_payloads = self.workflow_input.get("next_pubsub_payloads")
+        import_cfg = dict(self.workflow_input["import_cfg"], script="ftp_to_gcs")
+        import_cfg = with_fallbacks(import_cfg, self.defaults["import_cfg"])
+        workflow_instructions = None
+        callback_payload = None
+        status = "succeeded"
+        error = None
+
+        while True:
+            if attempt > max_attempts:
+                status, error = "failed", f"Max attempts of {max_attempts} reached"
+                break
+            callback_url = self.endpoint.create()
+            self.step("create_callback_url", attempt=attempt)
+            self.publish(import_cfg, callback_url, attempt=attempt)
+            start = self.clock.now()
+            # the delivery and the callback itself are simulated, the run of the function is real
+            callback_timeout = float(import_cfg["callback_timeout"]) - self.delivery_latency - self.callback_latency
+            callback_result = self.endpoint.await_callback(callback_url, timeout=callback_timeout)
+            self.clock.wait(self.callback_latency)
+            if callback_result is None:
+                self.timeline.add("await_callback", start, self.clock.now(), attempt=attempt, timeout=True)
+                callback_payload = {"result": "error", "result_detail": "callback_timeout"}
+            else:
+                self.timeline.add("await_callback", start, self.clock.now(), attempt=attempt,
+                                  result=callback_result.get("result"))
+                callback_payload = callback_result
+                workflow_instructions = callback_payload.get("workflow_instructions")
+            self.step("decide_next_step", attempt=attempt)
+
+            instructions = workflow_instructions or {}
+            if callback_payload.get("result") == "error":
+                attempt += 1
+                self.step("wait_before_retry", seconds=self.retry_sleep, attempt=attempt)
+            elif callback_payload.get("result") == "done":
+                for next_pubsub_payload in next_pubsub_payloads or []:
+                    self.publish(next_pubsub_payload, None, chained=True)
+                break
+            elif instructions.get("continuation") is not None:
+                continuations += 1
+                attempt = 1
+                import_cfg["continuation"] = instructions["continuation"]
+                self.step("continue_with_files_left", continuations=continuations)
+                if continuations > max_continuations:
+                    status, error = "failed", f"Max continuations of {max_continuations} reached"
+                    break
+            elif instructions.get("exit"):
+                break
+            elif instructions.get("retry"):
+                attempt += 1
+                self.step("wait_before_retry", seconds=self.retry_sleep, attempt=attempt)
+            else:
+                break
+        workflow_seconds = self.clock.now()
+
+        if self.follow_chain:
+            for invocation in self._invocations:
+                invocation.join()
+        completed_seconds = max([workflow_seconds] + [step["start"] + step["seconds"] for step in self.timeline.steps])
+        self.endpoint.close()
+        return {
+            "status": status,
+            "error": error,
+            "result": callback_payload.get("result") if callback_payload else None,
+            "workflow_seconds": round(workflow_seconds, 4),
+            "completed_seconds": round(completed_seconds, 4),
+            "runs": self.runs,
+            "attempts": attempt,
+            "continuations": continuations,
+            "seconds_per_step": self.timeline.seconds_per_step(),
+            "timeline": sorted(self.timeline.steps, key=lambda step: step["start"]),
+        }
+
+
+_failing_threads = set()  # threads of the runs whose FTP listings fail (see `failing_ftp_listing`)
+_failing_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def failing_ftp_listing(ftp_module):
+    """Makes the FTP listings of the current thread fail like a server that is temporarily unavailable.
+    Runs overlap (eg. after a callback timeout), so they share one patch that is removed with the last of them."""
+    import ftplib
+
+    with _failing_lock:
+        if not _failing_threads:
+            iter_entries = ftp_module.iter_entries
+
+            def failing_iter_entries(*args, **kwargs):
+                if threading.get_ident() in _failing_threads:
+                    raise ftplib.error_temp("421 Service not available (simulated)")
+                return iter_entries(*args, **kwargs)
+
+            failing_iter_entries.original = iter_entries
+            ftp_module.iter_entries = failing_iter_entries
+        _failing_threads.add(threading.get_ident())
+    try:
+        yield
+    finally:
+        with _failing_lock:
+            _failing_threads.discard(threading.get_ident())
+            if not _failing_threads:
+                ftp_module.iter_entries = ftp_module.iter_entries.original
+
+
+def simulate(workflow_input: dict, file_set_folder: str, args) -> dict:
+    """Simulates the workflow with `workflow_input` on a fresh copy of the files in `file_set_folder`."""
+    ftp_root = tempfile.mkdtemp(prefix="workflow_simulation_")
+    shutil.rmtree(ftp_root)
+    shutil.copytree(file_set_folder, ftp_root)  # keeps the modification dates, so the files count as ready
+    mp_context = multiprocessing.get_context("spawn")
+    counters = mp_context.Array("i", 4)  # not reported, but kept alive for the server process
+    port = mp_context.Value("i", 0)
+    ready = mp_context.Event()
+    ftp_server = mp_context.Process(target=serve_ftp, daemon=True,
+                                    args=(ftp_root, port, counters, ready,
+                                          args.ftp_bandwidth and args.ftp_bandwidth * 1e6, args.ftp_latency / 1000))
+    ftp_server.start()
+    try:
+        if not ready.wait(30):
+            raise Exception("FTP server did not start.")
+        from gcf_src.config import cfg
+        login = {"address": f"127.0.0.1:{port.value}", "user": FTP_USER, "passwd": FTP_PASSWD, "ftp_folder": "/"}
+        cfg._secret_cache[("benchmark_ftp", "latest")] = (float("inf"), json.dumps(login))
+
+        simulator = WorkflowSimulator(
+            dict(workflow_input, import_cfg=dict(BASE_IMPORT_CFG, **workflow_input.get("import_cfg", {}))),
+            read_workflow_defaults(), retry_sleep=args.retry_sleep, publish_latency=args.publish_latency / 1000,
+            delivery_latency=args.delivery_latency / 1000, callback_latency=args.callback_latency / 1000,
+            step_latency=args.step_latency / 1000, failing_runs=args.failing_runs, real_time=args.real_time)
+        result = simulator.run()
+        result["files_left_on_ftp"] = len([name for name in os.listdir(ftp_root) if name.startswith("bench_")])
+    finally:
+        ftp_server.terminate()
+        ftp_server.join()
+        shutil.rmtree(ftp_root, ignore_errors=True)
+    return dict({"input": workflow_input}, **result)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--files", default="20x1MB", help="file set COUNTxSIZE on the FTP, eg. 20x1MB")
+    arg_parser.add_argument("--input", action="append", help="JSON workflow input to compare (repeatable)")
+    arg_parser.add_argument("--retry-sleep", type=float, help="seconds before a retry (default: the workflow's)")
+    arg_parser.add_argument("--publish-latency", type=float, default=50, help="Pub/Sub publish latency in ms")
+    arg_parser.add_argument("--delivery-latency", type=float, default=100, help="Pub/Sub to function latency in ms")
+    arg_parser.add_argument("--callback-latency", type=float, default=50, help="callback to workflow latency in ms")
+    arg_parser.add_argument("--step-latency", type=float, default=10, help="overhead per workflow step in ms")
+    arg_parser.add_argument("--failing-runs", type=int, default=0, help="number of runs that fail with an FTP error")
+    arg_parser.add_argument("--function-timeout", type=float, help="seconds until a run is killed (FUNCTION_TIMEOUT)")
+    arg_parser.add_argument("--ftp-bandwidth", type=float, help="FTP bandwidth per connection in MB/s")
+    arg_parser.add_argument("--ftp-latency", type=float, default=0, help="FTP latency per command in ms")
+    arg_parser.add_argument("--gcs-bandwidth", type=float, help="GCS bandwidth per connection in MB/s")
+    arg_parser.add_argument("--gcs-latency", type=float, default=0, help="GCS latency per request in ms")
+    arg_parser.add_argument("--real-time", action="store_true", help="really wait the simulated latencies and sleeps")
+    arg_parser.add_argument("--work-dir", help="folder for the generated files (kept, so later runs can reuse them)")
+    arg_parser.add_argument("--verbose", action="store_true", help="show the output of the function")
+    arg_parser.add_argument("--output", help="write the JSON result to this file")
+    args = arg_parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    from gcf_src.config import cfg
+    from gcf_src.storage import gcs
+    from gcf_src.workflows import helpers
+    storage = FakeStorage(bandwidth=args.gcs_bandwidth and args.gcs_bandwidth * 1e6,
+                          latency=args.gcs_latency / 1000)
+    start_upload_server(storage)
+    gcs._storage_client = FakeStorageClient(storage)
+    cfg.FTP_SERVERS["benchmark_ftp"] = {"secret_id": "benchmark_ftp"}
+    helpers.callback_client().access_token = lambda force_refresh=False: "simulated-token"
+    if args.function_timeout is not None:
+        cfg.FUNCTION_TIMEOUT = args.function_timeout
+
+    workflow_inputs = [json.loads(workflow_input) for workflow_input in args.input or ["{}"]]
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="workflow_simulation_files_")
+    cases = []
+    try:
+        file_set_folder = generate_file_set(work_dir, args.files)
+        for workflow_input in workflow_inputs:
+            print(f"Simulating workflow with input {json.dumps(workflow_input)}", file=sys.stderr)
+            storage.reset()
+            output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+            with output:
+                cases.append(simulate(workflow_input, file_set_folder, args))
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    result = {"python": sys.version.split()[0], "commit": git_commit(), "files": args.files,
+              "latencies_ms": {"publish": args.publish_latency, "delivery": args.delivery_latency,
+                               "callback": args.callback_latency, "step": args.step_latency},
+              "retry_sleep": args.retry_sleep, "real_time": args.real_time, "cases": cases}
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,121 @@
+import threading
+import time
+from contextvars import ContextVar
 from json import loads
 from os import environ
+from typing import NamedTuple
 
-from google.cloud import secretmanager
-
-WORKFLOW_CALLBACK_URL = 'undefined'
-SCRIPT = 'undefined'
+# Config of the job (= script run) that is currently running: read as cfg.SCRIPT and cfg.WORKFLOW_CALLBACK_URL, set
+# with `set_job_cfg`. These are context variables, so that jobs running at the same time (eg. in a batch, see
+# `script_runner.run_batch`) each see their own values.
+_SCRIPT = ContextVar("SCRIPT", default="undefined")
+_WORKFLOW_CALLBACK_URL = ContextVar("WORKFLOW_CALLBACK_URL", default="undefined")
+_JOB_DEADLINE = ContextVar("JOB_DEADLINE", default=None)  # time.monotonic() by which the job has to be done
 GCP_PROJECT = environ.get("GCP_PROJECT", "workflow-demo-02-28")  # todo change to actual project ID to enable local runs
 GCS_DEFAULT_BUCKET = environ.get("GCS_DEFAULT_BUCKET", f"{GCP_PROJECT}-private-disposable-1m")
+# max. seconds an invocation can run (--timeout of the Cloud Function, see cloudbuild.yaml)
+FUNCTION_TIMEOUT = int(environ.get("FUNCTION_TIMEOUT", 540))
+# seconds a secret is kept in memory (across invocations of a warm instance) before it is fetched again
+SECRET_CACHE_TTL = int(environ.get("SECRET_CACHE_TTL", 600))
+
+# FTP servers by name (= "source_ftp" in payloads). You can add others in the same manner:
+# - secret_id: Secret Manager secret with the login JSON ({"address": ..., "user": ..., "passwd": ..., "ftp_folder": ...})
+#   "address" is "host" or "host:port" (default port 21)
+# - secret_version: OPTIONAL, pins a secret version, defaults to "latest"
+FTP_SERVERS = {
+    "my_test_ftp": {"secret_id": "my_test_ftp"},
+}
+
+_secret_client = None
+_secret_cache = {}  # (secret_id, version) -> (expiry timestamp, secret value)
+_secret_lock = threading.Lock()
+
+
+class FtpConfig(NamedTuple):
+    """Login and default folder of an FTP server."""
+    name: str
+    address: str
+    user: str
+    passwd: str
+    folder: str = "/"
+
+
+def __getattr__(name: str):
+    # cfg.SCRIPT and cfg.WORKFLOW_CALLBACK_URL return the values of the current job
+    if name == "SCRIPT":
+        return _SCRIPT.get()
+    if name == "WORKFLOW_CALLBACK_URL":
+        return _WORKFLOW_CALLBACK_URL.get()
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+def set_job_cfg(script: str, workflow_callback_url: str = None, deadline: float = None):
+    """Sets the config of the job that is running in the current context (see cfg.SCRIPT). `deadline` is the
+    `time.monotonic()` by which the job has to be done (see `seconds_left`)."""
+    _SCRIPT.set(script)
+    if workflow_callback_url is not None:
+        _WORKFLOW_CALLBACK_URL.set(workflow_callback_url)
+    _JOB_DEADLINE.set(deadline)
+
+
+def seconds_left() -> float or None:
+    """Returns the seconds the job in the current context has left until its deadline (None = no deadline)."""
+    deadline = _JOB_DEADLINE.get()
+    return deadline - time.monotonic() if deadline is not None else None
 
 
 def reset_cfg_vars():
     print("Resetting Config Vars so they do not persist into the next run")
-    global SCRIPT, WORKFLOW_CALLBACK_URL
-    SCRIPT = "undefined"
-    WORKFLOW_CALLBACK_URL = "undefined"
-    return SCRIPT, WORKFLOW_CALLBACK_URL
+    _SCRIPT.set("undefined")
+    _WORKFLOW_CALLBACK_URL.set("undefined")
+    _JOB_DEADLINE.set(None)
+    return _SCRIPT.get(), _WORKFLOW_CALLBACK_URL.get()
+
 
+def secret_mgr_client():
+    """Returns the Secret Manager client, created once per instance (= one gRPC channel for all invocations).
+    `google.cloud.secretmanager` is only imported on first use, so scripts that need no secrets do not pay for it."""
+    global _secret_client
+    with _secret_lock:
+        if _secret_client is None:
+            from google.cloud import secretmanager
+            _secret_client = secretmanager.SecretManagerServiceClient()
+        return _secret_client
 
-def secret_mgr_get_secret(secret_id: str):
-    client = secretmanager.SecretManagerServiceClient()
-    project_id = GCP_PROJECT
-    name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
-    response = client.access_secret_version(request={"name": name})
+
+def secret_mgr_get_secret(secret_id: str, version: str = "latest", ttl: int = SECRET_CACHE_TTL):
+    """Returns the value of a Secret Manager secret. Values are cached for `ttl` seconds, so warm invocations do not
+    have to call Secret Manager again. Use `invalidate_secret` if a cached value turns out to be outdated."""
+    key = (secret_id, str(version))
+    cached = _secret_cache.get(key)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    name = f"projects/{GCP_PROJECT}/secrets/{secret_id}/versions/{version}"
+    response = secret_mgr_client().access_secret_version(request={"name": name})
     decoded = response.payload.data.decode("UTF-8")
+    with _secret_lock:
+        _secret_cache[key] = (time.monotonic() + ttl, decoded)
     return decoded
 
 
-# FTP servers. You can add others in the same manner:
-def my_test_ftp():
-    login_info = loads(secret_mgr_get_secret("my_test_ftp"))
-    my_test_ftp.address = login_info["address"]
-    my_test_ftp.user = login_info["user"]
-    my_test_ftp.passwd = login_info["passwd"]
-    my_test_ftp.ftp_folder = login_info["ftp_folder"]
-    return my_test_ftp
\ No newline at end of file
+def invalidate_secret(secret_id: str = None):
+    """Removes a secret (all its versions) or, if `secret_id` is None, all secrets from the cache."""
+    print(f"Invalidating cached secret {secret_id or '(all)'}")
+    with _secret_lock:
+        for key in list(_secret_cache):
+            if secret_id is None or key[0] == secret_id:
+                del _secret_cache[key]
+
+
+def get_ftp_config(name: str, refresh: bool = False) -> FtpConfig:
+    """Returns the config of the FTP server registered as `name` in `FTP_SERVERS`.
+    :param refresh: if True, fetches the login from Secret Manager again (eg. after a failed login)
+    """
+    server = FTP_SERVERS.get(name)
+    if server is None:
+        raise Exception(f"Unknown FTP server {name}. Register it in cfg.FTP_SERVERS.")
+    if refresh:
+        invalidate_secret(server["secret_id"])
+    login_info = loads(secret_mgr_get_secret(server["secret_id"], version=server.get("secret_version", "latest")))
+    return FtpConfig(name=name, address=login_info["address"], user=login_info["user"],
+                     passwd=login_info["passwd"], folder=login_info.get("ftp_folder") or "/")
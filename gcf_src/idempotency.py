@@ -0,0 +1,143 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from os import environ
+from typing import NamedTuple
+
+from gcf_src.config import cfg
+
+# set to "false" to run every delivery of a job, also duplicates (see `claim_job`)
+IDEMPOTENCY = environ.get("IDEMPOTENCY", "true").lower() != "false"
+# folder in the default bucket (gcs.DEFAULT_BUCKET) for the markers of jobs
+MARKER_FOLDER = "_idempotency/"
+# number of jobs this instance remembers, so that duplicates that reach the same instance do not need GCS
+LRU_SIZE = 256
+# a job that is marked as running for longer than this has been killed (eg. by the timeout), so it can be run again
+STALE_AFTER = timedelta(seconds=cfg.FUNCTION_TIMEOUT + 60)
+
+_jobs = OrderedDict()  # job key -> marker (see `claim_job`), most recently used last
+_jobs_lock = threading.Lock()
+
+
+class JobClaim(NamedTuple):
+    """Result of `claim_job`."""
+    key: str = None  # None = the job is not deduplicated
+    duplicate: bool = False  # True = the job was already run (or is running) and must not be run again
+    result: dict = None  # result of the earlier run of a duplicate, None if it is still running
+    generation: int = None  # generation of the marker in GCS written by this claim
+
+
+def job_key(event_payload: dict, event_id: str = None, batch_index: int = None) -> str:
+    """Returns the key that identifies a job.
+    A workflow creates a new callback URL for every attempt, so a payload with a workflow_callback_url is the same job
+    whenever it is delivered, also if it was published twice. Without a callback URL, the same payload can be a new
+    job (eg. a scheduled one), so only redeliveries of the same Pub/Sub message (`event_id`) are the same job then.
+    Identical jobs without a callback URL in one batch are different jobs, so their `batch_index` is part of the key.
+    """
+    payload_hash = hashlib.sha256(json.dumps(event_payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    if event_payload.get("workflow_callback_url"):
+        return payload_hash
+    if batch_index is not None:
+        return f"{event_id}-{batch_index}-{payload_hash}"
+    return f"{event_id}-{payload_hash}"
+
+
+def marker_location(key: str) -> str:
+    return f"{MARKER_FOLDER}{key}.json"
+
+
+def _remember(key: str, marker: dict):
+    with _jobs_lock:
+        _jobs[key] = marker
+        _jobs.move_to_end(key)
+        while len(_jobs) > LRU_SIZE:
+            _jobs.popitem(last=False)
+
+
+def _duplicate(key: str, marker: dict) -> JobClaim:
+    print(f"Job {key} was delivered before (state: {marker.get('state')}, event {marker.get('event_id')}).")
+    return JobClaim(key=key, duplicate=True, result=marker.get("result") if marker.get("state") == "done" else None)
+
+
+def _is_stale(marker: dict) -> bool:
+    started = datetime.fromisoformat(marker["started"])
+    return datetime.now(timezone.utc) - started > STALE_AFTER
+
+
+def claim_job(event_payload: dict, event_id: str = None, batch_index: int = None) -> JobClaim:
+    """Claims the job with `event_payload` (delivered as Pub/Sub message `event_id`, as job number `batch_index` of a
+    batch) for this invocation, unless it was delivered before: Pub/Sub delivers at least once, and a redelivered job
+    would transfer everything again (and fail to delete files that are already gone).
+
+    Jobs are remembered in memory (for duplicates that reach the same instance) and as marker objects in GCS: the first
+    delivery creates the marker ("running") with a generation precondition, so exactly one invocation gets to run the
+    job, and `complete_job` stores its result in it (or `release_job` removes it if the job failed, so that it can run
+    again). A later delivery gets the stored result (see `JobClaim`). A job whose marker is still "running" after
+    `STALE_AFTER` was killed and is claimed again. If GCS cannot be reached, the job runs anyway.
+    Jobs with `"idempotent": false` in the payload are never deduplicated.
+    """
+    if not IDEMPOTENCY or not isinstance(event_payload, dict) or event_payload.get("idempotent") is False:
+        return JobClaim()
+    from gcf_src.storage import gcs
+
+    key = job_key(event_payload, event_id, batch_index)
+    with _jobs_lock:
+        remembered = _jobs.get(key)
+    if remembered is not None and not (remembered["state"] == "running" and _is_stale(remembered)):
+        return _duplicate(key, remembered)
+
+    marker = {"state": "running", "event_id": event_id, "script": event_payload.get("script"),
+              "started": datetime.now(timezone.utc).isoformat()}
+    location = marker_location(key)
+    try:
+        try:
+            generation = gcs.write_json(location, marker, if_generation_match=0)
+        except gcs.GenerationMismatch:
+            existing, existing_generation = gcs.read_json_with_generation(location)
+            if existing is not None and not (existing["state"] == "running" and _is_stale(existing)):
+                _remember(key, existing)
+                return _duplicate(key, existing)
+            print(f"Job {key} was not completed by the invocation that claimed it. Running it again.")
+            # fails if another invocation took it over in the meantime
+            generation = gcs.write_json(location, marker, if_generation_match=existing_generation)
+    except gcs.GenerationMismatch as e:
+        print(f"Job {key} was claimed by another invocation in the meantime: {e}")
+        return JobClaim(key=key, duplicate=True)
+    except Exception as e:
+        print(f"Could not check if job {key} was delivered before, running it anyway: {e}")
+        generation = None
+    _remember(key, marker)
+    return JobClaim(key=key, generation=generation)
+
+
+def complete_job(job_claim: JobClaim, result: dict):
+    """Stores the `result` of the job claimed with `job_claim`, so that later deliveries of the job replay it."""
+    if job_claim.key is None or job_claim.duplicate:
+        return
+    from gcf_src.storage import gcs
+
+    with _jobs_lock:
+        marker = dict(_jobs.get(job_claim.key) or {})
+    marker.update({"state": "done", "result": result, "completed": datetime.now(timezone.utc).isoformat()})
+    _remember(job_claim.key, marker)
+    try:
+        gcs.write_json(marker_location(job_claim.key), json.loads(json.dumps(marker, default=str)),
+                       if_generation_match=job_claim.generation)
+    except Exception as e:
+        print(f"Could not store the result of job {job_claim.key}: {e}")
+
+
+def release_job(job_claim: JobClaim):
+    """Forgets the job claimed with `job_claim` (eg. because it failed), so that a later delivery runs it again."""
+    if job_claim.key is None or job_claim.duplicate:
+        return
+    from gcf_src.storage import gcs
+
+    with _jobs_lock:
+        _jobs.pop(job_claim.key, None)
+    try:
+        gcs.delete_file_if_exists(marker_location(job_claim.key))
+    except Exception as e:
+        print(f"Could not release job {job_claim.key}: {e}")
@@ -0,0 +1,154 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# metrics of the script run (and the file) that is being processed in the current context. Threads started for a run
+# have to run in a copy of its context (contextvars.copy_context().run) to be counted.
+_current_run = ContextVar("metrics_run", default=None)
+_current_file = ContextVar("metrics_file", default=None)
+
+
+def log_entry(message: str, severity: str = "INFO", **fields):
+    """Prints a structured log entry: Cloud Logging parses JSON lines on stdout into jsonPayload (with `message` as
+    the summary line and `severity` as the log level), so the fields can be filtered and charted."""
+    print(json.dumps({"severity": severity, "message": message, **fields}, default=str))
+
+
+def _totals(seconds: float, nbytes: int or None) -> dict:
+    totals = {"count": 1, "seconds": seconds}
+    if nbytes is not None:
+        totals["bytes"] = nbytes
+    return totals
+
+
+def _add(totals: dict, seconds: float, nbytes: int or None):
+    totals["count"] += 1
+    totals["seconds"] += seconds
+    if nbytes is not None:
+        totals["bytes"] = totals.get("bytes", 0) + nbytes
+
+
+def _summary(totals: dict) -> dict:
+    summary = {"count": totals["count"], "seconds": round(totals["seconds"], 3)}
+    if "bytes" in totals:
+        summary["bytes"] = totals["bytes"]
+        if totals["seconds"] > 0:
+            summary["mb_per_s"] = round(totals["bytes"] / totals["seconds"] / 1e6, 2)
+    return summary
+
+
+class RunMetrics:
+    """Wall time, bytes and throughput per phase (eg. "ftp_download") of a script run, in total and per file.
+    Phases are recorded from any thread with `phase()`. Phases can overlap (eg. the GCS upload of a block happens while
+    the FTP download of the file is still running), so their times do not add up to the wall time of the run.
+    """
+
+    def __init__(self, script: str = None):
+        self.script = script
+        self.started = time.monotonic()
+        self.phases = {}  # phase -> totals
+        self.files = {}  # file -> phase -> totals
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, seconds: float, nbytes: int = None, file: str = None):
+        with self._lock:
+            if phase in self.phases:
+                _add(self.phases[phase], seconds, nbytes)
+            else:
+                self.phases[phase] = _totals(seconds, nbytes)
+            if file is not None:
+                file_phases = self.files.setdefault(file, {})
+                if phase in file_phases:
+                    _add(file_phases[phase], seconds, nbytes)
+                else:
+                    file_phases[phase] = _totals(seconds, nbytes)
+
+    def to_dict(self) -> dict:
+        """Returns the metrics as JSON-serializable dict (for logs and the workflow callback payload)."""
+        with self._lock:
+            return {"script": self.script, "wall_seconds": round(time.monotonic() - self.started, 3),
+                    "phases": {phase: _summary(totals) for phase, totals in self.phases.items()},
+                    "files": {file: {phase: _summary(totals) for phase, totals in file_phases.items()}
+                              for file, file_phases in self.files.items()}}
+
+
+class Phase:
+    """A running phase (see `phase()`). Set `bytes` to the number of bytes it transferred."""
+
+    def __init__(self, name: str, file: str = None):
+        self.name = name
+        self.file = file
+        self.bytes = None
+
+
+def current() -> RunMetrics or None:
+    """Returns the metrics of the run in the current context (None if no run is measured)."""
+    return _current_run.get()
+
+
+@contextmanager
+def run(script: str = None):
+    """Measures a script run: phases in this context (and in threads that copy it) are recorded in the yielded
+    `RunMetrics`."""
+    run_metrics = RunMetrics(script)
+    token = _current_run.set(run_metrics)
+    try:
+        yield run_metrics
+    finally:
+        _current_run.reset(token)
+
+
+def use(run_metrics: RunMetrics or None):
+    """Records the phases of the current context in `run_metrics` (eg. at the start of an asyncio task, which does not
+    inherit the context of the code that scheduled it from another thread)."""
+    _current_run.set(run_metrics)
+
+
+@contextmanager
+def file_scope(file: str):
+    """Attributes the phases in this context to `file` (unless they name a file themselves)."""
+    token = _current_file.set(file)
+    try:
+        yield
+    finally:
+        _current_file.reset(token)
+
+
+@contextmanager
+def phase(name: str, file: str = None, log: bool = True):
+    """Measures the wall time of the block as phase `name` of the current run and, if `log`, prints a structured log
+    entry for it. Set `bytes` on the yielded `Phase` to get the throughput. Use `log=False` for small, frequent phases
+    (eg. chunks of an upload): they are only added up in the metrics of the run.
+
+    Usage:
+        with metrics.phase("ftp_download", file=file_name) as download:
+            download.bytes = download_file(file_name)
+    """
+    current_phase = Phase(name, file=file or _current_file.get())
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield current_phase
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        run_metrics = _current_run.get()
+        if run_metrics is not None:
+            run_metrics.record(name, seconds, nbytes=current_phase.bytes, file=current_phase.file)
+        if log:
+            fields = {"phase": name, "seconds": round(seconds, 3)}
+            if current_phase.file is not None:
+                fields["file"] = current_phase.file
+            if current_phase.bytes is not None:
+                fields["bytes"] = current_phase.bytes
+                if seconds > 0:
+                    fields["mb_per_s"] = round(current_phase.bytes / seconds / 1e6, 2)
+            if run_metrics is not None and run_metrics.script is not None:
+                fields["script"] = run_metrics.script
+            if failed:
+                fields["failed"] = True
+            log_entry(f"{name} took {seconds:.3f}s", **fields)
@@ -0,0 +1,88 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+# number of functions (cpu) or source lines (memory) listed in a profile
+PROFILE_TOP = 20
+# before Python 3.12, a cProfile only sees the thread that enabled it, so every new thread gets its own. Since 3.12
+# (sys.monitoring), one cProfile sees all threads and only one can be enabled at a time
+PROFILE_PER_THREAD = sys.version_info < (3, 12)
+
+
+def _format_cpu_profile(profiles: list, top: int) -> list:
+    stats = None
+    for profile in profiles:
+        if stats is None:
+            stats = pstats.Stats(profile, stream=io.StringIO())
+        else:
+            stats.add(profile)
+    stats.sort_stats("cumulative")
+    lines = []
+    for (file_name, line, function), (_, calls, _, cumulative, _) in stats.stats.items():
+        lines.append({"function": f"{file_name}:{line}({function})", "calls": calls,
+                      "cumulative_seconds": round(cumulative, 4)})
+    return sorted(lines, key=lambda entry: entry["cumulative_seconds"], reverse=True)[:top]
+
+
+@contextmanager
+def profiled(mode: str or bool, top: int = PROFILE_TOP):
+    """Profiles the block and fills the yielded dict with the results when it ends.
+    :param mode: "cpu" (cProfile), "memory" (tracemalloc) or True (both)
+    :param top: number of functions (cpu) or source lines (memory) to report
+
+    The CPU profile covers the calling thread and all threads started while profiling (eg. transfer threads).
+    Threads of other jobs running at the same time are included, too (on Python 3.12+ all threads are, and only one
+    job can be profiled at a time: the CPU profile of a job that starts while another one is profiled is empty).
+    The memory profile reports the peak of traced memory and the source lines that allocated the most memory that is
+    still held at the end.
+    """
+    cpu = mode is True or mode == "cpu"
+    memory = mode is True or mode == "memory"
+    result = {}
+    profiles = []  # enabled profiles
+    if cpu:
+        def profile_new_thread(frame, event, arg):
+            # called once in every new thread: replace this hook with a cProfile of the thread
+            sys.setprofile(None)
+            thread_profile = cProfile.Profile()
+            thread_profile.enable()
+            profiles.append(thread_profile)
+
+        main_profile = cProfile.Profile()
+        try:
+            main_profile.enable()
+            profiles.append(main_profile)
+        except ValueError as e:
+            # Python 3.12+: another job (or tool) is profiling already
+            print(f"Could not start the CPU profile: {e}")
+            result["cpu"] = []
+            cpu = False
+        if cpu and PROFILE_PER_THREAD:
+            threading.setprofile(profile_new_thread)
+    started_tracing = False
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        started_tracing = True
+    try:
+        yield result
+    finally:
+        if cpu:
+            if PROFILE_PER_THREAD:
+                threading.setprofile(None)
+            for profile in profiles:
+                profile.disable()
+            result["cpu"] = _format_cpu_profile(profiles, top)
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            result["memory"] = {
+                "peak_bytes": peak,
+                "top": [{"line": str(stat.traceback), "bytes": stat.size, "count": stat.count}
+                        for stat in snapshot.statistics("lineno")[:top]],
+            }
+            if started_tracing:
+                tracemalloc.stop()
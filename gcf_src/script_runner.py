@@ -1,48 +1,198 @@
+import contextvars
+import importlib
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
 
+from gcf_src import idempotency
 from gcf_src.config import cfg
+from gcf_src.monitoring import metrics, profiling
 from gcf_src.workflows.helpers import workflow_callback_after_run
 
+# Supported scripts: payload "script" name -> module with a `run_script(**kwargs)` function.
+# Modules are only imported when a script is first run (or pre-warmed), so a cold start only pays for what it uses.
+SCRIPTS = {
+    "ftp_to_gcs": "gcf_src.storage.ftp_to_gcs",
+    "gcs_to_ftp": "gcf_src.storage.gcs_to_ftp",
+    "example_script": "gcf_src.example_script.example_script",
+}
+# comma-separated script names to import (and whose clients to create) when the instance starts, eg. "ftp_to_gcs"
+PREWARM_SCRIPTS = environ.get("PREWARM_SCRIPTS", "")
+# default max. number of jobs of a batch payload that run at the same time
+BATCH_MAX_CONCURRENCY = int(environ.get("BATCH_MAX_CONCURRENCY", 4))
 
-def run(event_payload):
-    """Runs the script with the supplied `event_payload` from pubsub."""
+_script_functions = {}
+_script_lock = threading.Lock()
+
+
+def get_script(script: str):
+    """Returns the `run_script` function of the registered `script`, importing its module on first use.
+    :raises NotImplementedError: if no such script is registered
+    """
+    if script not in SCRIPTS:
+        raise NotImplementedError(f"Unsupported script: {script}")
+    with _script_lock:
+        if script not in _script_functions:
+            _script_functions[script] = importlib.import_module(SCRIPTS[script]).run_script
+        return _script_functions[script]
+
+
+def prewarm(scripts: list = None):
+    """Imports the modules of `scripts` (default: `PREWARM_SCRIPTS`) and calls their optional `prewarm()` function
+    (eg. to create API clients), so that the first invocation of a new instance does not have to."""
+    if scripts is None:
+        scripts = [script.strip() for script in PREWARM_SCRIPTS.split(",") if script.strip()]
+    for script in scripts:
+        print(f"Pre-warming script {script}")
+        get_script(script)
+        module = importlib.import_module(SCRIPTS[script])
+        if hasattr(module, "prewarm"):
+            module.prewarm()
+
+
+def run(event_payload, event_id: str = None):
+    """Runs the script with the supplied `event_payload` from pubsub (message `event_id`).
+    The payload is either a single job ({"script": ..., "workflow_callback_url": ..., ...}) or a batch of jobs
+    ({"jobs": [job payload, ...], "max_concurrency": 4}, see `run_batch`)."""
+    # the invocation is killed after cfg.FUNCTION_TIMEOUT seconds, so jobs have to be done by then
+    deadline = time.monotonic() + cfg.FUNCTION_TIMEOUT
 
     print("in script_runner: checking event payload for valid JSON")
-    script_result = None
     try:
         event_payload = json.loads(event_payload)
-        print(f"Transformed event payload JSON to dict: {event_payload}")
+    except Exception as e:
+        print(f"Error in script_runner: {e}")
+        return e
+    print(f"Transformed event payload JSON to dict: {event_payload}")
+    if isinstance(event_payload, dict) and isinstance(event_payload.get("jobs"), list):
+        return run_batch(event_payload["jobs"], max_concurrency=event_payload.get("max_concurrency"),
+                         deadline=deadline, event_id=event_id)
+    return run_job(event_payload, deadline=deadline, event_id=event_id)
+
+
+def run_batch(jobs: list, max_concurrency: int = None, deadline: float = None, event_id: str = None) -> dict:
+    """Runs several jobs (= payloads of single runs, each with its own script and workflow_callback_url) in one
+    invocation, up to `max_concurrency` (default: `BATCH_MAX_CONCURRENCY`) at the same time. Each job sends its own
+    workflow callback as soon as it is done. Jobs run in their own context, so their config (cfg.SCRIPT,
+    cfg.WORKFLOW_CALLBACK_URL) does not get mixed up.
+    :return: {"result": "done", "jobs": the results of the jobs in the order of `jobs`}
+    """
+    max_concurrency = int(max_concurrency or BATCH_MAX_CONCURRENCY)
+    print(f"Running batch of {len(jobs)} jobs with max. {max_concurrency} at the same time")
+
+    def run_isolated(batch_index: int, job_payload: dict) -> dict:
+        try:
+            job_result = run_job(job_payload, deadline=deadline, event_id=event_id, batch_index=batch_index)
+        except Exception as e:  # the error callback failed, but the other jobs should still run
+            return {"result": "error", "result_detail": str(e)}
+        if isinstance(job_result, Exception):
+            return {"result": "error", "result_detail": str(job_result)}
+        return job_result
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        # copy_context: each job gets a fresh context, also if the worker thread ran another job before
+        futures = [executor.submit(contextvars.copy_context().run, run_isolated, batch_index, job_payload)
+                   for batch_index, job_payload in enumerate(jobs)]
+        job_results = [future.result() for future in futures]
+    print(f"Finished batch with results: {[job_result.get('result') for job_result in job_results]}")
+    return {"result": "done", "jobs": job_results}
+
+
+def run_job(event_payload: dict, deadline: float = None, event_id: str = None, batch_index: int = None):
+    """Runs the script of a single job (= the parsed payload of a single run) and sends its result to the workflow.
+    The metrics of the run (time and throughput per phase, see `metrics.RunMetrics`) are logged and added to the
+    result as "metrics". With `"profile": "cpu"`, `"memory"` or `true` in the payload, the run is profiled and the
+    profile is added to the result as "profile".
+    The job has to be done by `deadline` (`time.monotonic()` of the end of the invocation) or by the time the workflow
+    stops waiting for it (`callback_timeout` in the payload), whichever comes first. Scripts can check the time they
+    have left with `cfg.seconds_left()`.
+    A job that was delivered before (Pub/Sub message `event_id` was redelivered or the job was published twice) is not
+    run again: the result of the earlier run is sent to the workflow instead (see `idempotency.claim_job`, jobs of a
+    batch also pass their `batch_index`).
+    """
+    job_claim = idempotency.claim_job(event_payload, event_id, batch_index)
+    if job_claim.duplicate:
+        return replay_job(event_payload, job_claim)
+    with metrics.run(event_payload.get("script") if isinstance(event_payload, dict) else None) as run_metrics:
+        return _run_job(event_payload, run_metrics, deadline=job_deadline(event_payload, deadline),
+                        job_claim=job_claim)
+
+
+def replay_job(event_payload: dict, job_claim: idempotency.JobClaim) -> dict:
+    """Sends the stored result of a job that was run before (see `run_job`) to the workflow again. If the job is still
+    running, its run will send the result, so nothing is sent."""
+    if job_claim.result is None:
+        print(f"Job {job_claim.key} is still running in another invocation, skipping this delivery.")
+        return {"result": "duplicate", "result_detail": f"job {job_claim.key} is still running"}
+    print(f"Replaying the result of job {job_claim.key} instead of running it again: {job_claim.result}")
+    cfg.set_job_cfg(event_payload.get("script"), workflow_callback_url=event_payload.get("workflow_callback_url"))
+    try:
+        workflow_callback_after_run(workflow_callback_payload=dict(job_claim.result))
+    finally:
+        cfg.reset_cfg_vars()  # reset cfg vars so they do not persist into the next run
+    return job_claim.result
+
+
+def job_deadline(event_payload: dict, deadline: float = None) -> float or None:
+    """Returns the deadline of the job with `event_payload` in an invocation that ends at `deadline`."""
+    callback_timeout = event_payload.get("callback_timeout") if isinstance(event_payload, dict) else None
+    if callback_timeout is None:
+        return deadline
+    callback_deadline = time.monotonic() + float(callback_timeout)
+    return callback_deadline if deadline is None else min(deadline, callback_deadline)
+
+
+def add_metrics(script_result, run_metrics: metrics.RunMetrics, profile: dict = None):
+    """Logs the metrics of the run and adds them (and the `profile`, if any) to the `script_result` dict."""
+    run_metrics_dict = run_metrics.to_dict()
+    metrics.log_entry(f"Run of {run_metrics.script} took {run_metrics_dict['wall_seconds']}s",
+                      metrics=run_metrics_dict)
+    if isinstance(script_result, dict):
+        script_result["metrics"] = run_metrics_dict
+        if profile:
+            script_result["profile"] = profile
+
+
+def _run_job(event_payload: dict, run_metrics: metrics.RunMetrics, deadline: float = None,
+             job_claim: idempotency.JobClaim = idempotency.JobClaim()):
+    script_result = None
+    profile = None
+    try:
         script = event_payload.get('script')
 
-        cfg.SCRIPT = script
+        cfg.set_job_cfg(script, workflow_callback_url=event_payload.get("workflow_callback_url"), deadline=deadline)
         if event_payload.get("workflow_callback_url") is not None:
-            cfg.WORKFLOW_CALLBACK_URL = event_payload['workflow_callback_url']
             print(f"Workflow Callback URL in payload, will send callback request there after this run: "
                   f"{cfg.WORKFLOW_CALLBACK_URL}")
 
-        # placeholders, will be overwritten if supported script is found:
-        script_result = f"Unsupported payload sent to script_runner: {event_payload}"
-
-        def run_script(**kwargs):
-            _ = kwargs  # otherwise IDE code check complains about an unused variable
-            raise NotImplementedError(script_result)
-
-        # check payload for script name and import the corresponding script
-        if script == "ftp_to_gcs":
-            from gcf_src.storage.ftp_to_gcs import run_script
-        elif script == "example_script":
-            from gcf_src.example_script.example_script import run_script
+        if script not in SCRIPTS:
+            raise NotImplementedError(f"Unsupported payload sent to script_runner: {event_payload}")
+        run_script = get_script(script)
 
-        script_result = run_script(payload=event_payload)
+        if event_payload.get("profile"):
+            with profiling.profiled(event_payload["profile"]) as profile:
+                with metrics.phase("script"):
+                    script_result = run_script(payload=event_payload)
+        else:
+            with metrics.phase("script"):
+                script_result = run_script(payload=event_payload)
         print(f"Finished Run with result: {script_result}.")
 
+        add_metrics(script_result, run_metrics, profile=profile)
+        # before the callback: if it fails, a redelivery only has to replay it
+        idempotency.complete_job(job_claim, script_result)
+        job_claim = idempotency.JobClaim()  # done, also if the callback fails
         workflow_callback_after_run(workflow_callback_payload=script_result)
         cfg.reset_cfg_vars()
         return script_result
 
     except Exception as e:
         print(f"Error in script_runner: {e}")
+        idempotency.release_job(job_claim)  # a redelivery may succeed
         script_result = {"result": "error", "result_detail": str(e)}
+        add_metrics(script_result, run_metrics, profile=profile)
         try:
             workflow_callback_after_run(workflow_callback_payload=script_result)
         except Exception as exc:
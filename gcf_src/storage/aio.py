@@ -0,0 +1,129 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# max. number of downloaded blocks (of ftp.STREAM_BLOCKSIZE) waiting to be uploaded, per file
+QUEUE_SIZE = 16
+
+_END = object()  # marks the end of the data in a `BlockQueue`
+
+
+class EventLoopThread:
+    """Runs an asyncio event loop in a background thread, so that synchronous code can hand coroutines to it with
+    `submit` and wait for them like for any other `concurrent.futures.Future`. Blocking calls of the coroutines
+    (`asyncio.to_thread`) run in a pool of `max_workers` threads.
+
+    Usage:
+        with aio.EventLoopThread() as engine:
+            future = engine.submit(some_coroutine())
+            result = future.result()
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="asyncio"))
+        self._thread = threading.Thread(target=self.loop.run_forever, name="asyncio", daemon=True)
+        self._submitted = set()  # tasks of the coroutines passed to `submit` that are still running
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def submit(self, coroutine):
+        """Schedules `coroutine` on the event loop.
+        :return: a `concurrent.futures.Future` of its result (cancelling it cancels the coroutine)
+        """
+        async def run_submitted():
+            task = asyncio.current_task()
+            self._submitted.add(task)
+            try:
+                return await coroutine
+            finally:
+                self._submitted.discard(task)
+
+        return asyncio.run_coroutine_threadsafe(run_submitted(), self.loop)
+
+    def close(self):
+        """Cancels whatever is still running, then stops the event loop and its thread.
+        The submitted coroutines are cancelled first, while the tasks they started (eg. `BlockQueue.drain`) still run,
+        so that they can clean up. Whatever is left after that is cancelled, too."""
+        async def cancel(tasks: list):
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        async def cancel_all():
+            await cancel(list(self._submitted))
+            await cancel([task for task in asyncio.all_tasks() if task is not asyncio.current_task()])
+            await self.loop.shutdown_default_executor()
+
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(cancel_all(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+        self.loop.close()
+
+
+class BlockQueue:
+    """Bounded queue of data blocks between a producer thread (eg. an FTP download, which calls `write` like on any
+    other writer) and a coroutine on the event loop that consumes the blocks (see `drain`).
+
+    `write` blocks while the queue is full, so a download never gets further ahead of its upload than `maxsize`
+    blocks. If the consumer failed, `write` raises its error, so that the producer stops early.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int = QUEUE_SIZE):
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self.error = None  # error of the consumer
+        self.bytes_written = 0  # bytes accepted by `write`
+
+    def write(self, data: bytes) -> int:
+        """Adds a block to the queue (only call this from another thread than the event loop's)."""
+        put = asyncio.run_coroutine_threadsafe(self._queue.put(bytes(data)), self._loop)
+        while True:
+            if self.error is not None:
+                put.cancel()
+                raise self.error
+            try:
+                put.result(timeout=1)
+                break
+            except TimeoutError:
+                pass  # queue still full, check for errors again
+        self.bytes_written += len(data)
+        return len(data)
+
+    def abort(self, error: BaseException):
+        """Stops the transfer: the consumer discards the remaining blocks and `write` raises `error`."""
+        if self.error is None:
+            self.error = error
+
+    async def end(self):
+        """Marks the end of the data (call this on the event loop). After `abort`, the blocks still in the queue are
+        discarded (the consumer would discard them anyway), so that this does not wait for room in the queue."""
+        if self.error is not None:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+        await self._queue.put(_END)
+
+    async def drain(self, writer):
+        """Writes the blocks to `writer` (eg. a `gcs.ResumableUploadStream`) until `end`. The (blocking) writes run in
+        a worker thread, so the event loop stays free for other transfers. An error of `writer` is kept in `error`;
+        the rest of the blocks are discarded then.
+        :raises Exception: the error of `writer`, once all blocks have been taken from the queue
+        """
+        while True:
+            block = await self._queue.get()
+            if block is _END:
+                break
+            if self.error is None:
+                try:
+                    await asyncio.to_thread(writer.write, block)
+                except Exception as e:
+                    self.error = e
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,116 @@
+import contextvars
+import queue
+import threading
+import zlib
+
+from gcf_src.monitoring import metrics
+
+# supported compressions: suffix of the object name, content type and Content-Encoding of the compressed object
+COMPRESSIONS = {
+    # with Content-Encoding gzip and the content type of the uncompressed file, GCS can serve the file decompressed
+    # (decompressive transcoding), eg. to BigQuery or browsers
+    "gzip": {"suffix": ".gz", "content_type": None, "content_encoding": "gzip", "default_level": 6},
+    # GCS cannot transcode zstd, so the object is stored as a plain zstd file
+    "zstd": {"suffix": ".zst", "content_type": "application/zstd", "content_encoding": None, "default_level": 3},
+}
+# max. number of blocks waiting to be compressed. Limits the memory used if the upload is slower than the download.
+QUEUE_SIZE = 8
+
+
+def get_compression(compression: str) -> dict:
+    """Returns the settings of the `compression` (see `COMPRESSIONS`).
+    :raises Exception: if the compression is not supported
+    """
+    if compression not in COMPRESSIONS:
+        raise Exception(f"compression must be one of {list(COMPRESSIONS)}, got {compression}.")
+    return COMPRESSIONS[compression]
+
+
+def compressor(compression: str, level: int = None):
+    """Returns a new streaming compressor (an object with `compress` and `flush` methods) for `compression`."""
+    if level is None:
+        level = get_compression(compression)["default_level"]
+    if compression == "gzip":
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # 16 + = gzip header and trailer
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("zstd compression requires the zstandard package.")
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    get_compression(compression)  # raises for unsupported compressions
+
+
+def compress(data: bytes, compression: str, level: int = None) -> bytes:
+    """Compresses `data` at once (for files that are in memory anyway)."""
+    compress_obj = compressor(compression, level)
+    return compress_obj.compress(data) + compress_obj.flush()
+
+
+class CompressingWriter:
+    """Writable file-like object that compresses the data written to it and writes the compressed data to `writer`
+    (eg. a `gcs.ResumableUploadStream`).
+
+    Compression and the writes to `writer` run on a worker thread, so they overlap with whatever produces the data
+    (eg. an FTP download) instead of alternating with it. zlib and zstandard release the GIL while they compress.
+    Errors of the worker are raised by the next `write` or by `close`.
+    """
+
+    def __init__(self, writer, compression: str, level: int = None, queue_size: int = QUEUE_SIZE):
+        self.writer = writer
+        self.compression = compression
+        self._compressor = compressor(compression, level)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._closed = False
+        self.bytes_written = 0  # uncompressed bytes written to this object
+        # copy_context: count the uploads of the worker in the metrics of the current run
+        self._worker = threading.Thread(target=contextvars.copy_context().run, args=(self._run,), name="compression",
+                                        daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            if self._error is not None:
+                continue  # drain the queue, so that `write` does not block
+            try:
+                with metrics.phase("compress", log=False) as compress_phase:
+                    compress_phase.bytes = len(block)
+                    compressed = self._compressor.compress(block)
+                if compressed:
+                    self.writer.write(compressed)
+            except Exception as e:
+                self._error = e
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise Exception(f"{self.compression} compression failed: {self._error}") from self._error
+
+    def write(self, data: bytes) -> int:
+        self._raise_error()
+        self._queue.put(bytes(data))
+        self.bytes_written += len(data)
+        return len(data)
+
+    def _stop(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._worker.join()
+
+    def close(self):
+        """Compresses the remaining data and closes `writer`.
+        :return: whatever `writer.close()` returns
+        """
+        self._stop()
+        self._raise_error()
+        self.writer.write(self._compressor.flush())
+        return self.writer.close()
+
+    def abort(self):
+        """Stops compressing and aborts `writer`."""
+        self._stop()
+        self.writer.abort()
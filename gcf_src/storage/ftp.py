@@ -1,139 +1,904 @@
+import contextvars
+import fnmatch
+import ftplib
+import itertools
+import posixpath
 import re
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
 from ftplib import FTP
 from io import BytesIO, StringIO
+from typing import NamedTuple
 
-from dateutil import parser
+from gcf_src.monitoring import metrics
+
+# block size for streaming downloads (bytes handed to the writer per `retrbinary` callback)
+STREAM_BLOCKSIZE = 1024 * 1024
+# idle seconds after which a pooled connection is checked with a NOOP before it is reused
+KEEPALIVE_INTERVAL = 30
+# size of the byte ranges of segmented downloads (see `download_segmented`). Same as gcs.COMPOSITE_PART_SIZE, so each
+# segment becomes one part of a parallel composite upload.
+SEGMENT_SIZE = 16 * 1024 * 1024
+# files smaller than this are not worth the extra connections of a segmented download
+SEGMENTED_DOWNLOAD_MIN_SIZE = 64 * 1024 * 1024
 
 
 def to_expected_folder(folder):
     return '/' + folder if folder != '/' else '/'
 
 
+def open_connection(ftp_address: str, timeout: int = None) -> FTP:
+    """Connects (without logging in) to `ftp_address`, which is "host" or "host:port" (default port 21)."""
+    host, port = ftp_address, 0  # 0 = ftplib default port
+    if ftp_address.count(":") == 1:  # not an IPv6 address
+        host, port = ftp_address.split(":")
+        port = int(port)
+    ftp = FTP(timeout=timeout)
+    ftp.connect(host, port)
+    return ftp
+
+
+def is_connection_error(error: Exception) -> bool:
+    """Returns True if `error` means that the FTP control connection is gone (so reconnecting may help)."""
+    if isinstance(error, (EOFError, OSError)):
+        return True
+    # 421 = "Service not available, closing control connection", eg. after an idle timeout on the server
+    return isinstance(error, ftplib.error_temp) and str(error).startswith("421")
+
+
+def is_login_error(error: Exception) -> bool:
+    """Returns True if `error` is a rejected login (530), eg. because of outdated credentials."""
+    return isinstance(error, ftplib.error_perm) and str(error).startswith("530")
+
+
+class FtpSession:
+    """A logged-in FTP connection that is shared by all FTP operations of a run instead of logging in anew for every
+    operation.
+
+    Before a connection that has been idle for `keepalive_interval` seconds is reused, a NOOP checks that it is still
+    alive. If the control connection was dropped, the session logs in again and, for operations run via `call`,
+    retries the operation up to `max_reconnects` times. If the login is rejected and `refresh_login` is provided, it is
+    called to get fresh (user, passwd) credentials for one more login attempt. A session is not thread-safe; use one
+    session per thread (see `FtpSessionPool`). Use it as a context manager or call `close()` when done.
+    """
+
+    def __init__(self, ftp_address: str, ftp_user: str, ftp_passwd: str, timeout: int = None,
+                 keepalive_interval: int = KEEPALIVE_INTERVAL, max_reconnects: int = 2, refresh_login=None):
+        self.ftp_address = ftp_address
+        self.ftp_user = ftp_user
+        self.ftp_passwd = ftp_passwd
+        self.refresh_login = refresh_login
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.max_reconnects = max_reconnects
+        self.logins = 0  # number of logins over the lifetime of this session
+        self.supports_mlsd = None  # None = not known yet
+        self.supports_rest = None  # None = not known yet
+        self.supports_list_glob = None  # None = not known yet (see `iter_entries`)
+        self._ftp = None
+        self._folder = None  # folder the connection has been changed into
+        self._last_used = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _connect(self):
+        self._drop()
+        print(f"Logging in to FTP server {self.ftp_address}")
+        with metrics.phase("ftp_login"):
+            ftp = open_connection(self.ftp_address, timeout=self.timeout)
+            try:
+                ftp.login(user=self.ftp_user, passwd=self.ftp_passwd)
+            except ftplib.error_perm as e:
+                ftp.close()
+                if not is_login_error(e) or self.refresh_login is None:
+                    raise
+                print(f"Login to FTP server {self.ftp_address} was rejected ({e}). "
+                      f"Retrying with refreshed credentials.")
+                self.ftp_user, self.ftp_passwd = self.refresh_login()
+                ftp = open_connection(self.ftp_address, timeout=self.timeout)
+                ftp.login(user=self.ftp_user, passwd=self.ftp_passwd)
+        self._ftp = ftp
+        self.logins += 1
+        self._last_used = time.monotonic()
+        print('Connection with ftp was established')
+
+    def _drop(self):
+        """Closes the socket without saying goodbye (for connections that are broken anyway)."""
+        if self._ftp is not None:
+            self._ftp.close()
+        self._ftp = None
+        self._folder = None
+
+    def _is_alive(self) -> bool:
+        if self._ftp is None or self._ftp.sock is None:
+            return False
+        if time.monotonic() - self._last_used < self.keepalive_interval:
+            return True
+        try:
+            self._ftp.voidcmd("NOOP")
+            self._last_used = time.monotonic()
+            return True
+        except ftplib.all_errors as e:
+            print(f"FTP connection to {self.ftp_address} is not alive anymore: {e}")
+            return False
+
+    def connection(self, ftp_folder: str = None) -> FTP:
+        """Returns the logged-in `FTP` connection (reconnecting if needed), changed into `ftp_folder` if provided."""
+        if not self._is_alive():
+            self._connect()
+        if ftp_folder is not None and ftp_folder != self._folder:
+            if self._ftp.pwd() != to_expected_folder(ftp_folder):
+                self._ftp.cwd(ftp_folder)
+            self._folder = ftp_folder
+        return self._ftp
+
+    def call(self, operation, ftp_folder: str = None, retry: bool = True):
+        """Runs `operation(ftp)` with the connection changed into `ftp_folder`.
+        If the control connection turns out to be dropped, logs in again and retries the operation (if `retry` is True;
+        pass False for operations that must not be repeated, eg. because they already streamed data somewhere).
+        :return: the result of `operation`
+        """
+        reconnects = 0
+        while True:
+            try:
+                result = operation(self.connection(ftp_folder))
+                self._last_used = time.monotonic()
+                return result
+            except ftplib.all_errors as e:
+                if not retry or not is_connection_error(e) or reconnects >= self.max_reconnects:
+                    raise
+                reconnects += 1
+                print(f"FTP connection to {self.ftp_address} dropped ({e}). Reconnecting "
+                      f"(attempt {reconnects} of {self.max_reconnects}).")
+                self._drop()
+
+    def close(self):
+        if self._ftp is not None:
+            print(f'Closing FTP connection to {self.ftp_address}')
+            try:
+                self._ftp.quit()
+            except ftplib.all_errors:
+                pass
+        self._drop()
+
+
+class FtpSessionPool:
+    """Hands out `FtpSession`s per FTP host and user, so that a run logs in once per connection instead of once per
+    operation. At most `max_connections_per_host` sessions per host and user are open at the same time; `session()`
+    waits for one to be released if all are in use. Closes all its sessions on `close()` (or when used as a context
+    manager).
+
+    Usage:
+        with ftp.FtpSessionPool(max_connections_per_host=4) as pool:
+            with pool.session(address, user, passwd) as session:
+                ftp.list_entries(ftp_folder="/outgoing", session=session)
+    """
+
+    def __init__(self, timeout: int = None, keepalive_interval: int = KEEPALIVE_INTERVAL,
+                 max_connections_per_host: int = 1, refresh_login=None):
+        self.timeout = timeout
+        self.keepalive_interval = keepalive_interval
+        self.refresh_login = refresh_login  # see FtpSession
+        self.max_connections_per_host = max(1, max_connections_per_host)
+        self._sessions = []  # all sessions created by this pool
+        self._idle = {}  # (address, user) -> list of sessions that are not in use
+        self._open = {}  # (address, user) -> number of sessions created
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    @contextmanager
+    def session(self, ftp_address: str, ftp_user: str, ftp_passwd: str, wait: bool = True) -> FtpSession:
+        """Checks out a session for `ftp_address` and `ftp_user` (reusing an idle one if possible) and returns it to the
+        pool afterwards. If not `wait`, yields None instead of waiting if all sessions of the host are in use."""
+        key = (ftp_address, ftp_user)
+        with self._condition:
+            while wait and not self._idle.get(key) and self._open.get(key, 0) >= self.max_connections_per_host:
+                self._condition.wait()
+            if self._idle.get(key):
+                session = self._idle[key].pop()
+            elif self._open.get(key, 0) < self.max_connections_per_host:
+                session = FtpSession(ftp_address, ftp_user, ftp_passwd, timeout=self.timeout,
+                                     keepalive_interval=self.keepalive_interval, refresh_login=self.refresh_login)
+                self._sessions.append(session)
+                self._open[key] = self._open.get(key, 0) + 1
+            else:
+                session = None
+        if session is None:
+            yield None
+            return
+        try:
+            yield session
+        finally:
+            with self._condition:
+                self._idle.setdefault(key, []).append(session)
+                self._condition.notify()
+
+    @property
+    def logins(self) -> int:
+        return sum(session.logins for session in self._sessions)
+
+    def close(self):
+        with self._condition:
+            for session in self._sessions:
+                session.close()
+            self._sessions = []
+            self._idle = {}
+            self._open = {}
+
+
+@contextmanager
+def session_or_one_off(session: FtpSession = None, ftp_address: str = None, ftp_user: str = None,
+                       ftp_passwd: str = None, timeout: int = None):
+    """Yields `session` if provided. Otherwise yields a new session for the supplied login that is closed afterwards."""
+    if session is not None:
+        yield session
+        return
+    with FtpSession(ftp_address, ftp_user, ftp_passwd, timeout=timeout) as one_off_session:
+        yield one_off_session
+
+
+class FtpEntry(NamedTuple):
+    """A file or folder from an FTP listing."""
+    name: str
+    type: str  # "file", "dir" or "link"
+    size: int = None  # in bytes, None if unknown
+    modified: datetime = None  # timezone-aware (UTC), None if unknown
+    source: str = "MLSD"  # listing command the entry comes from. LIST times are only precise to the minute (or day)
+
+
+# `ls -l` style LIST lines, eg. "-rw-r--r--   1 owner group    1234 Jan 15 10:30 file.csv" (group is optional)
+UNIX_LIST_RE = re.compile(r'^(?P<type>[-dlbcps])\S{9,10}\s+\d+\s+\S+\s+(?:\S+\s+)?(?P<size>\d+)\s+'
+                          r'(?P<month>[A-Za-z]{3})\s+(?P<day>\d{1,2})\s+(?P<time>\d{1,2}:\d{2}|\d{4})\s+(?P<name>.+)$')
+# Windows/IIS style LIST lines, eg. "01-15-24  10:30AM       1234 file.csv" or "01-15-24  10:30AM  <DIR>  folder"
+WINDOWS_LIST_RE = re.compile(r'^(?P<date>\d{2}-\d{2}-\d{2,4})\s+(?P<time>\d{1,2}:\d{2}[AP]M)\s+'
+                             r'(?P<size><DIR>|\d+)\s+(?P<name>.+)$')
+MLSD_TYPES = {"file": "file", "dir": "dir", "os.unix=symlink": "link", "os.unix=slink": "link"}
+
+
+def parse_mlsd_time(value: str) -> datetime or None:
+    """Parses an MLSD/MLST/MDTM time value (YYYYMMDDHHMMSS[.sss], always UTC as per RFC 3659)."""
+    if not value:
+        return None
+    return datetime.strptime(value[:14], "%Y%m%d%H%M%S").replace(tzinfo=timezone.utc)
+
+
+def mlsd_entry(name: str, facts: dict) -> FtpEntry:
+    """Builds an `FtpEntry` from the facts of an MLSD/MLST line."""
+    size = facts.get("size") or facts.get("sizd")
+    return FtpEntry(name=name, type=MLSD_TYPES.get(facts.get("type", "").lower(), facts.get("type", "").lower()),
+                    size=int(size) if size is not None else None, modified=parse_mlsd_time(facts.get("modify")))
+
+
+def _recent_list_time(month: str, day: str, time_of_day: str, now: datetime) -> datetime or None:
+    """Returns the time of a Unix LIST line without year (eg. "Jan 15 10:30"): recent files are listed like this, so it
+    is the last such time that is not in the future (None if there is none, eg. "Feb 29" in the wrong years)."""
+    # parsed in a leap year, so that Feb 29 is a valid date
+    parsed = datetime.strptime(f"2000 {month} {day} {time_of_day}", "%Y %b %d %H:%M").replace(tzinfo=timezone.utc)
+    for year in (now.year, now.year - 1):
+        try:
+            modified = parsed.replace(year=year)
+        except ValueError:  # Feb 29 in a year that is not a leap year
+            continue
+        if modified <= now + timedelta(days=1):
+            return modified
+    return None
+
+
+def parse_list_line(line: str, now: datetime = None) -> FtpEntry or None:
+    """Parses one line of LIST output (Unix or Windows/IIS style). Times are assumed to be UTC.
+    :return: the entry or None if the line could not be parsed
+    """
+    now = now or datetime.now(timezone.utc)
+    match = UNIX_LIST_RE.match(line)
+    if match:
+        entry_type = {"-": "file", "d": "dir", "l": "link"}.get(match["type"], match["type"])
+        name = match["name"].split(" -> ")[0] if entry_type == "link" else match["name"]
+        try:
+            if ":" in match["time"]:  # recent files are listed without year
+                modified = _recent_list_time(match["month"], match["day"], match["time"], now)
+                if modified is None:
+                    return None
+            else:
+                modified = datetime.strptime(f'{match["time"]} {match["month"]} {match["day"]}',
+                                             "%Y %b %d").replace(tzinfo=timezone.utc)
+        except ValueError:  # eg. an unknown month or a day that does not exist
+            return None
+        return FtpEntry(name=name, type=entry_type, size=int(match["size"]), modified=modified, source="LIST")
+    match = WINDOWS_LIST_RE.match(line)
+    if match:
+        date_format = "%m-%d-%y" if len(match["date"]) == 8 else "%m-%d-%Y"
+        try:
+            modified = datetime.strptime(f'{match["date"]} {match["time"]}',
+                                         f"{date_format} %I:%M%p").replace(tzinfo=timezone.utc)
+        except ValueError:
+            return None
+        is_dir = match["size"] == "<DIR>"
+        return FtpEntry(name=match["name"], type="dir" if is_dir else "file",
+                        size=None if is_dir else int(match["size"]), modified=modified, source="LIST")
+    return None
+
+
+def parse_mlsd_line(line: str) -> tuple:
+    """Parses one line of MLSD output (eg. "type=file;size=123;modify=20240115103000; file.csv").
+    :return: (name, dict of the facts with lower-case keys)
+    """
+    facts_str, _, name = line.partition(" ")
+    facts = {}
+    for fact in facts_str.rstrip(";").split(";"):
+        key, _, value = fact.partition("=")
+        facts[key.lower()] = value
+    return name, facts
+
+
+def _iter_lines(ftp: FTP, command: str):
+    """Yields the lines of the listing `command` (eg. "MLSD") as they arrive. Like `FTP.retrlines`, but without
+    collecting all lines first."""
+    ftp.sendcmd("TYPE A")
+    conn = ftp.transfercmd(command)
+    try:
+        with conn.makefile("r", encoding=ftp.encoding) as lines:
+            for line in lines:
+                yield line.rstrip("\r\n")
+    except GeneratorExit:
+        # the listing was abandoned: read the reply to the aborted transfer, so that the connection stays usable
+        conn.close()
+        try:
+            ftp.getresp()
+        except ftplib.all_errors:
+            pass
+        raise
+    finally:
+        conn.close()
+    ftp.voidresp()
+
+
+def _iter_list(ftp: FTP, command: str):
+    """Yields the entries of the LIST `command` (eg. "LIST" or "LIST *.csv") as they arrive."""
+    for line in _iter_lines(ftp, command):
+        entry = parse_list_line(line)
+        if entry is None:
+            if not line.startswith("total "):
+                print(f"Could not parse LIST line, ignoring it: {line}")
+        elif entry.name not in (".", ".."):
+            yield entry
+
+
+def _iter_folder(ftp: FTP, session: "FtpSession", path: str = None, name_glob: str = None):
+    """Yields the entries of the folder `path` (relative to the current folder of `ftp`, None = the current folder) as
+    the listing arrives, with their names relative to that folder.
+    With `name_glob` (eg. "*.csv"), only files matching it are yielded (folders always are). The glob is sent to the
+    server with LIST, so that servers that support it only send the matching files. If that listing fails or is empty,
+    the folder is listed completely and the glob is checked here (servers that do not support globs answer with an error
+    or an empty listing, or list everything).
+    """
+    if name_glob is not None and session.supports_list_glob is not False:
+        found = False
+        try:
+            for entry in _iter_list(ftp, "LIST " + (posixpath.join(path, name_glob) if path else name_glob)):
+                if entry.type == "dir" or fnmatch.fnmatchcase(entry.name, name_glob):
+                    found = True
+                    yield entry
+        except ftplib.error_perm as e:  # eg. 550 = no matching files (or globs not supported)
+            if found:
+                raise
+            print(f"Listing {name_glob} on FTP server {session.ftp_address} failed ({e}), listing all files instead.")
+        if found:
+            return
+
+    entries = None
+    if session.supports_mlsd is not False:
+        try:
+            ftp.sendcmd("OPTS MLST type;size;modify;")
+            entries = (mlsd_entry(name, facts) for name, facts in map(parse_mlsd_line, _iter_lines(
+                ftp, "MLSD " + path if path else "MLSD")) if facts.get("type", "").lower() not in ("cdir", "pdir"))
+            first = next(entries, None)  # MLSD is sent with the first entry
+            session.supports_mlsd = True
+        except ftplib.error_perm as e:  # 500/502 = command not understood/implemented
+            if not str(e).startswith("50"):
+                raise
+            print(f"FTP server {session.ftp_address} does not support MLSD ({e}), falling back to LIST.")
+            session.supports_mlsd = False
+            entries = None
+        else:
+            entries = itertools.chain([first] if first is not None else [], entries)
+    if entries is None:
+        entries = _iter_list(ftp, "LIST " + path if path else "LIST")
+
+    for entry in entries:
+        if name_glob is None or entry.type == "dir" or fnmatch.fnmatchcase(entry.name, name_glob):
+            if name_glob is not None and entry.type == "file" and session.supports_list_glob is None:
+                # the LIST with the glob did not find this file
+                print(f"FTP server {session.ftp_address} does not filter listings by globs.")
+                session.supports_list_glob = False
+            yield entry
+
+
+def iter_entries(ftp_folder: str = '/',
+                 ftp_address: str = None,
+                 ftp_user: str = None,
+                 ftp_passwd: str = None,
+                 session: "FtpSession" = None,
+                 name_glob: str = None,
+                 recursive: bool = False,
+                 max_depth: int = None):
+    """Yields the entries (files and folders) in `ftp_folder` with name, type, size and modification time as the
+    listing arrives, so that huge folders are never held in memory as a whole. Uses MLSD and falls back to parsing
+    LIST output on servers that do not support MLSD.
+    - name_glob: only yield files whose names match this glob (eg. "*.csv"), prefiltered by the server if it supports
+      it (see `_iter_folder`). Not sent to the server when walking `recursive`ly, as it would hide the subfolders.
+    - recursive: also yield the entries of the subfolders (after those of their folder), down to `max_depth` levels
+      below `ftp_folder` (None = no limit). Their names are paths relative to `ftp_folder` (eg. "2024/01/file.csv").
+    The connection cannot be used for anything else until the listing is consumed.
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    :rtype: generator of FtpEntry
+    """
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+        print(f'Listing files with metadata on {ftp_session.ftp_address} in folder {ftp_folder}'
+              f'{" (recursively)" if recursive else ""}')
+        with metrics.phase("ftp_list"):
+            folders = [(None, 0)]  # (path relative to ftp_folder, depth) of the folders left to list
+            while folders:
+                path, depth = folders.pop()
+                walk_deeper = recursive and (max_depth is None or depth < max_depth)
+                subfolders = []  # listed after this folder, as the connection is busy until then
+                for entry in _iter_folder(ftp_session.connection(ftp_folder), ftp_session, path=path,
+                                          name_glob=None if recursive else name_glob):
+                    if path is not None:
+                        entry = entry._replace(name=posixpath.join(path, entry.name))
+                    if entry.type == "dir" and walk_deeper:
+                        subfolders.append((entry.name, depth + 1))
+                    if name_glob is None or entry.type != "file" or \
+                            fnmatch.fnmatchcase(posixpath.basename(entry.name), name_glob):
+                        yield entry
+                folders += reversed(subfolders)
+
+
+def list_entries(ftp_folder: str = '/',
+                 ftp_address: str = None,
+                 ftp_user: str = None,
+                 ftp_passwd: str = None,
+                 session: "FtpSession" = None) -> list:
+    """Returns all entries (files and folders) in `ftp_folder` with name, type, size and modification time from a
+    single listing round trip (see `iter_entries`).
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    :rtype: list of FtpEntry
+    """
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+        return ftp_session.call(lambda ftp: list(iter_entries(ftp_folder=ftp_folder, session=ftp_session)))
+
+
+def get_entry(file_name: str,
+              ftp_address: str = None,
+              ftp_user: str = None,
+              ftp_passwd: str = None,
+              ftp_folder: str = '/',
+              session: "FtpSession" = None) -> FtpEntry or None:
+    """Returns the metadata of a single file via MLST, or via SIZE and MDTM on servers that do not support MLST.
+    :return: the entry or None if the file is not present
+    """
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+
+        def get(ftp: FTP) -> FtpEntry or None:
+            if ftp_session.supports_mlsd is not False:
+                try:
+                    # reply: "250-Listing file\r\n type=file;size=123;modify=20240115103000; file.csv\r\n250 End"
+                    fact_line = ftp.sendcmd(f"MLST {file_name}").splitlines()[1].strip()
+                    facts_str, _, name = fact_line.partition(" ")
+                    facts = dict(fact.split("=", 1) for fact in facts_str.rstrip(";").split(";") if "=" in fact)
+                    return mlsd_entry(name.rsplit("/", 1)[-1], {k.lower(): v for k, v in facts.items()})
+                except ftplib.error_perm as e:
+                    if not str(e).startswith("50"):  # eg. 550 = file not found
+                        return None
+                    # 500/501/502 = MLST not understood/implemented
+                    ftp_session.supports_mlsd = False
+            try:
+                ftp.voidcmd("TYPE I")  # SIZE is not allowed in ASCII mode by some servers
+                size = ftp.size(file_name)
+                modified = parse_mlsd_time(ftp.voidcmd(f"MDTM {file_name}")[4:].strip())
+            except ftplib.error_perm:
+                return None
+            return FtpEntry(name=file_name, type="file", size=size, modified=modified, source="MDTM")
+
+        with metrics.phase("ftp_stat", file=file_name):
+            return ftp_session.call(get, ftp_folder=ftp_folder)
+
+
 def upload_to_ftp(buffer: StringIO or BytesIO,
                   file_name: str,
-                  ftp_address: str,
-                  ftp_user: str,
-                  ftp_passwd: str,
+                  ftp_address: str = None,
+                  ftp_user: str = None,
+                  ftp_passwd: str = None,
                   ftp_folder: str = "/",
                   file_encoding: str = 'utf-8',
                   retries: int = 3,
-                  retry_delay: int = 5, timeout: bool = None) -> str:
+                  retry_delay: int = 5, timeout: bool = None,
+                  session: FtpSession = None) -> str:
     """Sends supplied `buffer` to an FTP server as a file with the specified name.
-    :returns: URL to the uploaded file    
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    :returns: URL to the uploaded file
     """
     currRetry = 0
-    while currRetry < retries:
-        try:
-            print(f'Sending {file_name} file to the FTP server.')
-            text = buffer.getvalue()
-            bio = BytesIO(str.encode(text, file_encoding))
-            ftp = FTP(ftp_address, timeout=timeout)
-            ftp.login(user=ftp_user, passwd=ftp_passwd)
-            expected_folder = to_expected_folder(ftp_folder)
-            if ftp.pwd() != expected_folder:
-                ftp.cwd(ftp_folder)
-            ftp.storbinary('STOR ' + file_name, bio)
-            ftp.quit()
-            result = 'http://{}/{}'.format(ftp_address, file_name)
-            print(f'File {file_name} is uploaded to the FTP server and is accessible at {result}.')
-            return result
-        except Exception as e:
-            if "ftp" in locals():  # disconnect and reconnect
-                ftp.quit()
-            time.sleep(retry_delay)
-            currRetry += 1
-            print(f"Error uploading file to FTP: {e}. Trying again (attempt {currRetry} of {retries})")
+    if isinstance(buffer, BytesIO):
+        bio = buffer  # already bytes, send the buffer itself instead of a copy
+    else:
+        bio = BytesIO(buffer.getvalue().encode(file_encoding))
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd, timeout) as ftp_session:
+        while currRetry < retries:
+            try:
+                print(f'Sending {file_name} file to the FTP server.')
+                bio.seek(0)
+                with metrics.phase("ftp_upload", file=file_name) as upload:
+                    upload.bytes = bio.getbuffer().nbytes
+                    ftp_session.call(lambda ftp: ftp.storbinary('STOR ' + file_name, bio), ftp_folder=ftp_folder,
+                                     retry=False)
+                result = 'http://{}/{}'.format(ftp_session.ftp_address, file_name)
+                print(f'File {file_name} is uploaded to the FTP server and is accessible at {result}.')
+                return result
+            except Exception as e:
+                ftp_session.close()  # disconnect, the next attempt reconnects
+                time.sleep(retry_delay)
+                currRetry += 1
+                print(f"Error uploading file to FTP: {e}. Trying again (attempt {currRetry} of {retries})")
 
     raise Exception(f"Could not upload {file_name} to FTP!")
 
 
+def upload_stream_to_ftp(reader,
+                         file_name: str,
+                         ftp_address: str = None,
+                         ftp_user: str = None,
+                         ftp_passwd: str = None,
+                         ftp_folder: str = "/",
+                         timeout: int = None,
+                         blocksize: int = STREAM_BLOCKSIZE,
+                         session: FtpSession = None,
+                         temp_file_name: str = None) -> int:
+    """Streams `reader` (any object with a `read(size)` method, eg. a `gcs.StreamingReader`) block by block to an FTP
+    server as a file with the specified name, without holding the whole file in memory.
+    With a `temp_file_name`, the data is uploaded to that file first and only renamed to `file_name` once it is
+    complete, so that nobody on the FTP picks up a half-written file.
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    Not retried: the data that was read cannot be read again.
+    :return: number of bytes uploaded
+    """
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd, timeout) as ftp_session:
+        upload_name = temp_file_name or file_name
+        print(f'Streaming {file_name} to the FTP server {ftp_session.ftp_address} in folder {ftp_folder} '
+              f'as {upload_name}.')
+        transferred = 0
+
+        def count_block(block: bytes):
+            nonlocal transferred
+            transferred += len(block)
+
+        with metrics.phase("ftp_upload", file=file_name) as upload:
+            try:
+                ftp_session.call(lambda ftp: ftp.storbinary('STOR ' + upload_name, reader, blocksize=blocksize,
+                                                            callback=count_block),
+                                 ftp_folder=ftp_folder, retry=False)
+            finally:
+                upload.bytes = transferred
+        if temp_file_name is not None:
+            rename_file(temp_file_name, file_name, ftp_folder=ftp_folder, session=ftp_session)
+    print(f'File {file_name} ({transferred} bytes) was streamed to the FTP server.')
+    return transferred
+
+
+def rename_file(from_file_name: str,
+                to_file_name: str,
+                ftp_address: str = None,
+                ftp_user: str = None,
+                ftp_passwd: str = None,
+                ftp_folder: str = '/',
+                session: FtpSession = None):
+    """Renames a file on an FTP server, replacing `to_file_name` if it exists (some servers refuse to rename onto an
+    existing file, then it is deleted first).
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    """
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+        with metrics.phase("ftp_rename", file=to_file_name):
+            try:
+                ftp_session.call(lambda ftp: ftp.rename(from_file_name, to_file_name), ftp_folder=ftp_folder)
+            except ftplib.error_perm as e:
+                print(f"Could not rename {from_file_name} to {to_file_name} ({e}). Replacing {to_file_name}.")
+                ftp_session.call(lambda ftp: ftp.delete(to_file_name), ftp_folder=ftp_folder)
+                ftp_session.call(lambda ftp: ftp.rename(from_file_name, to_file_name), ftp_folder=ftp_folder)
+
+
+def fin_file_name(file_name: str) -> str:
+    """Returns the name of the .fin file that marks `file_name` as complete (Adobe Analytics convention:
+    "classifications.tab" -> "classifications.fin")."""
+    return file_name.split(".")[0] + ".fin"
+
+
 def download_from_ftp(file_name: str,
-                      ftp_address: str,
-                      ftp_user: str,
-                      ftp_passwd: str,
-                      ftp_folder: str,
-                      timeout: int = None) -> BytesIO or None:
+                      ftp_address: str = None,
+                      ftp_user: str = None,
+                      ftp_passwd: str = None,
+                      ftp_folder: str = '/',
+                      timeout: int = None,
+                      session: FtpSession = None,
+                      check_exists: bool = True) -> BytesIO or None:
     """Downloads the file denoted by the `file_name` from the FTP server and returns its content as BytesIO buffer.
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
     :return: binary content of the file or None if the file is not present
     """
-    print(f'Getting {file_name} from the FTP server {ftp_address} in folder {ftp_folder}.')
-    ftp = FTP(ftp_address, timeout=timeout)
-    ftp.login(user=ftp_user, passwd=ftp_passwd)
-    print('Connection with ftp was established')
-    expected_folder = to_expected_folder(ftp_folder)
-    if ftp.pwd() != expected_folder:
-        ftp.cwd(ftp_folder)
-    if file_name not in ftp.nlst():
-        print("file not found! stopping execution!")
-        return None
-    print(f'file {file_name} exists. Starting download.')
     result = BytesIO()
-    ftp.retrbinary('RETR ' + file_name, result.write)
-    ftp.quit()
+    transferred = download_to_stream(file_name=file_name, writer=result, ftp_address=ftp_address, ftp_user=ftp_user,
+                                     ftp_passwd=ftp_passwd, ftp_folder=ftp_folder, timeout=timeout, session=session,
+                                     check_exists=check_exists)
+    if transferred is None:
+        return None
     print(f'File {file_name} is downloaded from the FTP server into an in-memory buffer.')
     return result
 
 
+def download_to_stream(file_name: str,
+                       writer,
+                       ftp_address: str = None,
+                       ftp_user: str = None,
+                       ftp_passwd: str = None,
+                       ftp_folder: str = '/',
+                       timeout: int = None,
+                       blocksize: int = STREAM_BLOCKSIZE,
+                       session: FtpSession = None,
+                       check_exists: bool = True,
+                       offset: int = 0) -> int or None:
+    """Streams the file denoted by the `file_name` from the FTP server into `writer` (any object with a `write` method,
+    eg. a `gcs.ResumableUploadStream`) block by block, without holding the whole file in memory.
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    Set `check_exists` to False to skip the existence check if the file is known to exist (eg. from a listing).
+    With an `offset`, the download continues at that byte (via REST) instead of starting at the beginning.
+    :return: number of bytes transferred (from `offset` on) or None if the file is not present
+    """
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd, timeout) as ftp_session:
+        print(f'Getting {file_name} from the FTP server {ftp_session.ftp_address} in folder {ftp_folder}.')
+        if check_exists and file_name not in ftp_session.call(lambda ftp: ftp.nlst(), ftp_folder=ftp_folder):
+            print("file not found! stopping execution!")
+            return None
+        print(f'file {file_name} exists. Starting download.')
+        transferred = 0
+
+        def write_block(block: bytes):
+            nonlocal transferred
+            writer.write(block)
+            transferred += len(block)
+
+        # no retry: blocks that were already written cannot be taken back
+        if offset:
+            print(f'Continuing download of {file_name} at byte {offset}.')
+        with metrics.phase("ftp_download", file=file_name) as download:
+            try:
+                ftp_session.call(lambda ftp: ftp.retrbinary('RETR ' + file_name, write_block, blocksize=blocksize,
+                                                            rest=offset or None),
+                                 ftp_folder=ftp_folder, retry=False)
+            finally:
+                download.bytes = transferred
+    print(f'File {file_name} ({transferred} bytes) was streamed from the FTP server.')
+    return transferred
+
+
+def supports_rest(session: FtpSession, ftp_folder: str = None) -> bool:
+    """Returns True if the server of `session` supports REST (downloads that start in the middle of a file)."""
+    if session.supports_rest is None:
+        try:
+            # "350 Restarting at 0" - the position is set again by the REST of the next download. Some servers only
+            # accept REST in binary mode.
+            session.call(lambda ftp: (ftp.voidcmd("TYPE I"), ftp.sendcmd("REST 0")), ftp_folder=ftp_folder)
+            session.supports_rest = True
+        except ftplib.error_perm as e:
+            print(f"FTP server {session.ftp_address} does not support REST: {e}")
+            session.supports_rest = False
+    return session.supports_rest
+
+
+def _download_range(ftp: FTP, file_name: str, start: int, length: int or None, blocksize: int) -> bytes:
+    """Downloads `length` bytes (None = up to the end) of `file_name` from byte `start` on."""
+    blocks = []
+    received = 0
+    ftp.voidcmd("TYPE I")
+    with ftp.transfercmd("RETR " + file_name, rest=start) as conn:
+        while length is None or received < length:
+            block = conn.recv(blocksize if length is None else min(blocksize, length - received))
+            if not block:
+                break
+            blocks.append(block)
+            received += len(block)
+    try:
+        ftp.voidresp()
+    except (ftplib.error_temp, ftplib.error_perm):
+        if length is None or received < length:
+            raise
+        # we closed the data connection before the end of the file, which aborts the transfer (426 or 451)
+    return b"".join(blocks)
+
+
+def download_segmented(file_name: str,
+                       writer,
+                       size: int,
+                       session: FtpSession,
+                       pool: FtpSessionPool = None,
+                       ftp_folder: str = '/',
+                       max_connections: int = 4,
+                       segment_size: int = SEGMENT_SIZE,
+                       blocksize: int = STREAM_BLOCKSIZE,
+                       offset: int = 0) -> int:
+    """Streams the file denoted by `file_name` (of `size` bytes, from the listing) into `writer` like
+    `download_to_stream`, but downloads byte ranges of `segment_size` over up to `max_connections` connections at the
+    same time (each via REST), for servers that throttle each connection.
+
+    `session` downloads segments itself; the other connections are taken from `pool` if it has idle capacity (so
+    the pool's `max_connections_per_host` caps the connections to the server). The segments are written to `writer`
+    in order from the calling thread, so any writer works; at most `max_connections + 1` segments are held in memory.
+    A segment whose connection breaks is downloaded again on a new connection. If the server does not support REST,
+    the file is downloaded as a single stream.
+    :return: number of bytes transferred (from `offset` on)
+    """
+    if not supports_rest(session, ftp_folder=ftp_folder):
+        print(f"Downloading {file_name} as a single stream.")
+        return download_to_stream(file_name=file_name, writer=writer, ftp_folder=ftp_folder, blocksize=blocksize,
+                                  session=session, check_exists=False, offset=offset)
+    # the last segment is read to the end of the file, so that a file that grew does not go unnoticed
+    segments = [(start, segment_size if start + segment_size < size else None)
+                for start in range(offset, max(size, offset + 1), segment_size)]
+    connections = max(1, min(max_connections, len(segments)))
+    print(f"Downloading {file_name} in {len(segments)} segments over up to {connections} connections.")
+    results = [Future() for _ in segments]
+    next_segments = iter(range(len(segments)))
+    lock = threading.Lock()
+    free_slots = threading.Semaphore(connections + 1)  # segments that are being downloaded or wait to be written
+    stop = threading.Event()
+
+    def download_segments(worker_session: FtpSession):
+        while True:
+            free_slots.acquire()
+            with lock:
+                index = None if stop.is_set() else next(next_segments, None)
+            if index is None:
+                return
+            start, length = segments[index]
+            try:
+                with metrics.phase("ftp_segment", file=file_name, log=False) as segment:
+                    # retry: the segment is only written when it is complete, so it can be downloaded again
+                    data = worker_session.call(lambda ftp: _download_range(ftp, file_name, start, length, blocksize),
+                                               ftp_folder=ftp_folder)
+                    segment.bytes = len(data)
+            except BaseException as e:
+                worker_session.close()  # the control connection may be out of sync after a broken transfer
+                stop.set()
+                results[index].set_exception(e)
+                return
+            results[index].set_result(data)
+
+    def download_segments_on_extra_connection():
+        with pool.session(session.ftp_address, session.ftp_user, session.ftp_passwd, wait=False) as extra_session:
+            if extra_session is not None:
+                download_segments(extra_session)
+
+    transferred = 0
+    with metrics.phase("ftp_download", file=file_name) as download, \
+            ThreadPoolExecutor(max_workers=connections, thread_name_prefix="ftp-segment") as executor:
+        # copy_context: count the segments in the metrics of the current run and file
+        workers = [executor.submit(contextvars.copy_context().run, download_segments, session)]
+        if pool is not None:
+            workers += [executor.submit(contextvars.copy_context().run, download_segments_on_extra_connection)
+                        for _ in range(connections - 1)]
+        try:
+            for (start, length), result in zip(segments, results):
+                data = result.result()
+                writer.write(data)
+                transferred += len(data)
+                free_slots.release()
+                if length is not None and len(data) < length:
+                    break  # the file is shorter than in the listing, the caller has to check the size
+        finally:
+            stop.set()
+            for _ in workers:
+                free_slots.release()  # wake up workers that wait for a free slot
+            download.bytes = transferred
+    print(f'File {file_name} ({transferred} bytes) was downloaded from the FTP server in segments.')
+    return transferred
+
+
 def delete_file(file_name: str,
-                ftp_address: str,
-                ftp_user: str,
-                ftp_passwd: str,
-                ftp_folder: str = '/') -> bool or None:
+                ftp_address: str = None,
+                ftp_user: str = None,
+                ftp_passwd: str = None,
+                ftp_folder: str = '/',
+                session: FtpSession = None,
+                check_exists: bool = True) -> bool or None:
     """Deletes a file denoted by `file_name` from an FTP server if it exists. Otherwise returns None
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    Set `check_exists` to False to skip the existence check if the file is known to exist (eg. from a listing).
     :rtype: Boolean or None
     """
-    print(f'Deleting file {file_name} from {ftp_address} in folder {ftp_folder}')
-    ftp = FTP(ftp_address)
-    ftp.login(ftp_user, ftp_passwd)
-    ftp.cwd(ftp_folder)
-    if file_name not in ftp.nlst():
-        print("file not found! stopping execution!")
-        return None
-    else:
-        ftp.delete(file_name)
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+        print(f'Deleting file {file_name} from {ftp_session.ftp_address} in folder {ftp_folder}')
+        if check_exists and file_name not in ftp_session.call(lambda ftp: ftp.nlst(), ftp_folder=ftp_folder):
+            print("file not found! stopping execution!")
+            return None
+        with metrics.phase("ftp_delete", file=file_name):
+            ftp_session.call(lambda ftp: ftp.delete(file_name), ftp_folder=ftp_folder)
         print("file deleted!")
-    print('Closing FTP connection')
-    ftp.close()
     return True
 
 
-def get_file_names(ftp_address, ftp_user, ftp_passwd, ftp_folder):
+def get_file_names(ftp_address=None, ftp_user=None, ftp_passwd=None, ftp_folder='/', session: FtpSession = None):
     """Returns a list of file names on an FTP
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
     :return: list of file names
     :rtype: list of str
     """
-    print(f'Getting file names on {ftp_address} in folder {ftp_folder}')
-    ftp = FTP(ftp_address)
-    ftp.login(ftp_user, ftp_passwd)
-    ftp.cwd(ftp_folder)
-    files = ftp.nlst()
-    return files
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+        print(f'Getting file names on {ftp_session.ftp_address} in folder {ftp_folder}')
+        return ftp_session.call(lambda ftp: ftp.nlst(), ftp_folder=ftp_folder)
 
 
 def list_files_on_ftp(file_name_re: str,
-                      ftp_address: str,
-                      ftp_user: str,
-                      ftp_passwd: str,
-                      ftp_folder='/') -> list:
+                      ftp_address: str = None,
+                      ftp_user: str = None,
+                      ftp_passwd: str = None,
+                      ftp_folder='/',
+                      session: FtpSession = None) -> list:
     """Returns a list of files that match a regular expression string in `file_name_re` in a defined ftp_folder
-    on an FTP server.
+    on an FTP server. Only the matching names are kept while the listing streams in (see `iter_entries`).
     """
     file_name_rs = re.compile(file_name_re)
-    files = get_file_names(ftp_address, ftp_user, ftp_passwd, ftp_folder)
-    output = [file for file in files if file_name_rs.match(file)]
-    return output
+    return [entry.name for entry in iter_entries(ftp_folder, ftp_address, ftp_user, ftp_passwd, session=session)
+            if entry.type == "file" and file_name_rs.match(entry.name)]
 
 
 def get_file_modification_date(file_name: str,
-                               ftp_address: str,
-                               ftp_user: str,
-                               ftp_passwd: str,
-                               ftp_folder: str = "/"):
-    """Gets the file modification date from an FTP server. The server must support the MDTM command. """
-    print(f'getting file modification date for {file_name} on the FTP server {ftp_address} in folder {ftp_folder}.')
-    ftp = FTP(ftp_address)
-    ftp.login(ftp_user, ftp_passwd)
-    ftp.cwd(ftp_folder)
-    timestamp = ftp.voidcmd(f"MDTM {file_name}")[4:].strip()
-    return parser.parse(timestamp)
+                               ftp_address: str = None,
+                               ftp_user: str = None,
+                               ftp_passwd: str = None,
+                               ftp_folder: str = "/",
+                               session: FtpSession = None) -> datetime:
+    """Gets the file modification date (timezone-aware, UTC) from an FTP server. The server must support the MDTM
+    command. Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    """
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+        print(f'getting file modification date for {file_name} on the FTP server {ftp_session.ftp_address} '
+              f'in folder {ftp_folder}.')
+        with metrics.phase("ftp_mdtm", file=file_name):
+            timestamp = ftp_session.call(lambda ftp: ftp.voidcmd(f"MDTM {file_name}"),
+                                         ftp_folder=ftp_folder)[4:].strip()
+    # MDTM returns UTC as per RFC 3659, optionally with fractions of a second
+    return parse_mlsd_time(timestamp)
+
+
+def get_file_size(file_name: str,
+                  ftp_address: str = None,
+                  ftp_user: str = None,
+                  ftp_passwd: str = None,
+                  ftp_folder: str = "/",
+                  session: FtpSession = None) -> int or None:
+    """Gets the size of a file in bytes from an FTP server (SIZE command).
+    Uses `session` if provided, otherwise opens (and closes) a connection with the supplied login.
+    :return: the size or None if the server does not support SIZE
+    """
+    def size(ftp: FTP) -> int:
+        ftp.voidcmd("TYPE I")  # some servers refuse SIZE in ASCII mode, as the size would depend on line endings
+        return ftp.size(file_name)
+
+    with session_or_one_off(session, ftp_address, ftp_user, ftp_passwd) as ftp_session:
+        try:
+            with metrics.phase("ftp_size", file=file_name, log=False):
+                return ftp_session.call(size, ftp_folder=ftp_folder)
+        except ftplib.error_perm as e:
+            print(f"Could not get size of {file_name} from FTP server {ftp_session.ftp_address}: {e}")
+            return None
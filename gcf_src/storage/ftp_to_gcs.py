@@ -1,9 +1,32 @@
-from datetime import datetime, timezone, timedelta
-from io import StringIO
+import asyncio
+import contextvars
+import ftplib
+import heapq
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from io import StringIO, BytesIO
 
 from gcf_src.config import cfg
+from gcf_src.monitoring import metrics
+from gcf_src.storage import aio
 from gcf_src.storage import ftp
 from gcf_src.storage import gcs
+from gcf_src.storage.compression import CompressingWriter, compress, get_compression
+from gcf_src.storage.transcoding import Transcoding, TranscodingError, TranscodingWriter, get_transcoding, transcode
+from gcf_src.storage import manifest
+from gcf_src.storage import readiness
+from gcf_src.storage import scheduling
+
+# folder in the target bucket for the checkpoints of interrupted streaming transfers
+CHECKPOINT_FOLDER = "_ftp_to_gcs_checkpoints/"
+# files of at least this size (or of unknown size) can be resumed by the next attempt if their transfer is interrupted
+RESUMABLE_MIN_SIZE = 64 * 1024 * 1024
+# how often an interrupted FTP download is continued (via REST) within the same attempt
+FTP_RESUME_ATTEMPTS = 2
+# files without modification date are imported last
+UNKNOWN_MODIFIED = datetime.max.replace(tzinfo=timezone.utc)
 
 
 def return_result(result: str = "done", result_detail: object = None, workflow_instructions: dict = None) -> dict:
@@ -28,6 +51,439 @@ def return_result(result: str = "done", result_detail: object = None, workflow_i
             "workflow_instructions": workflow_instructions_to_send}
 
 
+def to_gcs_location(gcs_folder: str, gcs_file_name: str) -> str:
+    """Joins a GCS folder and file name to a GCS location (= blob name)."""
+    if gcs_folder[-1] != "/":
+        # append "/" to folder name if it is not there yet to make concatenation of folder to file name easier
+        gcs_folder += "/"
+    return gcs_folder + gcs_file_name
+
+
+def listing_key(entry: ftp.FtpEntry) -> tuple:
+    """Returns the key files are imported in the order of: oldest first (files without modification date last, ties by
+    name)."""
+    return entry.modified or UNKNOWN_MODIFIED, entry.name
+
+
+def to_cursor(entry: ftp.FtpEntry) -> dict:
+    """Returns the position of `entry` in the import order as JSON (for the continuation, see `from_cursor`)."""
+    return {"modified": entry.modified.isoformat() if entry.modified is not None else None, "name": entry.name}
+
+
+def from_cursor(cursor: dict) -> tuple:
+    """Returns the `listing_key` of the position `cursor` (see `to_cursor`)."""
+    modified = datetime.fromisoformat(cursor["modified"]) if cursor.get("modified") else UNKNOWN_MODIFIED
+    return modified, cursor["name"]
+
+
+def select_files(entries, file_name_re: str = None, max_files: int = None, after: tuple = None) -> list:
+    """Returns the files among the FTP listing `entries` (a list or a generator, see `ftp.iter_entries`) whose names
+    match `file_name_re` (None = all), oldest first (see `listing_key`). With `max_files`, only the oldest `max_files`
+    files are returned; they are kept in a heap while the listing streams in instead of sorting all files. With `after`
+    (a `listing_key`), only files that come after it are returned.
+    """
+    file_name_rs = re.compile(file_name_re) if file_name_re is not None else None
+    files = (entry for entry in entries if entry.type == "file"
+             and (file_name_rs is None or file_name_rs.match(entry.name))
+             and (after is None or listing_key(entry) > after))
+    if max_files is not None:
+        return heapq.nsmallest(max_files, files, key=listing_key)
+    return sorted(files, key=listing_key)
+
+
+class FtpTransferError(Exception):
+    """A file could not be read from the FTP. This happens quite often, so it leads to a retry instead of an error."""
+
+
+def check_size(entry: ftp.FtpEntry, size: int):
+    """Checks that `size` bytes are the complete FTP file `entry` (if the listing contains its size).
+    :raises FtpTransferError: if the sizes differ, eg. because the download was truncated
+    """
+    if entry.size is not None and size != entry.size:
+        raise FtpTransferError(f"Got {size} bytes of file {entry.name}, but its size on the FTP is {entry.size} bytes.")
+
+
+def checkpoint_location(gcs_location: str) -> str:
+    """Returns the location of the checkpoint of a streaming transfer to `gcs_location`."""
+    return CHECKPOINT_FOLDER + gcs_location + ".json"
+
+
+def source_fingerprint(entry: ftp.FtpEntry) -> dict:
+    """Identifies a version of a file on the FTP, so that a transfer is only resumed if the file has not changed."""
+    return {"file": entry.name, "size": entry.size,
+            "modified": entry.modified.isoformat() if entry.modified is not None else None}
+
+
+def open_upload(entry: ftp.FtpEntry, gcs_bucket: str, gcs_location: str, resumable: bool = True,
+                content_type: str = None, content_encoding: str = None,
+                composite_upload_threshold: int = gcs.COMPOSITE_UPLOAD_THRESHOLD) -> gcs.ResumableUploadStream:
+    """Returns the GCS upload stream for the FTP file `entry`. If `resumable`, continues the upload session of an
+    earlier, interrupted attempt if there is a checkpoint for the unchanged file. Otherwise opens a new upload session
+    and (if `resumable`) saves its checkpoint, so that the next attempt can continue it.
+    Files of at least `composite_upload_threshold` bytes (None = never) are uploaded as `gcs.ParallelCompositeUpload`
+    instead, which is never resumable."""
+    if gcs.use_composite_upload(entry.size, composite_upload_threshold):
+        print(f"Uploading {entry.name} ({entry.size} bytes) as parallel composite upload")
+        return gcs.ParallelCompositeUpload(dest_file_name=gcs_location, bucket_name=gcs_bucket,
+                                           content_type=content_type, content_encoding=content_encoding)
+    if resumable:
+        checkpoint = gcs.read_json(checkpoint_location(gcs_location), bucket_name=gcs_bucket)
+        if checkpoint is not None and checkpoint.get("source") == source_fingerprint(entry):
+            try:
+                return gcs.ResumableUploadStream.resume(checkpoint["session_url"], gcs_location,
+                                                        bucket_name=gcs_bucket)
+            except Exception as e:
+                print(f"Could not resume upload of {gcs_location}, starting over: {e}")
+    upload = gcs.ResumableUploadStream(dest_file_name=gcs_location, bucket_name=gcs_bucket, content_type=content_type,
+                                       content_encoding=content_encoding)
+    if resumable:
+        gcs.write_json(checkpoint_location(gcs_location),
+                       {"source": source_fingerprint(entry), "session_url": upload.open()}, bucket_name=gcs_bucket)
+    return upload
+
+
+def compressed_file_name(file_name: str, compression: str = None) -> str:
+    """Returns the name of `file_name` after `compression` (eg. "export.csv" -> "export.csv.gz")."""
+    if compression is None:
+        return file_name
+    suffix = get_compression(compression)["suffix"]
+    return file_name if file_name.endswith(suffix) else file_name + suffix
+
+
+def compressed_content_type(gcs_location: str, compression: str) -> tuple:
+    """Returns the content type and Content-Encoding of the file `gcs_location` compressed with `compression`."""
+    settings = get_compression(compression)
+    uncompressed_location = gcs_location[:-len(settings["suffix"])]
+    content_type = settings["content_type"] or gcs.infer_content_type(uncompressed_location)
+    return content_type, settings["content_encoding"]
+
+
+def upload_content_type(gcs_location: str, compression: str = None, transcoding: Transcoding = None) -> tuple:
+    """Returns the content type and Content-Encoding of the upload to `gcs_location` (None, None = inferred by GCS)."""
+    content_type, content_encoding = None, None
+    if compression is not None:
+        content_type, content_encoding = compressed_content_type(gcs_location, compression)
+    if transcoding is not None:
+        content_type = content_type or gcs.infer_content_type(gcs_location)
+        if content_type.startswith("text/"):
+            content_type += f"; charset={transcoding.target_encoding}"
+    return content_type, content_encoding
+
+
+def download_entry(entry: ftp.FtpEntry, writer, ftp_session: ftp.FtpSession, source_folder: str, offset: int = 0,
+                   ftp_pool: ftp.FtpSessionPool = None, connections_per_file: int = 1) -> int:
+    """Streams the FTP file `entry` into `writer` from byte `offset` on. Files of at least
+    `ftp.SEGMENTED_DOWNLOAD_MIN_SIZE` are downloaded in segments over up to `connections_per_file` connections (the
+    extra ones from `ftp_pool`, see `ftp.download_segmented`).
+    :return: number of bytes transferred (from `offset` on)
+    """
+    if connections_per_file > 1 and entry.size is not None and \
+            entry.size - offset >= ftp.SEGMENTED_DOWNLOAD_MIN_SIZE:
+        return ftp.download_segmented(entry.name, writer=writer, size=entry.size, session=ftp_session, pool=ftp_pool,
+                                      ftp_folder=source_folder, max_connections=connections_per_file, offset=offset)
+    return ftp.download_to_stream(file_name=entry.name, writer=writer, ftp_folder=source_folder, session=ftp_session,
+                                  check_exists=False, offset=offset)
+
+
+def open_stream_writer(entry: ftp.FtpEntry, gcs_bucket: str, gcs_location: str, resumable: bool = True,
+                       compression: str = None, compression_level: int = None, transcoding: Transcoding = None,
+                       composite_upload_threshold: int = gcs.COMPOSITE_UPLOAD_THRESHOLD) -> tuple:
+    """Opens the upload of the FTP file `entry` to `gcs_location` (see `open_upload`) with a `TranscodingWriter` (if
+    `transcoding`) and a `CompressingWriter` (if `compression`) in front of it. Compressed or transcoded uploads are
+    never `resumable`.
+    :return: (upload, writer): the data has to be written to the writer, the result of the upload is in `upload.result`
+    """
+    if compression is None and transcoding is None:
+        upload = open_upload(entry, gcs_bucket=gcs_bucket, gcs_location=gcs_location, resumable=resumable,
+                             composite_upload_threshold=composite_upload_threshold)
+        return upload, upload
+    content_type, content_encoding = upload_content_type(gcs_location, compression=compression,
+                                                         transcoding=transcoding)
+    upload = open_upload(entry, gcs_bucket=gcs_bucket, gcs_location=gcs_location, resumable=False,
+                         content_type=content_type, content_encoding=content_encoding,
+                         composite_upload_threshold=composite_upload_threshold)
+    writer = upload
+    if compression is not None:
+        writer = CompressingWriter(writer, compression=compression, level=compression_level)
+    if transcoding is not None:
+        writer = TranscodingWriter(writer, transcoding)
+    return upload, writer
+
+
+def stream_file(entry: ftp.FtpEntry, ftp_session: ftp.FtpSession, source_folder: str, gcs_bucket: str,
+                gcs_location: str, resumable: bool = True, compression: str = None,
+                compression_level: int = None, transcoding: Transcoding = None,
+                composite_upload_threshold: int = gcs.COMPOSITE_UPLOAD_THRESHOLD, ftp_pool: ftp.FtpSessionPool = None,
+                connections_per_file: int = 1) -> tuple:
+    """Streams the FTP file `entry` into a GCS resumable upload to `gcs_location`. A big file is downloaded over up to
+    `connections_per_file` connections (see `download_entry`).
+    An interrupted download is continued at the byte it stopped (FTP REST) up to `FTP_RESUME_ATTEMPTS` times. If it
+    still fails and the transfer is `resumable`, the upload session is kept (see `open_upload`) for the next attempt.
+    The upload is only finalized if it has the size from the listing, and GCS validates it against the checksums that
+    are computed while streaming.
+    With a `compression`, the file is compressed on the way on a worker thread. With a `transcoding`, its text is
+    converted on the way (before compressing it). Such a transfer cannot be continued by the next attempt (the state
+    of the compressor or decoder would be lost), so `resumable` is ignored then. The same goes for files of at least
+    `composite_upload_threshold` bytes, which are uploaded in parallel parts (see `gcs.ParallelCompositeUpload`).
+    :return: (the GCS object resource of the uploaded file, the size of the file on the FTP)
+    :raises FtpTransferError: if the file could not be streamed
+    :raises TranscodingError: if the file could not be converted (the upload is aborted)
+    :raises Exception: if GCS could not finalize the upload of the complete file (eg. compose the parts)
+    """
+    if compression is not None or transcoding is not None or \
+            gcs.use_composite_upload(entry.size, composite_upload_threshold):
+        resumable = False
+
+    def open_writer(resumable: bool) -> tuple:
+        return open_stream_writer(entry, gcs_bucket=gcs_bucket, gcs_location=gcs_location, resumable=resumable,
+                                  compression=compression, compression_level=compression_level,
+                                  transcoding=transcoding, composite_upload_threshold=composite_upload_threshold)
+
+    upload, writer = open_writer(resumable)
+    resume_attempts = 0
+    while upload.result is None:  # the upload can already be finalized if an earlier attempt stopped right after it
+        offset = writer.bytes_written
+        try:
+            download_entry(entry, writer=writer, ftp_session=ftp_session, source_folder=source_folder, offset=offset,
+                           ftp_pool=ftp_pool, connections_per_file=connections_per_file)
+            # a broken data connection can look like the end of the file, so do not finalize a truncated upload
+            check_size(entry, writer.bytes_written)
+        except Exception as e:
+            ftp_session.close()  # the control connection may be out of sync after a broken transfer
+            if isinstance(e, TranscodingError):
+                writer.abort()
+                raise
+            if offset > 0 and isinstance(e, ftplib.error_perm) and writer.bytes_written == offset:
+                # the server does not support REST, so we have to start over
+                print(f"Could not continue download of {entry.name} at byte {offset} ({e}). Starting over.")
+                writer.abort()
+                upload, writer = open_writer(resumable=False)
+                continue
+            # an upload that failed (eg. a part of a parallel composite upload) cannot be written to anymore
+            if resume_attempts < FTP_RESUME_ATTEMPTS and writer.bytes_written > offset and not upload.failed:
+                resume_attempts += 1
+                print(f"Error while streaming file {entry.name} ({e}). Continuing at byte {writer.bytes_written} "
+                      f"(attempt {resume_attempts} of {FTP_RESUME_ATTEMPTS}).")
+                continue
+            if not resumable:
+                writer.abort()
+            raise FtpTransferError(f"Error while streaming file {entry.name} from FTP to GCS: {e}")
+        # the whole file was downloaded: errors of GCS when finalizing the upload are raised as they are
+        try:
+            writer.close()
+        except Exception:
+            if not resumable:
+                writer.abort()
+            raise
+    check_size(entry, writer.bytes_written)
+    if resumable:
+        gcs.delete_file_if_exists(checkpoint_location(gcs_location), bucket_name=gcs_bucket)
+    return upload.result, writer.bytes_written
+
+
+def transfer_file(entry: ftp.FtpEntry, ftp_session: ftp.FtpSession, source_folder: str, gcs_bucket: str,
+                  gcs_folders: list, gcs_file_name: str, streaming: bool = True, encoding: str = "utf-8",
+                  resumable: bool = True, compression: str = None, compression_level: int = None,
+                  transcoding: Transcoding = None,
+                  composite_upload_threshold: int = gcs.COMPOSITE_UPLOAD_THRESHOLD, ftp_pool: ftp.FtpSessionPool = None,
+                  connections_per_file: int = 1) -> dict:
+    """Transfers the file from the FTP listing `entry` to the file `gcs_file_name` in all `gcs_folders`.
+    If `resumable`, an interrupted streaming transfer of a big file is continued by the next attempt. Streamed files of
+    at least `composite_upload_threshold` bytes are uploaded as parallel composite uploads. Big files are downloaded
+    over up to `connections_per_file` connections (the extra ones from `ftp_pool`).
+    With a `compression` ("gzip" or "zstd"), the file is stored compressed (`gcs_file_name` should have the suffix
+    of the compression, see `compressed_file_name`). With a `transcoding`, its text is converted to another encoding.
+    :return: {"gcs_locations": the GCS locations of the file, "size": its size on the FTP in bytes,
+              "checksums": the base64-encoded CRC32C and MD5 of the stored file as validated and stored by GCS}
+    :raises FtpTransferError: if the file could not be read from the FTP or is incomplete
+    """
+    ftp_file_name = entry.name
+    print("Importing file from FTP to GCS: " + ftp_file_name)
+    file_gcs_locations = [to_gcs_location(gcs_folder, gcs_file_name) for gcs_folder in gcs_folders]
+
+    if streaming:
+        print(f"Streaming {ftp_file_name} from FTP to GCS bucket {gcs_bucket} and location {file_gcs_locations[0]}")
+        uploaded, size = stream_file(entry, ftp_session=ftp_session, source_folder=source_folder,
+                                     gcs_bucket=gcs_bucket, gcs_location=file_gcs_locations[0],
+                                     resumable=resumable and (entry.size is None or entry.size >= RESUMABLE_MIN_SIZE),
+                                     compression=compression, compression_level=compression_level,
+                                     transcoding=transcoding, composite_upload_threshold=composite_upload_threshold,
+                                     ftp_pool=ftp_pool, connections_per_file=connections_per_file)
+        checksums = {"crc32c": uploaded.get("crc32c"), "md5": uploaded.get("md5Hash")}
+        # no need to stream the file again for the other folders, copy it within GCS instead
+        gcs.fan_out(file_gcs_locations[0], file_gcs_locations[1:], bucket_name=gcs_bucket)
+    else:
+        try:
+            source_file = BytesIO()
+            download_entry(entry, writer=source_file, ftp_session=ftp_session, source_folder=source_folder,
+                           ftp_pool=ftp_pool, connections_per_file=connections_per_file)
+        except Exception as e:
+            raise FtpTransferError(f"Error while downloading file {ftp_file_name} from FTP: {e}")
+        size = source_file.getbuffer().nbytes
+        check_size(entry, size)
+
+        print(
+            f"Downloaded from FTP. Now transferring {ftp_file_name} to GCS bucket {gcs_bucket} and folder {gcs_folders}")
+
+        upload_kwargs = {}
+        if transcoding is not None:
+            source_file = BytesIO(transcode(source_file.getvalue(), transcoding))
+        if compression is not None:
+            source_file = BytesIO(compress(source_file.getvalue(), compression, level=compression_level))
+        if compression is not None or transcoding is not None:
+            upload_kwargs["content_type"], upload_kwargs["content_encoding"] = upload_content_type(
+                file_gcs_locations[0], compression=compression, transcoding=transcoding)
+        gcs.upload_file_to_locations(file_gcs_locations, data=source_file, bucket_name=gcs_bucket,
+                                     file_encoding=encoding, checksum="crc32c", **upload_kwargs)
+        checksums = gcs.get_checksums(file_gcs_locations[0], bucket_name=gcs_bucket)
+    print(f"Transferred file {ftp_file_name} to GCS bucket {gcs_bucket} and locations {file_gcs_locations}")
+    return {"gcs_locations": file_gcs_locations, "size": size, "checksums": checksums}
+
+
+async def stream_file_async(entry: ftp.FtpEntry, ftp_pool: ftp.FtpSessionPool, ftp_login: tuple, source_folder: str,
+                            gcs_bucket: str, gcs_location: str, resumable: bool = True, compression: str = None,
+                            compression_level: int = None, transcoding: Transcoding = None,
+                            composite_upload_threshold: int = gcs.COMPOSITE_UPLOAD_THRESHOLD,
+                            connections_per_file: int = 1) -> tuple:
+    """Same as `stream_file`, but for the asyncio engine: the FTP download and the GCS upload are connected by a
+    bounded queue (`aio.BlockQueue`) instead of uploading each block in the download callback. The download fills the
+    queue while earlier blocks are uploaded, and the FTP connection (from `ftp_pool`, logged in with `ftp_login` =
+    (address, user, passwd)) is given back as soon as the download is complete, so the next file can be downloaded
+    while the end of this one is still being uploaded.
+    :return: (the GCS object resource of the uploaded file, the size of the file on the FTP)
+    :raises FtpTransferError: if the file could not be streamed
+    :raises TranscodingError: if the file could not be converted (the upload is aborted)
+    """
+    if compression is not None or transcoding is not None or \
+            gcs.use_composite_upload(entry.size, composite_upload_threshold):
+        resumable = False
+
+    async def open_writer(resumable: bool) -> tuple:
+        upload, writer = await asyncio.to_thread(open_stream_writer, entry, gcs_bucket=gcs_bucket,
+                                                 gcs_location=gcs_location, resumable=resumable,
+                                                 compression=compression, compression_level=compression_level,
+                                                 transcoding=transcoding,
+                                                 composite_upload_threshold=composite_upload_threshold)
+        blocks = aio.BlockQueue(asyncio.get_running_loop())
+        return upload, writer, blocks, asyncio.create_task(blocks.drain(writer)), writer.bytes_written
+
+    def download(blocks: aio.BlockQueue, offset: int):
+        with ftp_pool.session(*ftp_login) as ftp_session:
+            try:
+                download_entry(entry, writer=blocks, ftp_session=ftp_session, source_folder=source_folder,
+                               offset=offset, ftp_pool=ftp_pool, connections_per_file=connections_per_file)
+            except Exception:
+                ftp_session.close()  # the control connection may be out of sync after a broken transfer
+                raise
+
+    async def stop(blocks: aio.BlockQueue, uploader: asyncio.Task, error: BaseException):
+        blocks.abort(error)
+        await blocks.end()
+        await asyncio.gather(uploader, return_exceptions=True)
+
+    # start_offset: bytes that were uploaded by an earlier attempt (see `open_upload`)
+    upload, writer, blocks, uploader, start_offset = await open_writer(resumable)
+    resume_attempts = 0
+    try:
+        while upload.result is None:  # the upload can already be finalized if an earlier attempt stopped right after it
+            offset = start_offset + blocks.bytes_written
+            try:
+                await asyncio.to_thread(download, blocks, offset)
+                # a broken data connection can look like the end of the file, so do not finalize a truncated upload
+                check_size(entry, start_offset + blocks.bytes_written)
+                break
+            except Exception as e:
+                received = start_offset + blocks.bytes_written
+                if isinstance(blocks.error, TranscodingError):
+                    raise blocks.error
+                if blocks.error is not None:  # the upload failed, no point in continuing the download
+                    raise FtpTransferError(f"Error while streaming file {entry.name} from FTP to GCS: {blocks.error}")
+                if offset > 0 and isinstance(e, ftplib.error_perm) and received == offset:
+                    # the server does not support REST, so we have to start over
+                    print(f"Could not continue download of {entry.name} at byte {offset} ({e}). Starting over.")
+                    await stop(blocks, uploader, e)
+                    await asyncio.to_thread(writer.abort)
+                    upload, writer, blocks, uploader, start_offset = await open_writer(resumable=False)
+                    continue
+                if resume_attempts < FTP_RESUME_ATTEMPTS and received > offset:
+                    resume_attempts += 1
+                    print(f"Error while streaming file {entry.name} ({e}). Continuing at byte {received} "
+                          f"(attempt {resume_attempts} of {FTP_RESUME_ATTEMPTS}).")
+                    continue
+                raise FtpTransferError(f"Error while streaming file {entry.name} from FTP to GCS: {e}")
+        await blocks.end()
+        await uploader
+    except BaseException as e:  # also if the transfer is cancelled
+        await stop(blocks, uploader, e)
+        if not resumable:
+            await asyncio.to_thread(writer.abort)
+        if isinstance(e, Exception) and not isinstance(e, (FtpTransferError, TranscodingError)):
+            raise FtpTransferError(f"Error while streaming file {entry.name} from FTP to GCS: {e}")
+        raise
+    # the whole file was downloaded: errors of GCS when finalizing the upload are raised as they are
+    try:
+        await asyncio.to_thread(writer.close)
+    except BaseException:
+        if not resumable:
+            await asyncio.to_thread(writer.abort)
+        raise
+    size = start_offset + blocks.bytes_written
+    check_size(entry, size)
+    if resumable:
+        await asyncio.to_thread(gcs.delete_file_if_exists, checkpoint_location(gcs_location), bucket_name=gcs_bucket)
+    return upload.result, size
+
+
+async def transfer_file_async(entry: ftp.FtpEntry, ftp_pool: ftp.FtpSessionPool, ftp_login: tuple,
+                              source_folder: str, gcs_bucket: str, gcs_folders: list, gcs_file_name: str,
+                              resumable: bool = True, compression: str = None, compression_level: int = None,
+                              transcoding: Transcoding = None,
+                              composite_upload_threshold: int = gcs.COMPOSITE_UPLOAD_THRESHOLD,
+                              connections_per_file: int = 1) -> dict:
+    """Same as `transfer_file` (in streaming mode), but for the asyncio engine (see `stream_file_async`)."""
+    print("Importing file from FTP to GCS: " + entry.name)
+    file_gcs_locations = [to_gcs_location(gcs_folder, gcs_file_name) for gcs_folder in gcs_folders]
+    print(f"Streaming {entry.name} from FTP to GCS bucket {gcs_bucket} and location {file_gcs_locations[0]}")
+    uploaded, size = await stream_file_async(
+        entry, ftp_pool=ftp_pool, ftp_login=ftp_login, source_folder=source_folder, gcs_bucket=gcs_bucket,
+        gcs_location=file_gcs_locations[0],
+        resumable=resumable and (entry.size is None or entry.size >= RESUMABLE_MIN_SIZE),
+        compression=compression, compression_level=compression_level, transcoding=transcoding,
+        composite_upload_threshold=composite_upload_threshold, connections_per_file=connections_per_file)
+    checksums = {"crc32c": uploaded.get("crc32c"), "md5": uploaded.get("md5Hash")}
+    await asyncio.to_thread(gcs.fan_out, file_gcs_locations[0], file_gcs_locations[1:], bucket_name=gcs_bucket)
+    print(f"Transferred file {entry.name} to GCS bucket {gcs_bucket} and locations {file_gcs_locations}")
+    return {"gcs_locations": file_gcs_locations, "size": size, "checksums": checksums}
+
+
+def commit_file(entry: ftp.FtpEntry, ftp_session: ftp.FtpSession, source_folder: str, transferred_size: int,
+                keep_file_on_ftp: bool = False, add_fin_file: bool = False, encoding: str = "utf-8"):
+    """Finishes the import of the FTP file `entry` that has been transferred to GCS: deletes it from the FTP (unless
+    `keep_file_on_ftp`) and adds the .fin file (if `add_fin_file`).
+    :raises FtpTransferError: if `transferred_size` differs from the size in the listing (nothing is deleted then)
+    """
+    ftp_file_name = entry.name
+    check_size(entry, transferred_size)
+    if keep_file_on_ftp is False:
+        print(f"Deleting file {ftp_file_name} from FTP")
+        ftp.delete_file(ftp_folder=source_folder, file_name=ftp_file_name, session=ftp_session, check_exists=False)
+        print(f"Deleted file {ftp_file_name} from FTP")
+
+    if add_fin_file is True:
+        print("Adding .fin file to FTP so Adobe Analytics can start importing it.")
+        finfile_buffer = StringIO()
+        finfile_name = ftp.fin_file_name(ftp_file_name)
+        ftp.upload_to_ftp(finfile_buffer, file_name=finfile_name, ftp_folder=source_folder, file_encoding=encoding,
+                          session=ftp_session)
+        print(f"Uploaded fin file {finfile_name} to FTP")
+
+
+def prewarm():
+    """Creates the clients this script needs (called by `script_runner.prewarm` when the instance starts)."""
+    gcs.get_storage_client()
+    cfg.secret_mgr_client()
+
+
 def run_script(**kwargs):
     """Imports a file from FTP to GCS.
     kwargs.payload contains:
@@ -41,8 +497,65 @@ def run_script(**kwargs):
     - workflow_callback_url: URL to call when the workflow is done - OPTIONAL
     - keep_file_on_ftp: if False, will delete the file from FTP after it has been imported to GCS - OPTIONAL, defaults to False
     - add_fin_file: if True, will add a .fin file to the FTP folder after the file has been imported to GCS (for Adobe Analytics imports) - OPTIONAL, defaults to False
+    - max_parallel_transfers: max. number of files transferred at the same time (= max. number of connections to the
+      FTP server, unless max_connections_per_host is higher). Deletes and .fin files are still done in oldest-first order - OPTIONAL, defaults to 1
+    - file_ready_after_seconds: seconds a file must not have changed (size and modification date) to be considered
+      completely uploaded to the FTP - OPTIONAL, defaults to 30
+    - ready_wait_seconds: max. seconds to wait for files that are still changing, polling them on the open connection,
+      before returning "file_not_ready_yet" (the workflow retries later) - OPTIONAL, defaults to 60
+    - connections_per_file: max. number of FTP connections a file of at least 64 MiB is downloaded over (in segments of
+      16 MiB, via REST), for servers that throttle each connection. Falls back to one connection if the server does not
+      support REST - OPTIONAL, defaults to 1
+    - max_connections_per_host: max. number of connections to the FTP server, including the extra connections of
+      segmented downloads - OPTIONAL, defaults to max_parallel_transfers * connections_per_file
+    - streaming: if True, streams the file from FTP into a GCS resumable upload in chunks, so memory use does not depend
+      on the file size. If False, the whole file is downloaded into memory first - OPTIONAL, defaults to True
+    - resumable: if True, an interrupted streaming transfer of a big file is continued by the next attempt instead of
+      starting over (a checkpoint with the upload session is kept in the bucket) - OPTIONAL, defaults to True
+    - incremental: if True, only imports files that are new or have changed (size or modification date) since they
+      were last imported to the same GCS locations. The imported files are recorded in a manifest in the GCS bucket.
+      Mostly useful with keep_file_on_ftp=True - OPTIONAL, defaults to False
+    - engine: "threads" or "asyncio". With "asyncio", downloads and uploads are connected by bounded queues on an
+      asyncio event loop, so the download of the next file overlaps with the upload of the previous one (needs
+      streaming=True) - OPTIONAL, defaults to "threads"
+    - compression: "gzip" or "zstd" to store the file compressed. The suffix of the compression (".gz" or ".zst") is
+      appended to the GCS file name. Compressed transfers are not resumable - OPTIONAL, defaults to None (no compression)
+    - compression_level: compression level (gzip: 1-9, zstd: 1-22) - OPTIONAL, defaults to 6 for gzip and 3 for zstd
+    - composite_upload_threshold: size in bytes from which streamed files are uploaded as parallel composite uploads
+      (parts uploaded over several connections and composed in GCS, see `gcs.ParallelCompositeUpload`). Composite
+      objects have a CRC32C but no MD5 checksum and their transfer is not resumable. False disables composite uploads -
+      OPTIONAL, defaults to gcs.COMPOSITE_UPLOAD_THRESHOLD (512 MiB)
+    - source_encoding: encoding of the text files on the FTP (eg. "cp1252"). If set, the files are converted to
+      target_encoding while they are transferred. Transcoded transfers are not resumable - OPTIONAL, defaults to None
+      (files are stored as they are)
+    - target_encoding: encoding of the files in GCS - OPTIONAL, defaults to "utf-8"
+    - strip_bom: if True, removes a byte order mark at the start of transcoded files - OPTIONAL, defaults to True
+    - newline: "\n" or "\r\n" to convert all line endings of transcoded files - OPTIONAL, defaults to None (kept)
+    - encoding_errors: what to do with characters that cannot be converted: "strict" (the import fails), "replace" or
+      "ignore" - OPTIONAL, defaults to "strict"
+    - manifest_location: location of the manifest for incremental imports in the GCS bucket - OPTIONAL, defaults to
+      "_ftp_to_gcs_manifests/{source_ftp}/{source_folder}/manifest.json"
+    - source_file_glob: glob for the names of the files to import (eg. "*.csv"), sent to the FTP server with the
+      listing so that servers that support it only list the matching files. Can be combined with source_file_name_re -
+      OPTIONAL
+    - recursive: if True, also imports the files in the subfolders of source_folder. Their names (and GCS file names)
+      are paths relative to source_folder (eg. "2024/01/file.csv"), also for source_file_name_re - OPTIONAL, defaults
+      to False
+    - max_depth: max. number of subfolder levels below source_folder to import from with recursive=True - OPTIONAL,
+      defaults to None (no limit)
+    - max_files: max. number of files a run imports (the oldest ones). If more files match, the run returns result
+      "continue" with a cursor after the last of them, and the workflow starts the next run for the next files -
+      OPTIONAL, defaults to None (all files)
+    - continuation: the "continuation" from the workflow_instructions of an earlier run that ran out of time or
+      reached max_files (result "continue"): {"files": names of the files that are left (if the run ran out of time),
+      "cursor": {"last_file": the last file imported, "files_done": number of files imported so far, "after": position
+      (modification date and name) of the last file of the page of max_files files, if there are more}, "throughput":
+      observed bytes/s}. Only these files (or else only the files after the cursor) are imported then. Set by the
+      workflow - OPTIONAL
+    - profile: "cpu", "memory" or True (both) to profile the run. The profile is added to the callback payload next to
+      the metrics of the run (see `script_runner.run_job`) - OPTIONAL, defaults to False
     - one of:
-        - source_file_name_re: regex, will do the import for multiple files
+        - source_file_name_re (and/or source_file_glob): regex, will do the import for multiple files
         - source_file_name: single file name, will do the import for a single file
     """
     print(f"Starting script to import file(s) from FTP to GCS with locals: {locals()}")
@@ -53,21 +566,75 @@ def run_script(**kwargs):
     source_ftp = payload.get("source_ftp")
     if source_ftp is None:
         raise Exception("source_ftp must be provided in payload.")
-    source_ftp_cfg = getattr(cfg, source_ftp)()  # eg. "aa_main_prod_export_ftp"
+    source_ftp_cfg = cfg.get_ftp_config(source_ftp)  # eg. "aa_main_prod_export_ftp"
     source_file_name_re = payload.get("source_file_name_re", None)  # regex, will do the import for multiple files
+    source_file_glob = payload.get("source_file_glob", None)  # glob, will do the import for multiple files
     source_file_name = payload.get("source_file_name", None)  # single file name, will do the import for a single file
-    if source_file_name_re is None and source_file_name is None:
-        raise Exception("Either source_file_name_re or source_file_name must be provided in payload.")
+    if source_file_name_re is None and source_file_glob is None and source_file_name is None:
+        raise Exception("Either source_file_name_re, source_file_glob or source_file_name must be provided in payload.")
+    recursive = payload.get("recursive") or False
+    max_depth = payload.get("max_depth")
+    if max_depth is not None:
+        max_depth = int(max_depth)
+    max_files = payload.get("max_files")
+    if max_files is not None:
+        max_files = int(max_files)
+        if max_files < 1:
+            raise Exception(f"max_files must be at least 1, got {max_files}.")
     source_folder = payload.get("source_folder") or source_ftp_cfg.folder
     encoding = payload.get("encoding") or "utf-8"
     ftp_timeout = payload.get("ftp_timeout")
     keep_file_on_ftp = payload.get("keep_file_on_ftp") or False
     add_fin_file = payload.get("add_fin_file") or False
+    streaming = payload.get("streaming", True) is not False
+    max_parallel_transfers = int(payload.get("max_parallel_transfers") or 1)
+    connections_per_file = int(payload.get("connections_per_file") or 1)
+    file_ready_after_seconds = payload.get("file_ready_after_seconds")
+    if file_ready_after_seconds is None:
+        file_ready_after_seconds = readiness.FILE_READY_AFTER_SECONDS
+    ready_wait_seconds = payload.get("ready_wait_seconds")
+    if ready_wait_seconds is None:
+        ready_wait_seconds = readiness.READY_WAIT_SECONDS
+    max_connections_per_host = int(payload.get("max_connections_per_host") or
+                                   max_parallel_transfers * connections_per_file)
+    resumable = payload.get("resumable", True) is not False
+    incremental = payload.get("incremental") or False
+    engine = payload.get("engine") or "threads"
+    if engine not in ("threads", "asyncio"):
+        raise Exception(f"engine must be one of ['threads', 'asyncio'], got {engine}.")
+    if engine == "asyncio" and not streaming:
+        raise Exception("engine asyncio only supports streaming transfers (streaming=True).")
+    compression = payload.get("compression") or None
+    if compression is not None:
+        get_compression(compression)  # fail early for unsupported compressions
+    compression_level = payload.get("compression_level")
+    if compression_level is not None:
+        compression_level = int(compression_level)
+    composite_upload_threshold = payload.get("composite_upload_threshold")
+    if composite_upload_threshold is None:
+        composite_upload_threshold = gcs.COMPOSITE_UPLOAD_THRESHOLD
+    elif composite_upload_threshold is False:
+        composite_upload_threshold = None
+    else:
+        composite_upload_threshold = int(composite_upload_threshold)
+    transcoding = None
+    if payload.get("source_encoding"):
+        transcoding = get_transcoding(payload["source_encoding"], target_encoding=payload.get("target_encoding"),
+                                      strip_bom=payload.get("strip_bom"), newline=payload.get("newline"),
+                                      errors=payload.get("encoding_errors"))
+
+    continuation = payload.get("continuation")
+    if continuation is not None and source_file_name is not None:
+        raise Exception("continuation is only supported with source_file_name_re or source_file_glob.")
+    # stops starting transfers when the run would run out of time (see script_runner.run_job)
+    budget = scheduling.TransferBudget(throughput=continuation.get("throughput") if continuation else None)
 
     source_host = source_ftp_cfg.address
     source_user = source_ftp_cfg.user
     print(f"source_host: {source_host}, source_file_name_re: {source_file_name_re}, "
-          f"source_file_name: {source_file_name}, source_folder: {source_folder}, encoding: {encoding}, "
+          f"source_file_glob: {source_file_glob}, recursive: {recursive}, max_depth: {max_depth}, "
+          f"max_files: {max_files}, source_file_name: {source_file_name}, source_folder: {source_folder}, "
+          f"encoding: {encoding}, "
           f"timeout: {ftp_timeout}, source_user: {source_user}")
     source_pwd = source_ftp_cfg.passwd
 
@@ -77,87 +644,235 @@ def run_script(**kwargs):
         raise Exception("gcs_folders must be provided in payload.")
 
     print(f"gcs_bucket: {gcs_bucket}, gcs_folder: {gcs_folders}")
-    if source_file_name is not None:
-        files_on_source_ftp = [source_file_name]
-    else:  # = a regular Expression to search for multiple files was provided
-        files_on_source_ftp = ftp.list_files_on_ftp(file_name_re=source_file_name_re, ftp_address=source_host,
-                                                    ftp_user=source_user, ftp_passwd=source_pwd,
-                                                    ftp_folder=source_folder)
-        if len(files_on_source_ftp) == 0:
-            msg = f"no_matches_on_ftp"
-            print(msg)
-            return return_result(result=msg, workflow_instructions={"exit": True})
-        print(f"Found the following files on FTP: {files_on_source_ftp}")
-
-        if len(files_on_source_ftp) > 1:
-            # process the oldest file first.
-            files_on_source_ftp = sorted(files_on_source_ftp, reverse=True)
-
-    gcs_locations = []  # will contain a list of all exported files' GCS locations
-    for ftp_file_name in files_on_source_ftp:
-        print(f"Checking if file {ftp_file_name} has been completely uploaded already to FTP")
-        # we cannot be 100% sure, but we can check if the file was last modified at least 10 minutes ago (an upload should never take that long)
-        modification_date = ftp.get_file_modification_date(file_name=ftp_file_name, ftp_address=source_host,
-                                                           ftp_user=source_user, ftp_passwd=source_pwd,
-                                                           ftp_folder=source_folder)
-        now = datetime.now(timezone.utc)
-        if modification_date > datetime.now() - timedelta(seconds=30):
-            print(
-                f"File {ftp_file_name}'s modification date is {modification_date}, so it may not have been completely uploaded yet to FTP. Stopping.")
-            # we want the workflow to retry later. Since we are sorting the files in a way that we are processing the newest files first,
-            # it will not happen that there are any other (newer) unprocessed files on the FTP
-            return return_result(result="file_not_ready_yet", workflow_instructions={"retry": True})
-        print(
-            f"File {ftp_file_name}'s modification date is {modification_date}, so it has been completely uploaded already to FTP. Continuing.")
 
-        print("Importing file from FTP to GCS: " + ftp_file_name)
-        try:
+    def gcs_file_name(entry: ftp.FtpEntry) -> str:
+        return compressed_file_name(payload.get("gcs_file_name") or entry.name, compression)
 
-            source_file = ftp.download_from_ftp(file_name=ftp_file_name, ftp_address=source_host,
-                                                ftp_user=source_user, ftp_passwd=source_pwd,
-                                                ftp_folder=source_folder, timeout=ftp_timeout)
-        except Exception as e:
-            msg = f"Error while downloading file {ftp_file_name} from FTP: {e}"
-            # this happens quite often, so we don't want to raise the Exception to the top (would cause false alerts)
-            print(msg)
-            return return_result(result="ftp_error", result_detail=msg, workflow_instructions={"retry": True})
+    def file_gcs_locations(entry: ftp.FtpEntry) -> list:
+        return [to_gcs_location(gcs_folder, gcs_file_name(entry)) for gcs_folder in gcs_folders]
 
-        print(
-            f"Downloaded from FTP. Now transferring {ftp_file_name} to GCS bucket {gcs_bucket} and folder {gcs_folders}")
+    import_manifest = None
+    skipped_files = []  # files that were not imported because they are unchanged since the last import
+    if incremental:
+        import_manifest = manifest.Manifest(
+            payload.get("manifest_location") or manifest.default_manifest_location(source_ftp, source_folder or ""),
+            bucket_name=gcs_bucket).load()
+
+    # one FTP login per connection for all operations of this run
+    def refresh_login():
+        # the login was rejected, so the cached secret may be outdated
+        refreshed_cfg = cfg.get_ftp_config(source_ftp, refresh=True)
+        return refreshed_cfg.user, refreshed_cfg.passwd
+
+    page_end = None  # cursor after the last file of this run if max_files leaves files for the next run
+    with ftp.FtpSessionPool(timeout=ftp_timeout, max_connections_per_host=max_connections_per_host,
+                            refresh_login=refresh_login) as ftp_pool:
+        with ftp_pool.session(source_host, source_user, source_pwd) as ftp_session:
+            if source_file_name is not None:
+                entry = ftp.get_entry(file_name=source_file_name, ftp_folder=source_folder, session=ftp_session)
+                if entry is None:
+                    raise Exception(f"File {source_file_name} not found on FTP in folder {source_folder}.")
+                files_on_source_ftp = [entry]
+            else:  # = a regular Expression (or glob) to search for multiple files was provided
+                # one listing round trip gives us names, sizes and modification dates of all files. The entries are
+                # filtered as they arrive, so only the matching files are kept in memory
+                def list_source_files(select) -> list:
+                    # the listing is repeated from the start if the connection drops
+                    return ftp_session.call(lambda _: select(ftp.iter_entries(
+                        ftp_folder=source_folder, session=ftp_session, name_glob=source_file_glob,
+                        recursive=recursive, max_depth=max_depth)))
+
+                if continuation is not None and continuation.get("files") is not None:
+                    continuation_files = set(continuation["files"])
+                    files_on_source_ftp = list_source_files(lambda entries: select_files(
+                        (entry for entry in entries if entry.name in continuation_files),
+                        file_name_re=source_file_name_re))
+                    page_end = continuation["cursor"].get("after")
+                    print(f"Continuing after {continuation['cursor']} with the files that are left: "
+                          f"{[entry.name for entry in files_on_source_ftp]}")
+                else:
+                    after = continuation["cursor"].get("after") if continuation is not None else None
+                    # one more than max_files tells us if there are more files for the next run
+                    files_on_source_ftp = list_source_files(lambda entries: select_files(
+                        entries, file_name_re=source_file_name_re,
+                        max_files=max_files + 1 if max_files is not None else None,
+                        after=from_cursor(after) if after is not None else None))
+                    if max_files is not None and len(files_on_source_ftp) > max_files:
+                        files_on_source_ftp = files_on_source_ftp[:max_files]
+                        page_end = to_cursor(files_on_source_ftp[-1])
+                    if after is not None:
+                        print(f"Continuing with the files after {after}")
+                if len(files_on_source_ftp) == 0 and page_end is None:
+                    msg = f"no_matches_on_ftp"
+                    print(msg)
+                    return return_result(result=msg, workflow_instructions={"exit": True})
+                print(f"Found the following files on FTP: {[entry.name for entry in files_on_source_ftp]}"
+                      f"{' (and more for the next run)' if page_end is not None else ''}")
+
+            if import_manifest is not None:
+                skipped_files = [entry.name for entry in files_on_source_ftp
+                                 if import_manifest.is_imported(entry, file_gcs_locations(entry))]
+                files_on_source_ftp = [entry for entry in files_on_source_ftp if entry.name not in skipped_files]
+                print(f"Skipping {len(skipped_files)} files that are unchanged since their last import: "
+                      f"{skipped_files}")
+
+            files_to_import = []
+            file_not_ready = False
+            # all files share the waiting time, so that a run does not wait for each of them in turn
+            ready_deadline = time.monotonic() + ready_wait_seconds
+            if cfg.seconds_left() is not None:
+                # leave time for at least one transfer
+                ready_deadline = min(ready_deadline, time.monotonic() + cfg.seconds_left() / 2)
+            for entry in files_on_source_ftp:
+                print(f"Checking if file {entry.name} has been completely uploaded already to FTP")
+                file_readiness = readiness.wait_until_ready(entry, ftp_session=ftp_session, ftp_folder=source_folder,
+                                                            ready_after_seconds=file_ready_after_seconds,
+                                                            deadline=ready_deadline)
+                if not file_readiness.ready:
+                    print(
+                        f"File {entry.name} ({file_readiness.state}) was still changing after waiting {file_readiness.waited:.1f}s, so it may not have been completely uploaded yet to FTP. Stopping.")
+                    # Since we are processing the oldest files first, all other unprocessed files are even newer
+                    file_not_ready = True
+                    break
+                print(
+                    f"File {entry.name} ({file_readiness.state}) has not changed for {file_ready_after_seconds}s, so it has been completely uploaded already to FTP. Continuing.")
+                if file_readiness.waited > 0 and file_readiness.state.size is not None:
+                    # the size in the listing is outdated if the file changed while we waited
+                    entry = entry._replace(size=file_readiness.state.size)
+                    if entry.source != "LIST" and file_readiness.state.modified is not None:
+                        # LIST times are less precise than MDTM, keep them comparable for incremental imports
+                        entry = entry._replace(modified=file_readiness.state.modified)
+                files_to_import.append(entry)
+
+        def transfer(number: int, entry: ftp.FtpEntry) -> dict or None:
+            if not budget.try_start(number):
+                return None  # left for the next invocation
+            started = time.monotonic()
+            with metrics.file_scope(entry.name), \
+                    ftp_pool.session(source_host, source_user, source_pwd) as transfer_session:
+                transferred = transfer_file(entry, ftp_session=transfer_session, source_folder=source_folder,
+                                            gcs_bucket=gcs_bucket, gcs_folders=gcs_folders,
+                                            gcs_file_name=gcs_file_name(entry), streaming=streaming,
+                                            encoding=encoding, resumable=resumable, compression=compression,
+                                            compression_level=compression_level, transcoding=transcoding,
+                                            composite_upload_threshold=composite_upload_threshold,
+                                            ftp_pool=ftp_pool, connections_per_file=connections_per_file)
+            budget.record(transferred["size"], time.monotonic() - started)
+            return transferred
+
+        if engine == "asyncio":
+            # up to max_parallel_transfers files (more if max_connections_per_host allows it) are downloaded while as
+            # many others finish their upload
+            in_flight = asyncio.Semaphore(2 * max_parallel_transfers)
+            run_metrics = metrics.current()
+
+            async def transfer_async(number: int, entry: ftp.FtpEntry) -> dict or None:
+                metrics.use(run_metrics)  # the task runs in the context of the event loop thread
+                async with in_flight:
+                    if not budget.try_start(number):
+                        return None  # left for the next invocation
+                    started = time.monotonic()
+                    with metrics.file_scope(entry.name):
+                        transferred = await transfer_file_async(
+                            entry, ftp_pool=ftp_pool, ftp_login=(source_host, source_user, source_pwd),
+                            source_folder=source_folder, gcs_bucket=gcs_bucket, gcs_folders=gcs_folders,
+                            gcs_file_name=gcs_file_name(entry), resumable=resumable, compression=compression,
+                            compression_level=compression_level, transcoding=transcoding,
+                            composite_upload_threshold=composite_upload_threshold,
+                            connections_per_file=connections_per_file)
+                    budget.record(transferred["size"], time.monotonic() - started)
+                    return transferred
+
+            # each file in flight needs at most two threads at the same time (FTP download and GCS upload)
+            executor = aio.EventLoopThread(max_workers=4 * max_parallel_transfers)
+
+            def submit_transfer(number: int, entry: ftp.FtpEntry):
+                return executor.submit(transfer_async(number, entry))
+        else:
+            executor = ThreadPoolExecutor(max_workers=max_parallel_transfers)
+
+            def submit_transfer(number: int, entry: ftp.FtpEntry):
+                # copy_context: count the transfers in the metrics of this run
+                return executor.submit(contextvars.copy_context().run, transfer, number, entry)
+
+        gcs_locations = []  # will contain a list of all exported files' GCS locations
+        file_results = []  # per-file results
+        files_left = []  # files that are left for the next run because the time budget of this run was used up
+        budget.plan([entry.size for entry in files_to_import])
+        with executor:
+            transfers = [submit_transfer(number, entry) for number, entry in enumerate(files_to_import)]
+            # transfers run in parallel, but deletes and .fin files are committed in oldest-first order.
+            # If a transfer fails, later files are not committed either and will be imported again in the next attempt
+            try:
+                for number, (entry, future) in enumerate(zip(files_to_import, transfers)):
+                    try:
+                        transferred = future.result()
+                        if transferred is None:
+                            # this and all later files are left for the next run, also if they were transferred
+                            # already, so that the files that are committed are always the oldest ones
+                            files_left += [left.name for left in files_to_import[number:]]
+                            for pending in transfers[number:]:
+                                pending.cancel()
+                            break
+                        with ftp_pool.session(source_host, source_user, source_pwd) as ftp_session:
+                            commit_file(entry, ftp_session=ftp_session, source_folder=source_folder,
+                                        transferred_size=transferred["size"], keep_file_on_ftp=keep_file_on_ftp,
+                                        add_fin_file=add_fin_file, encoding=encoding)
+                    except Exception as e:
+                        for pending in transfers:
+                            pending.cancel()
+                        file_results.append({"file": entry.name, "result": "error", "result_detail": str(e)})
+                        if not isinstance(e, FtpTransferError):
+                            raise
+                        # this happens quite often, so we don't want to raise the Exception to the top (would cause false alerts)
+                        print(str(e))
+                        script_result = return_result(result="ftp_error", result_detail=str(e),
+                                                      workflow_instructions={"retry": True})
+                        script_result.update({"gcs_locations": gcs_locations, "files": file_results,
+                                              "skipped_files": skipped_files})
+                        return script_result
+                    gcs_locations += transferred["gcs_locations"]
+                    if import_manifest is not None:
+                        import_manifest.record(entry, transferred["gcs_locations"],
+                                               checksums=transferred["checksums"])
+                    file_results.append({"file": entry.name, "result": "done",
+                                         "gcs_locations": transferred["gcs_locations"], "size": transferred["size"],
+                                         "checksums": transferred["checksums"]})
+            finally:
+                if import_manifest is not None:
+                    # save the files that were imported, also if a later one failed
+                    import_manifest.save()
+
+    def continue_with(result_detail: str, continuation_files: list = None) -> dict:
+        files_done = (continuation["cursor"]["files_done"] if continuation is not None else 0) + \
+            len([file_result for file_result in file_results if file_result["result"] == "done"])
+        last_file = file_results[-1]["file"] if file_results else None
+        if last_file is None and continuation is not None:
+            last_file = continuation["cursor"]["last_file"]
+        next_continuation = {"cursor": {"last_file": last_file, "files_done": files_done, "after": page_end},
+                             "throughput": round(budget.throughput)}
+        if continuation_files is not None:
+            next_continuation["files"] = continuation_files
+        continue_result = return_result(result="continue", result_detail=result_detail,
+                                        workflow_instructions={"continuation": next_continuation})
+        continue_result.update({"gcs_locations": gcs_locations, "files": file_results, "skipped_files": skipped_files})
+        return continue_result
 
-        gcs_file_name = payload.get("gcs_file_name") or ftp_file_name
-
-        for gcs_folder in gcs_folders:
-            if gcs_folder[-1] != "/":
-                # append "/" to folder name if it is not there yet to make concatenation of folder to file name easier
-                gcs_folder += "/"
-            gcs_location = gcs_folder + gcs_file_name
-            gcs.upload_file(dest_file_name=gcs_location, bucket_name=gcs_bucket, data=source_file,
-                            file_encoding=encoding)
-            gcs_locations.append(gcs_location)
-            print(
-                f"Transferred file {ftp_file_name} to GCS bucket {gcs_bucket} and location {gcs_location}")
-
-        if keep_file_on_ftp is False:
-            print(f"Deleting file {ftp_file_name} from FTP")
-            ftp.delete_file(ftp_folder=source_folder, file_name=ftp_file_name, ftp_address=source_host,
-                            ftp_user=source_user,
-                            ftp_passwd=source_pwd)
-            print(f"Deleted file {ftp_file_name} from FTP")
-
-        if add_fin_file is True:
-            print("Adding .fin file to FTP so Adobe Analytics can start importing it.")
-            finfile_buffer = StringIO()
-            finfile_name = ftp_file_name.split(".")[0] + ".fin"
-            ftp.upload_to_ftp(finfile_buffer,
-                              file_name=finfile_name,
-                              ftp_address=source_host,
-                              ftp_user=source_user,
-                              ftp_passwd=source_pwd,
-                              ftp_folder=source_folder, file_encoding=encoding)
-            print(f"Uploaded fin file {finfile_name} to FTP")
-
-    return {"result": "done", "gcs_locations": gcs_locations}
+    if files_left:
+        # the workflow starts the next run with the files that are left, instead of the next run timing out as well
+        if file_not_ready:
+            # files that were not ready are checked again by the next run
+            files_left += [entry.name for entry in files_on_source_ftp[len(files_to_import):]]
+        return continue_with(f"{len(files_left)} files are left for the next run", continuation_files=files_left)
+    if file_not_ready:
+        # we want the workflow to retry later
+        script_result = return_result(result="file_not_ready_yet", workflow_instructions={"retry": True})
+        script_result.update({"gcs_locations": gcs_locations, "files": file_results, "skipped_files": skipped_files})
+        return script_result
+    if page_end is not None:
+        # the workflow starts the next run for the files after this page
+        return continue_with(f"more than {max_files} files match, continuing after {page_end['name']} in the next run")
+    return {"result": "done", "gcs_locations": gcs_locations, "files": file_results, "skipped_files": skipped_files}
 
 
 if __name__ == '__main__':
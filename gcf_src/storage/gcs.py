@@ -1,13 +1,57 @@
+import base64
+import contextvars
+import hashlib
+import json
 import mimetypes
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
 from io import StringIO, BytesIO
+from os import environ
 
-from google.cloud import storage
+import requests
 
 from gcf_src.config import cfg
+from gcf_src.monitoring import metrics
 
-storage_client = storage.Client()
+_storage_client = None
+_storage_client_lock = threading.Lock()
 # Name of the default project GCS bucket
 DEFAULT_BUCKET = cfg.GCS_DEFAULT_BUCKET
+# Chunk size for streaming (resumable) uploads. GCS requires a multiple of 256 KiB for every chunk but the last one.
+# This is also the upper bound of file data a streaming upload holds in memory.
+STREAM_CHUNK_SIZE = 32 * 256 * 1024  # 8 MiB
+# number of times a request of a streaming upload is repeated after a connection error or one of
+# `UPLOAD_RETRY_STATUS_CODES`, with exponential backoff starting at `UPLOAD_RETRY_BACKOFF` seconds
+UPLOAD_RETRIES = 3
+UPLOAD_RETRY_BACKOFF = 1
+UPLOAD_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# max. number of server-side copies that run at the same time when a file is written to several locations
+FAN_OUT_WORKERS = 8
+# files of at least this size (bytes) are uploaded as parallel composite uploads (see `ParallelCompositeUpload`)
+COMPOSITE_UPLOAD_THRESHOLD = int(environ.get("COMPOSITE_UPLOAD_THRESHOLD", 512 * 1024 * 1024))
+# size of the parts of a parallel composite upload. Each part in flight is held in memory.
+COMPOSITE_PART_SIZE = 16 * 1024 * 1024
+# max. number of parts of a parallel composite upload that are uploaded at the same time
+COMPOSITE_UPLOAD_WORKERS = 4
+# folder for the temporary parts of parallel composite uploads. Add a lifecycle rule that deletes objects in it after
+# a day, for parts left behind by instances that crashed in the middle of an upload.
+COMPOSITE_PARTS_FOLDER = "_composite_parts/"
+# max. number of objects GCS composes in one request
+MAX_COMPOSE_SOURCES = 32
+
+
+def get_storage_client():
+    """Returns the GCS client. It is only created (and `google.cloud.storage` only imported) when first needed, so
+    cold starts of scripts that do not use GCS do not pay for it. The client is reused across invocations."""
+    global _storage_client
+    with _storage_client_lock:
+        if _storage_client is None:
+            from google.cloud import storage
+            _storage_client = storage.Client()
+        return _storage_client
 
 
 def download_file(file_name, bucket_name=DEFAULT_BUCKET, file_encoding='utf-8', encode=False):
@@ -30,12 +74,14 @@ def download_file(file_name, bucket_name=DEFAULT_BUCKET, file_encoding='utf-8',
     :rtype: StringIO or BytesIO or None
     """
     print(f'Downloading file {file_name} from GCS bucket {bucket_name}')
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.get_blob(blob_name=file_name)
     if blob is None:
         print(f'File {file_name} is not found.')
         return None
-    byte_arr = blob.download_as_string()
+    with metrics.phase("gcs_download", file=file_name) as download:
+        byte_arr = blob.download_as_bytes()
+        download.bytes = len(byte_arr)
     if encode:
         print(f'Decoding file {file_name} using {file_encoding} encoding.')
         encoded_str = byte_arr.decode(encoding=file_encoding)
@@ -43,10 +89,20 @@ def download_file(file_name, bucket_name=DEFAULT_BUCKET, file_encoding='utf-8',
     return BytesIO(byte_arr)
 
 
+def infer_content_type(file_name: str, content_type: str = None) -> str:
+    """Returns `content_type` or, if it is None, the content type guessed from the `file_name`."""
+    if content_type is None:
+        guessed_type, _ = mimetypes.guess_type(file_name)
+        content_type = guessed_type or 'application/octet-stream'
+        print(f'Inferred Content Type {content_type} from file name.')
+    return content_type
+
+
 def upload_file(dest_file_name: str = None, data: object = None, content_type: str = None,
                 bucket_name: str = DEFAULT_BUCKET,
                 file_encoding: str = 'utf-8', encode: bool = True, no_cache: bool = False,
-                metadata: dict = None, retries: int = None, timeout: int = None) -> str:
+                metadata: dict = None, retries: int = None, timeout: int = None, checksum: str = None,
+                content_encoding: str = None) -> str:
     """Uploads supplied data to the bucket with a specific destination file name.
 
     :param timeout: timeout in seconds for uploads (defaults to GCS default of 60 seconds)
@@ -59,24 +115,36 @@ def upload_file(dest_file_name: str = None, data: object = None, content_type: s
     :param encode: encode the stringIO (True) or is it already encoded?
     :param no_cache: set to True if you want to disable caching of the uploaded file
     :param metadata: GCS metadata to be stored with the file
+    :param checksum: "md5" or "crc32c" to have GCS validate the upload against a checksum computed while uploading
+    :param content_encoding: Content-Encoding of the data (eg. "gzip" if it is compressed)
     :return: URL of the stored file
     """
     print(f'Uploading file {dest_file_name} of type {content_type} to GCS bucket {bucket_name}.')
-    if content_type is None:
-        guessed_type, _ = mimetypes.guess_type(dest_file_name)
-        content_type = guessed_type or 'application/octet-stream'
-        print(f'Inferred Content Type {content_type} from file name.')
-    unpacked_data = data
-    if isinstance(data, StringIO) or isinstance(data, BytesIO):
-        print('Unpacking data from StringIO/BytesIO.')
-        data.seek(0)
-        unpacked_data = data.read()
-    bucket = storage_client.bucket(bucket_name)
+    content_type = infer_content_type(dest_file_name, content_type)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(dest_file_name)
-    if isinstance(unpacked_data, str) and encode is True:
-        print(f'Encoding string data as {file_encoding} bytes.')
-        unpacked_data = unpacked_data.encode(file_encoding)
-    blob.upload_from_string(unpacked_data, content_type, num_retries=retries, timeout=timeout)
+    if content_encoding is not None:
+        blob.content_encoding = content_encoding
+    if isinstance(data, BytesIO):
+        # upload straight from the buffer instead of reading it into another full copy first
+        data.seek(0)
+        with metrics.phase("gcs_upload", file=dest_file_name) as upload:
+            upload.bytes = data.getbuffer().nbytes
+            blob.upload_from_file(data, content_type=content_type, num_retries=retries, timeout=timeout,
+                                  checksum=checksum)
+    else:
+        unpacked_data = data
+        if isinstance(data, StringIO):
+            print('Unpacking data from StringIO.')
+            data.seek(0)
+            unpacked_data = data.read()
+        if isinstance(unpacked_data, str) and encode is True:
+            print(f'Encoding string data as {file_encoding} bytes.')
+            unpacked_data = unpacked_data.encode(file_encoding)
+        with metrics.phase("gcs_upload", file=dest_file_name) as upload:
+            upload.bytes = len(unpacked_data)
+            blob.upload_from_string(unpacked_data, content_type, num_retries=retries, timeout=timeout,
+                                    checksum=checksum)
 
     if no_cache is True:
         blob.cache_control = "no-cache, max-age=0"
@@ -97,7 +165,600 @@ def delete_file(bucket_name: str = DEFAULT_BUCKET, file_name: str = None):
 
     print(
         f"File {file_name} in bucket {bucket_name} will be deleted.")
-    source_bucket = storage_client.bucket(bucket_name)
+    source_bucket = get_storage_client().bucket(bucket_name)
     source_blob = source_bucket.blob(file_name)
     # Delete the file in the source bucket
     return source_blob.delete()
+
+
+class GenerationMismatch(Exception):
+    """A write with a generation precondition failed because the file was changed (or created) in the meantime."""
+
+
+def read_json(file_name: str, bucket_name: str = DEFAULT_BUCKET) -> dict or list or None:
+    """Returns the parsed content of a JSON file in GCS or None if the file does not exist."""
+    return read_json_with_generation(file_name, bucket_name=bucket_name)[0]
+
+
+def read_json_with_generation(file_name: str, bucket_name: str = DEFAULT_BUCKET) -> tuple:
+    """Returns the parsed content of a JSON file in GCS and its generation (for `write_json(if_generation_match=...)`).
+    :return: (content, generation) or (None, 0) if the file does not exist
+    """
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name=file_name)
+    if blob is None:
+        return None, 0
+    return json.loads(blob.download_as_bytes(if_generation_match=blob.generation)), blob.generation
+
+
+def write_json(file_name: str, data: dict or list, bucket_name: str = DEFAULT_BUCKET,
+               if_generation_match: int = None) -> int:
+    """Writes `data` as a JSON file to GCS.
+    :param if_generation_match: only write if the file still has this generation (0 = only if it does not exist yet)
+    :return: the generation of the written file
+    :raises GenerationMismatch: if the precondition `if_generation_match` failed
+    """
+    from google.api_core.exceptions import PreconditionFailed
+    blob = get_storage_client().bucket(bucket_name).blob(file_name)
+    try:
+        blob.upload_from_string(json.dumps(data), content_type="application/json",
+                                if_generation_match=if_generation_match)
+    except PreconditionFailed as e:
+        raise GenerationMismatch(f"{file_name} in bucket {bucket_name} was changed in the meantime: {e}")
+    return blob.generation
+
+
+def delete_file_if_exists(file_name: str, bucket_name: str = DEFAULT_BUCKET) -> bool:
+    """Deletes a file from GCS if it exists.
+    :return: True if a file was deleted
+    """
+    from google.api_core.exceptions import NotFound
+    try:
+        get_storage_client().bucket(bucket_name).blob(file_name).delete()
+        return True
+    except NotFound:
+        return False
+
+
+def copy_file(source_file_name: str, dest_file_name: str, bucket_name: str = DEFAULT_BUCKET,
+              dest_bucket_name: str = None) -> str:
+    """Copies a file server-side within GCS (no data passes through this function). Uses rewrites, so that large files
+    and copies across locations or storage classes work too.
+    :return: URL of the copied file
+    """
+    print(f"Copying file {source_file_name} in bucket {bucket_name} to {dest_file_name}.")
+    source_blob = get_storage_client().bucket(bucket_name).blob(source_file_name)
+    dest_blob = get_storage_client().bucket(dest_bucket_name or bucket_name).blob(dest_file_name)
+    with metrics.phase("gcs_copy", file=dest_file_name) as copy:
+        token, bytes_rewritten, total_bytes = dest_blob.rewrite(source_blob)
+        while token is not None:
+            print(f"Copied {bytes_rewritten} of {total_bytes} bytes of {source_file_name} to {dest_file_name}.")
+            token, bytes_rewritten, total_bytes = dest_blob.rewrite(source_blob, token=token)
+        copy.bytes = total_bytes
+    return dest_blob.self_link
+
+
+def fan_out(source_file_name: str, dest_file_names: list, bucket_name: str = DEFAULT_BUCKET,
+            max_workers: int = FAN_OUT_WORKERS) -> list:
+    """Creates copies of the already uploaded `source_file_name` at all `dest_file_names` with server-side copies
+    that run concurrently, instead of uploading the same data again for every destination.
+    :return: the destination file names (in the order they were supplied)
+    """
+    dest_file_names = [dest_file_name for dest_file_name in dest_file_names if dest_file_name != source_file_name]
+    if len(dest_file_names) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(dest_file_names))) as executor:
+        # copy_context: count the copies in the metrics of the current run
+        copies = [executor.submit(contextvars.copy_context().run, copy_file, source_file_name=source_file_name,
+                                  dest_file_name=dest_file_name, bucket_name=bucket_name)
+                  for dest_file_name in dest_file_names]
+        for copy in copies:
+            copy.result()  # raises if a copy failed
+    print(f"Copied file {source_file_name} in bucket {bucket_name} to {dest_file_names}.")
+    return dest_file_names
+
+
+def list_files(prefix: str = None, bucket_name: str = DEFAULT_BUCKET, file_name_re: str = None) -> list:
+    """Returns the files (blobs with name, size, generation and update time) in the bucket whose names start with
+    `prefix` and, if `file_name_re` is given, whose names without the prefix match the regex. Oldest files first.
+    "Folder" placeholders (names ending with "/") are skipped."""
+    file_name_rs = re.compile(file_name_re) if file_name_re is not None else None
+    blobs = [blob for blob in get_storage_client().list_blobs(bucket_name, prefix=prefix)
+             if not blob.name.endswith("/")
+             and (file_name_rs is None or file_name_rs.match(blob.name[len(prefix or ""):]))]
+    return sorted(blobs, key=lambda blob: (blob.updated, blob.name))
+
+
+def open_reader(file_name: str, bucket_name: str = DEFAULT_BUCKET, chunk_size: int = STREAM_CHUNK_SIZE):
+    """Opens a GCS file for streaming reads (see `StreamingReader`).
+    :return: a `StreamingReader` (close it when done) or None if the file does not exist
+    """
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name=file_name)
+    if blob is None:
+        return None
+    return StreamingReader(blob, chunk_size=chunk_size)
+
+
+def get_checksums(file_name: str, bucket_name: str = DEFAULT_BUCKET) -> dict:
+    """Returns the checksums GCS computed for a file (base64, as in the object resource) or {} if it does not exist."""
+    blob = get_storage_client().bucket(bucket_name).get_blob(blob_name=file_name)
+    if blob is None:
+        return {}
+    return {"crc32c": blob.crc32c, "md5": blob.md5_hash}
+
+
+def upload_file_to_locations(dest_file_names: list, data: object = None, bucket_name: str = DEFAULT_BUCKET,
+                             **upload_kwargs) -> list:
+    """Uploads supplied data once to the first of `dest_file_names` and creates the other ones with `fan_out`.
+    Takes the same keyword arguments as `upload_file`.
+    :return: the GCS locations of the file (= `dest_file_names`)
+    """
+    upload_file(dest_file_name=dest_file_names[0], data=data, bucket_name=bucket_name, **upload_kwargs)
+    fan_out(dest_file_names[0], dest_file_names[1:], bucket_name=bucket_name)
+    return list(dest_file_names)
+
+
+class StreamingChecksums:
+    """CRC32C and MD5 of data that is passed to `update` block by block, so a stream can be hashed while it is
+    transferred instead of in a separate pass. The checksums are base64-encoded like in GCS object resources."""
+
+    def __init__(self):
+        import google_crc32c  # installed with google-cloud-storage; C implementation where available
+        self._crc32c = google_crc32c.Checksum()
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def update(self, data: bytes):
+        self._crc32c.update(data)
+        self._md5.update(data)
+        self.size += len(data)
+
+    @property
+    def crc32c(self) -> str:
+        return base64.b64encode(self._crc32c.digest()).decode("ascii")
+
+    @property
+    def md5(self) -> str:
+        return base64.b64encode(self._md5.digest()).decode("ascii")
+
+    def to_dict(self) -> dict:
+        return {"crc32c": self.crc32c, "md5": self.md5}
+
+    def goog_hash_header(self) -> str:
+        """Returns the value for the X-Goog-Hash header, with which GCS validates the uploaded data."""
+        return f"crc32c={self.crc32c},md5={self.md5}"
+
+
+class ResumableUploadStream:
+    """Writable file-like object that streams data into a GCS resumable upload session.
+
+    Data is sent to GCS in chunks of `chunk_size` bytes as soon as enough has been written, so at most about one chunk
+    is held in memory no matter how big the file is. A request that fails with a connection error or a 429/5xx response
+    is repeated from the offset GCS has committed (see `_put`). The upload session is only opened on the first write,
+    and the object is only created in GCS when `close()` is called. Call `abort()` instead if the source of the data
+    failed, so that no truncated object is committed.
+
+    CRC32C and MD5 of the data are computed while it is written and sent with the final chunk, so GCS rejects the
+    upload if the data it received differs. This is not possible for an upload that was `resume`d, because the bytes
+    written before are not known anymore (`checksums` is None then); GCS still computes the checksums of the object.
+
+    Usage:
+        with gcs.ResumableUploadStream("folder/file.csv", bucket_name="my-bucket") as upload:
+            ftp.retrbinary("RETR file.csv", upload.write)
+    """
+
+    def __init__(self, dest_file_name: str, bucket_name: str = DEFAULT_BUCKET, content_type: str = None,
+                 chunk_size: int = STREAM_CHUNK_SIZE, metadata: dict = None, timeout: int = None,
+                 content_encoding: str = None):
+        if chunk_size % (256 * 1024) != 0:
+            raise ValueError("chunk_size must be a multiple of 256 KiB")
+        self.dest_file_name = dest_file_name
+        self.bucket_name = bucket_name
+        self.content_type = infer_content_type(dest_file_name, content_type)
+        self.chunk_size = chunk_size
+        self.metadata = metadata
+        self.timeout = timeout
+        self.content_encoding = content_encoding
+        self.session_url = None
+        self.committed = 0  # number of bytes persisted by GCS
+        self.result = None  # object resource returned by GCS after the upload has been finalized
+        self._buffer = bytearray()
+        self._http = requests.Session()
+        self._aborted = False
+        self.checksums = StreamingChecksums()  # of all bytes written, None if unknown (resumed upload)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    @property
+    def bytes_written(self) -> int:
+        return self.committed + len(self._buffer)
+
+    @property
+    def failed(self) -> bool:
+        """True if the upload was aborted. A failed request does not break the session: writing continues at the
+        committed offset."""
+        return self._aborted
+
+    @classmethod
+    def resume(cls, session_url: str, dest_file_name: str, bucket_name: str = DEFAULT_BUCKET,
+               **kwargs) -> "ResumableUploadStream":
+        """Reattaches to the upload session `session_url` of an earlier, interrupted upload (eg. from a previous
+        attempt). Asks GCS how many bytes it has persisted: writing continues at `committed`. If the upload had already
+        been finalized, `result` is set. Takes the same keyword arguments as the constructor.
+        :raises Exception: if the session does not exist anymore (sessions expire after a week)
+        """
+        upload = cls(dest_file_name, bucket_name=bucket_name, **kwargs)
+        upload.session_url = session_url
+        upload.checksums = None
+        upload._put(b"")  # status query
+        print(f"Resuming upload of {dest_file_name} in GCS bucket {bucket_name} at byte {upload.committed}.")
+        return upload
+
+    def open(self) -> str:
+        """Opens the upload session (if not open yet) without writing data.
+        :return: the session URL, which can be used to `resume` the upload later
+        """
+        if self.session_url is None:
+            self._open_session()
+        return self.session_url
+
+    def _open_session(self):
+        bucket = get_storage_client().bucket(self.bucket_name)
+        blob = bucket.blob(self.dest_file_name)
+        if self.metadata is not None:
+            blob.metadata = self.metadata
+        if self.content_encoding is not None:
+            blob.content_encoding = self.content_encoding
+        self.session_url = blob.create_resumable_upload_session(content_type=self.content_type,
+                                                                timeout=self.timeout)
+        print(f"Opened resumable upload session for {self.dest_file_name} in GCS bucket {self.bucket_name}.")
+
+    def _send(self, data: bytes, total_size: int = None, headers: dict = None) -> requests.Response:
+        total = "*" if total_size is None else str(total_size)
+        if len(data) > 0:
+            content_range = f"bytes {self.committed}-{self.committed + len(data) - 1}/{total}"
+        else:
+            content_range = f"bytes */{total}"
+        with metrics.phase("gcs_upload", log=False) as upload:
+            upload.bytes = len(data)
+            return self._http.put(self.session_url, data=data,
+                                  headers={"Content-Range": content_range, **(headers or {})}, timeout=self.timeout)
+
+    def _put(self, data: bytes, total_size: int = None, headers: dict = None) -> requests.Response:
+        """Sends `data` starting at the committed offset. If `total_size` is given, this finalizes the upload.
+        Without data and `total_size`, only asks GCS for the committed offset.
+        After a connection error or a 429/5xx response, GCS may have persisted all, some or none of `data`, so it is
+        asked for the committed offset and only the rest is sent again (up to `UPLOAD_RETRIES` times)."""
+        start = self.committed
+        for attempt in range(UPLOAD_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(UPLOAD_RETRY_BACKOFF * 2 ** (attempt - 1))
+                try:
+                    # status query (finalizes the upload if `total_size` bytes have been persisted)
+                    response = self._send(b"", total_size=total_size, headers=headers)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                    continue
+                if response.status_code in UPLOAD_RETRY_STATUS_CODES:
+                    error = f"HTTP {response.status_code}: {response.text}"
+                    continue
+                self._handle_response(response, total_size)
+                if self.result is not None or (total_size is None and self.committed - start >= len(data)):
+                    return response  # everything had been persisted (and the upload finalized)
+            try:
+                response = self._send(data[self.committed - start:], total_size=total_size, headers=headers)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.status_code not in UPLOAD_RETRY_STATUS_CODES:
+                    return self._handle_response(response, total_size)
+                error = f"HTTP {response.status_code}: {response.text}"
+            if attempt < UPLOAD_RETRIES:
+                print(f"Request of resumable upload of {self.dest_file_name} failed ({error}), asking for the "
+                      f"committed offset and trying again (attempt {attempt + 1} of {UPLOAD_RETRIES}).")
+        raise Exception(f"Resumable upload of {self.dest_file_name} failed after {UPLOAD_RETRIES} retries: {error}")
+
+    def _handle_response(self, response: requests.Response, total_size: int = None) -> requests.Response:
+        if response.status_code == 308:  # chunk accepted, upload incomplete
+            committed_range = response.headers.get("Range")  # eg. "bytes=0-8388607"
+            self.committed = int(committed_range.split("-")[-1]) + 1 if committed_range else 0
+        elif response.status_code in (200, 201):
+            self.result = response.json()
+            self.committed = int(self.result.get("size", total_size or 0))
+        else:
+            raise Exception(f"Resumable upload of {self.dest_file_name} failed with HTTP {response.status_code}: "
+                            f"{response.text}")
+        return response
+
+    def write(self, data: bytes) -> int:
+        if self.session_url is None:
+            self._open_session()
+        if self.checksums is not None:
+            self.checksums.update(data)
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            offset_before = self.committed
+            self._put(bytes(self._buffer[:self.chunk_size]))
+            if self.committed <= offset_before:
+                raise Exception(f"Resumable upload of {self.dest_file_name} did not make progress.")
+            # GCS may persist less than was sent; keep whatever was not committed in the buffer
+            del self._buffer[:self.committed - offset_before]
+        return len(data)
+
+    def close(self) -> dict:
+        """Sends the remaining buffered data and finalizes the upload.
+        :return: the GCS object resource of the uploaded file
+        """
+        if self.result is not None:
+            return self.result
+        if self.session_url is None:
+            self._open_session()  # empty file
+        total_size = self.committed + len(self._buffer)
+        headers = None
+        if self.checksums is not None:
+            headers = {"X-Goog-Hash": self.checksums.goog_hash_header()}
+        self._put(bytes(self._buffer), total_size=total_size, headers=headers)
+        self._buffer = bytearray()
+        self._http.close()
+        print(f"File {self.dest_file_name} uploaded successfully via streaming to GCS bucket {self.bucket_name}, "
+              f"size: {total_size}")
+        return self.result
+
+    def abort(self):
+        """Cancels the upload session so that no (partial) object is created in GCS."""
+        self._aborted = True
+        if self.session_url is not None and self.result is None:
+            print(f"Aborting resumable upload of {self.dest_file_name}.")
+            try:
+                self._http.delete(self.session_url, timeout=self.timeout)
+            except Exception as e:
+                print(f"Could not cancel resumable upload session: {e}")
+        self._buffer = bytearray()
+        self._http.close()
+
+
+class StreamingReader:
+    """Readable file-like object that streams a GCS file (`blob`, as returned by `get_blob` or `list_files`).
+
+    `read()` fetches `chunk_size` bytes per request, so memory use does not depend on the file size. The generation
+    of `blob` is read, also if the file is replaced in the meantime. Ranged reads are not validated by GCS, so the
+    checksums of the data are computed while it is read; `verify()` compares them with the checksums of the file.
+    If `verify_at_end`, `read` does that by itself when it reaches the end of the file, so that whatever consumes the
+    data (eg. an FTP upload) fails before it is complete.
+    """
+
+    def __init__(self, blob, chunk_size: int = STREAM_CHUNK_SIZE, verify_at_end: bool = True):
+        self.blob = blob
+        self.verify_at_end = verify_at_end
+        self.checksums = StreamingChecksums()
+        self._reader = blob.open("rb", chunk_size=chunk_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    @property
+    def bytes_read(self) -> int:
+        return self.checksums.size
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._reader.read(size)
+        self.checksums.update(data)
+        if not data and size != 0 and self.verify_at_end:
+            self.verify()
+        return data
+
+    def verify(self):
+        """Checks that the complete file has been read unchanged (call it after the last `read`).
+        :raises Exception: if size or checksums differ from the file in GCS
+        """
+        if self.blob.size is not None and self.bytes_read != self.blob.size:
+            raise Exception(f"Read {self.bytes_read} bytes of {self.blob.name}, but it has {self.blob.size} bytes.")
+        if self.blob.crc32c is not None and self.checksums.crc32c != self.blob.crc32c:
+            raise Exception(f"CRC32C of the data read from {self.blob.name} does not match the file in GCS.")
+        if self.blob.md5_hash is not None and self.checksums.md5 != self.blob.md5_hash:
+            raise Exception(f"MD5 of the data read from {self.blob.name} does not match the file in GCS.")
+
+    def close(self):
+        self._reader.close()
+
+
+def use_composite_upload(size: int or None, threshold: int or None = COMPOSITE_UPLOAD_THRESHOLD) -> bool:
+    """Returns True if a file of `size` bytes should be uploaded as parallel composite upload (never if the size is
+    not known or `threshold` is None)."""
+    return threshold is not None and size is not None and size >= threshold
+
+
+class ParallelCompositeUpload:
+    """Writable file-like object that uploads the data written to it as parts of `part_size` bytes, up to
+    `max_workers` at the same time, and composes them into `dest_file_name` on `close()`. A single upload stream
+    (see `ResumableUploadStream`) is limited to the throughput of one connection; this one uses several.
+
+    The parts are temporary objects in `COMPOSITE_PARTS_FOLDER`. More than `MAX_COMPOSE_SOURCES` parts are composed
+    in several levels. The parts are deleted when the upload is complete or aborted. At most `max_workers` parts (plus
+    the one being written) are held in memory: `write` waits while all workers are busy.
+
+    The result is a composite object, which has a CRC32C but no MD5 checksum. The CRC32C of the data is computed while
+    it is written and compared with the one of the composed object. It has the same interface as
+    `ResumableUploadStream` (`write`, `close`, `abort`, `result`, `bytes_written`), but cannot be resumed.
+    """
+
+    def __init__(self, dest_file_name: str, bucket_name: str = DEFAULT_BUCKET, content_type: str = None,
+                 metadata: dict = None, content_encoding: str = None, part_size: int = COMPOSITE_PART_SIZE,
+                 max_workers: int = COMPOSITE_UPLOAD_WORKERS, timeout: int = None):
+        self.dest_file_name = dest_file_name
+        self.bucket_name = bucket_name
+        self.content_type = infer_content_type(dest_file_name, content_type)
+        self.metadata = metadata
+        self.content_encoding = content_encoding
+        self.part_size = part_size
+        self.timeout = timeout
+        self.result = None  # object resource of the composed file
+        self.checksums = StreamingChecksums()
+        self.part_prefix = f"{COMPOSITE_PARTS_FOLDER}{dest_file_name}/{uuid.uuid4().hex}/"
+        self._bucket = get_storage_client().bucket(bucket_name)
+        self._buffer = bytearray()
+        self._parts = []  # names of the parts, in order
+        self._temp_objects = []  # names of all temporary objects (parts and intermediate composites)
+        self._uploads = []  # futures of the part uploads
+        self._error = None  # first error of a part upload
+        self._aborted = False
+        self._free_workers = threading.Semaphore(max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="composite-upload")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    @property
+    def bytes_written(self) -> int:
+        return self.checksums.size
+
+    @property
+    def failed(self) -> bool:
+        """True if a part upload failed or the upload was aborted: writing to it raises then."""
+        return self._error is not None or self._aborted
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise Exception(f"Parallel composite upload of {self.dest_file_name} failed: {self._error}") \
+                from self._error
+        if self._aborted:
+            raise Exception(f"Parallel composite upload of {self.dest_file_name} was aborted.")
+
+    def _upload_part(self, part_name: str, data: bytes):
+        try:
+            kwargs = {"timeout": self.timeout} if self.timeout is not None else {}
+            with metrics.phase("gcs_upload", log=False) as upload:
+                upload.bytes = len(data)
+                # if_generation_match=0: the part is new, so the client library can safely retry a failed request
+                self._bucket.blob(part_name).upload_from_string(data, content_type="application/octet-stream",
+                                                                checksum="crc32c", if_generation_match=0, **kwargs)
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+            raise
+        finally:
+            self._free_workers.release()
+
+    def _submit_part(self, data: bytes):
+        self._raise_error()
+        self._free_workers.acquire()  # released when the part is uploaded
+        part_name = f"{self.part_prefix}{len(self._parts):06d}"
+        self._parts.append(part_name)
+        self._temp_objects.append(part_name)
+        # copy_context: count the uploads in the metrics of the current run
+        self._uploads.append(self._executor.submit(contextvars.copy_context().run, self._upload_part, part_name,
+                                                   data))
+
+    def write(self, data: bytes) -> int:
+        self._raise_error()
+        self.checksums.update(data)
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._submit_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def _compose(self, source_names: list, dest_blob):
+        with metrics.phase("gcs_compose", log=False):
+            dest_blob.compose([self._bucket.blob(source_name) for source_name in source_names])
+
+    def _compose_all(self) -> object:
+        """Composes the parts into the destination file, in several levels if there are too many for one request.
+        :return: the blob of the destination file
+        """
+        sources = self._parts
+        level = 0
+        while len(sources) > MAX_COMPOSE_SOURCES:
+            groups = [sources[i:i + MAX_COMPOSE_SOURCES] for i in range(0, len(sources), MAX_COMPOSE_SOURCES)]
+            sources = [f"{self.part_prefix}compose-{level}-{i:06d}" for i in range(len(groups))]
+            self._temp_objects += sources
+            composes = [self._executor.submit(contextvars.copy_context().run, self._compose, group,
+                                              self._bucket.blob(intermediate_name))
+                        for group, intermediate_name in zip(groups, sources)]
+            for compose in composes:
+                compose.result()
+            level += 1
+        dest_blob = self._bucket.blob(self.dest_file_name)
+        dest_blob.content_type = self.content_type
+        if self.content_encoding is not None:
+            dest_blob.content_encoding = self.content_encoding
+        if self.metadata is not None:
+            dest_blob.metadata = self.metadata
+        self._compose(sources, dest_blob)
+        return dest_blob
+
+    def _delete_temp_objects(self):
+        from google.api_core.exceptions import NotFound
+
+        def delete(object_name: str):
+            try:
+                self._bucket.blob(object_name).delete()
+            except NotFound:
+                pass
+            except Exception as e:  # the lifecycle rule of COMPOSITE_PARTS_FOLDER will take care of it
+                print(f"Could not delete temporary object {object_name}: {e}")
+
+        list(self._executor.map(delete, self._temp_objects))
+        self._temp_objects = []
+
+    def close(self) -> dict:
+        """Uploads the rest of the data, composes the parts into the destination file and deletes the parts.
+        :return: the GCS object resource of the uploaded file
+        """
+        if self.result is not None:
+            return self.result
+        try:
+            if self._buffer or not self._parts:
+                self._submit_part(bytes(self._buffer))
+                self._buffer = bytearray()
+            for upload in self._uploads:
+                upload.result()
+            self._raise_error()
+            dest_blob = self._compose_all()
+            if dest_blob.crc32c != self.checksums.crc32c:
+                dest_blob.delete()
+                raise Exception(f"CRC32C of the composed file {self.dest_file_name} does not match the uploaded data.")
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            self.abort()
+            raise
+        self._delete_temp_objects()
+        self._executor.shutdown()
+        self.result = {"name": dest_blob.name, "bucket": self.bucket_name, "size": str(dest_blob.size),
+                       "crc32c": dest_blob.crc32c, "md5Hash": dest_blob.md5_hash,
+                       "componentCount": dest_blob.component_count, "selfLink": dest_blob.self_link}
+        print(f"File {self.dest_file_name} uploaded successfully as parallel composite upload of {len(self._parts)} "
+              f"parts to GCS bucket {self.bucket_name}, size: {dest_blob.size}")
+        return self.result
+
+    def abort(self):
+        """Stops the upload and deletes the parts that were uploaded, so that no (partial) file is created in GCS."""
+        if self.result is not None or self._aborted:
+            return
+        self._aborted = True
+        print(f"Aborting parallel composite upload of {self.dest_file_name}.")
+        for upload in self._uploads:
+            upload.cancel()
+        wait(self._uploads)
+        self._buffer = bytearray()
+        self._delete_temp_objects()
+        self._executor.shutdown()
@@ -0,0 +1,168 @@
+import contextvars
+import ftplib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from gcf_src.config import cfg
+from gcf_src.monitoring import metrics
+from gcf_src.storage import ftp
+from gcf_src.storage import gcs
+from gcf_src.storage.ftp_to_gcs import return_result
+
+# files are uploaded as "{name}{TEMP_SUFFIX}" and renamed when complete (with "atomic": true)
+TEMP_SUFFIX = ".part"
+
+
+def upload_atomically(reader, file_name: str, ftp_session: ftp.FtpSession, target_folder: str,
+                      atomic: bool = True) -> int:
+    """Streams `reader` to `file_name` on the FTP. If `atomic`, via a temporary file that is renamed when complete
+    (and deleted if the upload fails).
+    :return: number of bytes uploaded
+    """
+    temp_file_name = file_name + TEMP_SUFFIX if atomic else None
+    try:
+        return ftp.upload_stream_to_ftp(reader, file_name=file_name, ftp_folder=target_folder, session=ftp_session,
+                                        temp_file_name=temp_file_name)
+    except Exception:
+        ftp_session.close()  # the control connection may be out of sync after a broken transfer
+        if temp_file_name is not None:
+            try:
+                ftp.delete_file(temp_file_name, ftp_folder=target_folder, session=ftp_session, check_exists=False)
+            except ftplib.all_errors as e:
+                print(f"Could not delete {temp_file_name} from FTP: {e}")
+        raise
+
+
+def export_file(blob, ftp_session: ftp.FtpSession, gcs_bucket: str, target_folder: str, target_file_name: str,
+                add_fin_file: bool = False, atomic: bool = True) -> dict:
+    """Streams the GCS file `blob` (from `gcs.list_files` or `get_blob`) to `target_file_name` on the FTP and then adds
+    its .fin file (if `add_fin_file`). At most one chunk of the file is held in memory. The data is checked against
+    the checksums of the file in GCS before the upload is completed (see `gcs.StreamingReader`).
+    :return: {"file": the GCS location, "ftp_file": the file name on the FTP, "size": its size in bytes,
+              "crc32c": its base64-encoded CRC32C}
+    """
+    print(f"Exporting file {blob.name} from GCS bucket {gcs_bucket} to FTP folder {target_folder} as "
+          f"{target_file_name}")
+
+    with gcs.StreamingReader(blob) as reader:
+        # the reader checks the checksums at the end of the file, so a corrupt file is not renamed to its final name
+        size = upload_atomically(reader, file_name=target_file_name, ftp_session=ftp_session,
+                                 target_folder=target_folder, atomic=atomic)
+    if add_fin_file:
+        finfile_name = ftp.fin_file_name(target_file_name)
+        upload_atomically(BytesIO(), file_name=finfile_name, ftp_session=ftp_session, target_folder=target_folder,
+                          atomic=atomic)
+        print(f"Uploaded fin file {finfile_name} to FTP")
+    print(f"Exported file {blob.name} ({size} bytes) to FTP as {target_file_name}")
+    return {"file": blob.name, "ftp_file": target_file_name, "size": size, "crc32c": reader.checksums.crc32c}
+
+
+def prewarm():
+    """Creates the clients this script needs (called by `script_runner.prewarm` when the instance starts)."""
+    gcs.get_storage_client()
+    cfg.secret_mgr_client()
+
+
+def run_script(**kwargs):
+    """Exports file(s) from GCS to an FTP server, streaming them chunk by chunk (memory use does not depend on the file
+    size).
+    kwargs.payload contains:
+    - target_ftp: FTP to export to (eg. "aa_classifications_ftp", see cfg.FTP_SERVERS) - MANDATORY
+    - target_folder: FTP folder to export to (eg. "/incoming") - OPTIONAL, defaults to the folder of the FTP's config
+    - gcs_bucket: GCS bucket to export from - OPTIONAL, defaults to cfg.GCS_DEFAULT_BUCKET
+    - target_file_name: file name on the FTP (only for gcs_file_name) - OPTIONAL, defaults to the GCS file name
+      without its folder
+    - add_fin_file: if True, adds a .fin file for each file after it has been uploaded (for Adobe Analytics
+      classification imports) - OPTIONAL, defaults to False
+    - atomic: if True, files (and .fin files) are uploaded under a temporary name ("{name}.part") and renamed when they
+      are complete, so that nobody picks up a half-written file - OPTIONAL, defaults to True
+    - max_parallel_transfers: max. number of files uploaded at the same time (= max. number of connections to the
+      FTP server) - OPTIONAL, defaults to 1
+    - ftp_timeout: timeout for FTP connection (eg. 10) - OPTIONAL, defaults to None (default FTP lib timeout)
+    - workflow_callback_url: URL to call when the workflow is done - OPTIONAL
+    - one of:
+        - gcs_file_name: GCS location of a single file (eg. "classifications/products.tab")
+        - gcs_prefix: GCS folder or name prefix (eg. "classifications/"), exports all files starting with it (oldest
+          first). Combine with gcs_file_name_re (regex for the file names after the prefix) to select some of them.
+    """
+    print(f"Starting script to export file(s) from GCS to FTP with locals: {locals()}")
+
+    payload = kwargs.get("payload", {})
+    target_ftp = payload.get("target_ftp")
+    if target_ftp is None:
+        raise Exception("target_ftp must be provided in payload.")
+    target_ftp_cfg = cfg.get_ftp_config(target_ftp)
+    target_folder = payload.get("target_folder") or target_ftp_cfg.folder
+    gcs_bucket = payload.get("gcs_bucket") or cfg.GCS_DEFAULT_BUCKET
+    gcs_file_name = payload.get("gcs_file_name")
+    gcs_prefix = payload.get("gcs_prefix")
+    gcs_file_name_re = payload.get("gcs_file_name_re")
+    if gcs_file_name is None and gcs_prefix is None:
+        raise Exception("Either gcs_file_name or gcs_prefix must be provided in payload.")
+    add_fin_file = payload.get("add_fin_file") or False
+    atomic = payload.get("atomic", True) is not False
+    max_parallel_transfers = int(payload.get("max_parallel_transfers") or 1)
+    ftp_timeout = payload.get("ftp_timeout")
+    target_host = target_ftp_cfg.address
+    target_user = target_ftp_cfg.user
+    target_pwd = target_ftp_cfg.passwd
+    print(f"target_host: {target_host}, target_folder: {target_folder}, gcs_bucket: {gcs_bucket}, "
+          f"gcs_file_name: {gcs_file_name}, gcs_prefix: {gcs_prefix}, gcs_file_name_re: {gcs_file_name_re}")
+
+    if gcs_file_name is not None:
+        blob = gcs.get_storage_client().bucket(gcs_bucket).get_blob(blob_name=gcs_file_name)
+        if blob is None:
+            raise Exception(f"File {gcs_file_name} not found in GCS bucket {gcs_bucket}.")
+        blobs = [blob]
+        target_file_names = [payload.get("target_file_name") or gcs_file_name.split("/")[-1]]
+    else:
+        blobs = gcs.list_files(prefix=gcs_prefix, bucket_name=gcs_bucket, file_name_re=gcs_file_name_re)
+        if len(blobs) == 0:
+            msg = "no_matches_in_gcs"
+            print(msg)
+            return return_result(result=msg, workflow_instructions={"exit": True})
+        target_file_names = [blob.name.split("/")[-1] for blob in blobs]
+        print(f"Found the following files in GCS: {[blob.name for blob in blobs]}")
+
+    def refresh_login():
+        # the login was rejected, so the cached secret may be outdated
+        refreshed_cfg = cfg.get_ftp_config(target_ftp, refresh=True)
+        return refreshed_cfg.user, refreshed_cfg.passwd
+
+    ftp_files = []
+    file_results = []
+    with ftp.FtpSessionPool(timeout=ftp_timeout, max_connections_per_host=max_parallel_transfers,
+                            refresh_login=refresh_login) as ftp_pool:
+
+        def export(blob, target_file_name: str) -> dict:
+            with metrics.file_scope(blob.name), ftp_pool.session(target_host, target_user, target_pwd) as session:
+                return export_file(blob, ftp_session=session, gcs_bucket=gcs_bucket, target_folder=target_folder,
+                                   target_file_name=target_file_name, add_fin_file=add_fin_file, atomic=atomic)
+
+        with ThreadPoolExecutor(max_workers=max_parallel_transfers) as executor:
+            # copy_context: count the exports in the metrics of this run
+            exports = [executor.submit(contextvars.copy_context().run, export, blob, target_file_name)
+                       for blob, target_file_name in zip(blobs, target_file_names)]
+            for blob, future in zip(blobs, exports):
+                try:
+                    exported = future.result()
+                except Exception as e:
+                    for pending in exports:
+                        pending.cancel()
+                    file_results.append({"file": blob.name, "result": "error", "result_detail": str(e)})
+                    if not isinstance(e, ftplib.all_errors):
+                        raise
+                    # FTP errors happen quite often, so we don't want to raise the Exception to the top
+                    print(f"Error while exporting file {blob.name} to FTP: {e}")
+                    script_result = return_result(result="ftp_error", result_detail=str(e),
+                                                  workflow_instructions={"retry": True})
+                    script_result.update({"ftp_files": ftp_files, "files": file_results})
+                    return script_result
+                ftp_files.append(exported["ftp_file"])
+                file_results.append({"result": "done", **exported})
+    return {"result": "done", "ftp_files": ftp_files, "files": file_results}
+
+
+if __name__ == '__main__':
+    run_script(payload={'target_ftp': 'my_test_ftp', 'target_folder': '/gcp-workflows/', 'gcs_prefix': '__test/',
+                        'gcs_file_name_re': r'.*\.tab$', 'add_fin_file': True, 'script': 'gcs_to_ftp'})
@@ -0,0 +1,71 @@
+from gcf_src.storage import gcs
+
+# folder in the target bucket for the manifests of incremental FTP to GCS imports
+MANIFEST_FOLDER = "_ftp_to_gcs_manifests/"
+# how often a manifest update is retried if another run changed the manifest in the meantime
+MAX_SAVE_ATTEMPTS = 5
+
+
+def default_manifest_location(source_ftp: str, source_folder: str) -> str:
+    """Returns the default manifest location for imports from `source_folder` on the FTP `source_ftp`."""
+    return f"{MANIFEST_FOLDER}{source_ftp}/{source_folder.strip('/') or '_root'}/manifest.json"
+
+
+class Manifest:
+    """Record of the files that were imported from an FTP folder (name, size, modification time, checksum and GCS
+    locations), stored as JSON in GCS. Used by incremental imports to skip files that have not changed since they were
+    imported.
+
+    Updates are atomic: `save()` writes with a generation precondition. If another run changed the manifest in the
+    meantime, it reloads the manifest, applies this run's records again and retries, so no records get lost.
+    """
+
+    def __init__(self, location: str, bucket_name: str = gcs.DEFAULT_BUCKET):
+        self.location = location
+        self.bucket_name = bucket_name
+        self.files = {}  # FTP file name -> record
+        self.generation = 0  # generation of the manifest in GCS, 0 = does not exist yet
+        self._pending = {}  # records of this run that have not been saved yet
+
+    def load(self) -> "Manifest":
+        content, self.generation = gcs.read_json_with_generation(self.location, bucket_name=self.bucket_name)
+        self.files = (content or {}).get("files", {})
+        self.files.update(self._pending)
+        print(f"Loaded manifest {self.location} with {len(self.files)} files (generation {self.generation}).")
+        return self
+
+    @staticmethod
+    def fingerprint(entry) -> dict:
+        """Returns what identifies a version of the FTP listing `entry`."""
+        return {"size": entry.size, "modified": entry.modified.isoformat() if entry.modified is not None else None}
+
+    def is_imported(self, entry, gcs_locations: list) -> bool:
+        """Returns True if the FTP listing `entry` was already imported unchanged to `gcs_locations`."""
+        record = self.files.get(entry.name)
+        if record is None or entry.size is None or entry.modified is None:
+            return False
+        return ({"size": record.get("size"), "modified": record.get("modified")} == self.fingerprint(entry)
+                and record.get("gcs_locations") == list(gcs_locations))
+
+    def record(self, entry, gcs_locations: list, checksums: dict = None):
+        """Records that the FTP listing `entry` was imported to `gcs_locations` (saved with the next `save()`)."""
+        record = dict(self.fingerprint(entry), gcs_locations=list(gcs_locations), checksums=checksums or {})
+        self.files[entry.name] = record
+        self._pending[entry.name] = record
+
+    def save(self):
+        """Writes the records of this run to GCS (atomically, see class docstring)."""
+        if len(self._pending) == 0:
+            return
+        for attempt in range(1, MAX_SAVE_ATTEMPTS + 1):
+            try:
+                self.generation = gcs.write_json(self.location, {"files": self.files}, bucket_name=self.bucket_name,
+                                                 if_generation_match=self.generation)
+                print(f"Saved manifest {self.location} with {len(self._pending)} new records "
+                      f"(generation {self.generation}).")
+                self._pending = {}
+                return
+            except gcs.GenerationMismatch as e:
+                print(f"{e} Reloading manifest and retrying (attempt {attempt} of {MAX_SAVE_ATTEMPTS}).")
+                self.load()
+        raise Exception(f"Could not save manifest {self.location} after {MAX_SAVE_ATTEMPTS} attempts.")
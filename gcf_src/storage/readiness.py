@@ -0,0 +1,99 @@
+import ftplib
+import time
+from datetime import datetime, timezone, timedelta
+from typing import NamedTuple
+
+from gcf_src.monitoring import metrics
+from gcf_src.storage import ftp
+
+# seconds since the last modification after which a file on the FTP is considered completely uploaded
+FILE_READY_AFTER_SECONDS = 30
+# LIST output only contains the modification time to the minute
+LIST_TIME_PRECISION = timedelta(minutes=1)
+# seconds until the first poll of a file that is not ready yet. Doubles with every poll up to MAX_POLL_INTERVAL.
+POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 8
+# max. seconds a run waits for files to become ready before it lets the workflow retry later
+READY_WAIT_SECONDS = 60
+
+
+class FileState(NamedTuple):
+    """Size and modification date of a file on the FTP. None if the server does not tell."""
+    size: int = None
+    modified: datetime = None  # timezone-aware (UTC)
+
+
+class Readiness(NamedTuple):
+    """Result of `wait_until_ready`."""
+    ready: bool
+    state: FileState  # last known state of the file
+    waited: float  # seconds spent waiting for the file
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def seconds_since(modified: datetime or None) -> float:
+    """Returns the seconds since the UTC `modified` (0 if it is unknown or in the future, eg. because of clock skew)."""
+    if modified is None:
+        return 0.0
+    return max(0.0, (utc_now() - modified).total_seconds())
+
+
+def is_file_ready(modification_date: datetime, ready_after_seconds: int = FILE_READY_AFTER_SECONDS) -> bool:
+    """Returns True if a file with the UTC `modification_date` has not been modified for `ready_after_seconds`."""
+    return modification_date <= utc_now() - timedelta(seconds=ready_after_seconds)
+
+
+def get_file_state(file_name: str, ftp_session: ftp.FtpSession, ftp_folder: str) -> FileState:
+    """Returns the current size (SIZE) and modification date (MDTM) of `file_name`."""
+    try:
+        modified = ftp.get_file_modification_date(file_name=file_name, ftp_folder=ftp_folder, session=ftp_session)
+    except ftplib.error_perm as e:
+        print(f"Could not get modification date of {file_name} from FTP: {e}")
+        modified = None
+    return FileState(size=ftp.get_file_size(file_name=file_name, ftp_folder=ftp_folder, session=ftp_session),
+                     modified=modified)
+
+
+def wait_until_ready(entry: ftp.FtpEntry, ftp_session: ftp.FtpSession, ftp_folder: str,
+                     ready_after_seconds: int = FILE_READY_AFTER_SECONDS, deadline: float = None,
+                     poll_interval: float = POLL_INTERVAL, max_poll_interval: float = MAX_POLL_INTERVAL,
+                     sleep=time.sleep) -> Readiness:
+    """Waits until the FTP file `entry` (from a listing) is completely uploaded, ie. it has not changed for
+    `ready_after_seconds`. We cannot be 100% sure, but a file that is still being uploaded changes its size and
+    modification date.
+
+    A file whose modification date (from the listing if it is precise enough, otherwise MDTM) is old enough is ready
+    right away. Otherwise its SIZE and MDTM are polled on `ftp_session`, first after `poll_interval` seconds, then with
+    doubling intervals up to `max_poll_interval`. The file is ready when its modification date is old enough or when
+    it has not changed between polls for `ready_after_seconds` (measured with our own clock, so a server clock that is
+    off does not matter). Every change starts that window anew.
+    Gives up as soon as the file cannot be ready before `deadline` (a `time.monotonic()` value, None = no limit).
+    """
+    started = time.monotonic()
+    # a LIST time of 10:30 can mean any time up to 10:30:59
+    listed = entry.modified + LIST_TIME_PRECISION if entry.source == "LIST" and entry.modified is not None \
+        else entry.modified
+    if listed is not None and is_file_ready(listed, ready_after_seconds):
+        return Readiness(ready=True, state=FileState(size=entry.size, modified=entry.modified), waited=0.0)
+
+    with metrics.phase("ftp_wait_ready", file=entry.name):
+        state = get_file_state(entry.name, ftp_session=ftp_session, ftp_folder=ftp_folder)
+        unchanged_since = time.monotonic()
+        interval = poll_interval
+        while True:
+            # the file cannot be ready earlier, even if it does not change anymore
+            wait_for = ready_after_seconds - max(seconds_since(state.modified), time.monotonic() - unchanged_since)
+            if wait_for <= 0:
+                return Readiness(ready=True, state=state, waited=time.monotonic() - started)
+            if deadline is not None and time.monotonic() + wait_for > deadline:
+                return Readiness(ready=False, state=state, waited=time.monotonic() - started)
+            sleep(min(interval, wait_for))
+            interval = min(2 * interval, max_poll_interval)
+            new_state = get_file_state(entry.name, ftp_session=ftp_session, ftp_folder=ftp_folder)
+            if new_state != state:
+                print(f"File {entry.name} is still changing on the FTP: {state} -> {new_state}")
+                state = new_state
+                unchanged_since = time.monotonic()
@@ -0,0 +1,95 @@
+import threading
+from os import environ
+
+from gcf_src.config import cfg
+
+# seconds kept free at the end of a job for committing files (deletes, .fin files, manifest) and the workflow callback
+BUDGET_RESERVE_SECONDS = 30
+# assumed throughput of a transfer (bytes/s) until the first transfer of the job is done
+ASSUMED_THROUGHPUT = float(environ.get("ASSUMED_THROUGHPUT", 5e6))
+# seconds a transfer takes on top of moving its bytes (listing, commands, finalizing the upload)
+TRANSFER_OVERHEAD_SECONDS = 2
+
+
+class TransferBudget:
+    """Decides which transfers of a batch can still be started before the deadline of the job (see
+    `cfg.seconds_left`), so that the job stops before it is killed mid-file and can hand the rest on to the next
+    invocation instead.
+
+    The duration of a transfer is estimated from its size and the throughput observed for the transfers of the job so
+    far (`record`). Transfers are numbered in the order they have to be committed in (`plan`) and are decided strictly
+    in that order, whichever of them asks first (`try_start`). Once one of them does not fit anymore, none of the later
+    ones is started, so the files that are left are always the last ones. The first transfer of the job is always
+    started, so every invocation makes progress.
+    """
+
+    def __init__(self, reserve_seconds: float = BUDGET_RESERVE_SECONDS, throughput: float = None):
+        self.reserve_seconds = reserve_seconds
+        self._assumed_throughput = throughput or ASSUMED_THROUGHPUT  # eg. from the continuation of the last job
+        self._bytes = 0
+        self._seconds = 0.0
+        self._sizes = []  # sizes of the transfers, in commit order
+        self._started = []  # decisions (True = started) for the transfers up to the next number to decide
+        self._stopped_at = None  # number of the first transfer that was not started
+        self._lock = threading.Lock()
+
+    @property
+    def throughput(self) -> float:
+        """Observed throughput of a transfer in bytes/s (the assumed one until a transfer is done)."""
+        with self._lock:
+            return self._throughput()
+
+    def _throughput(self) -> float:
+        if self._seconds > 0 and self._bytes > 0:
+            return self._bytes / self._seconds
+        return self._assumed_throughput
+
+    def estimate(self, size: int or None) -> float:
+        """Returns the estimated seconds to transfer a file of `size` bytes (None = unknown, counts as empty)."""
+        with self._lock:
+            return self._estimate(size)
+
+    def _estimate(self, size: int or None) -> float:
+        return (size or 0) / self._throughput() + TRANSFER_OVERHEAD_SECONDS
+
+    def record(self, size: int, seconds: float):
+        """Records a transfer of `size` bytes that took `seconds`."""
+        with self._lock:
+            self._bytes += size
+            self._seconds += seconds
+
+    def plan(self, sizes: list):
+        """Sets the sizes in bytes (None = unknown) of the transfers of the job, in commit order."""
+        with self._lock:
+            self._sizes = list(sizes)
+
+    def try_start(self, number: int) -> bool:
+        """Returns True if transfer `number` (0-based, in commit order, see `plan`) can be started.
+
+        The transfers before `number` that did not ask yet are decided first, so a transfer that asks early does not
+        take the time of an earlier one. Never blocks, so it can be called from the event loop of the asyncio engine.
+        """
+        with self._lock:
+            while len(self._started) <= number:
+                self._started.append(self._decide(len(self._started)))
+            return self._started[number]
+
+    def _decide(self, number: int) -> bool:
+        if self._stopped_at is not None:
+            return False
+        if number == 0:
+            return True
+        seconds_left = cfg.seconds_left()
+        size = self._sizes[number] if number < len(self._sizes) else None
+        estimate = self._estimate(size)
+        if seconds_left is not None and estimate > seconds_left - self.reserve_seconds:
+            print(f"Not starting transfer {number} ({size} bytes, estimated {estimate:.0f}s): only "
+                  f"{seconds_left:.0f}s left of the time budget of this job.")
+            self._stopped_at = number
+            return False
+        return True
+
+    @property
+    def stopped(self) -> bool:
+        """True if transfers were left out because of the deadline."""
+        return self._stopped_at is not None
@@ -0,0 +1,117 @@
+import codecs
+from typing import NamedTuple
+
+from gcf_src.monitoring import metrics
+
+NEWLINES = (None, "\n", "\r\n")
+
+
+class Transcoding(NamedTuple):
+    """How to convert the text of a file while it is transferred."""
+    source_encoding: str
+    target_encoding: str = "utf-8"
+    strip_bom: bool = True  # remove a byte order mark at the start of the file
+    newline: str = None  # None = keep line endings, "\n" or "\r\n" = convert all line endings ("\r\n", "\r", "\n")
+    errors: str = "strict"  # what to do with bytes that are not valid in source_encoding (see `codecs`)
+
+
+def get_transcoding(source_encoding: str, target_encoding: str = None, strip_bom: bool = None, newline: str = None,
+                    errors: str = None) -> Transcoding:
+    """Returns the `Transcoding` for the payload options (None = default).
+    :raises Exception: if an encoding, `newline` or `errors` is not supported
+    """
+    transcoding = Transcoding(source_encoding=source_encoding, target_encoding=target_encoding or "utf-8",
+                              strip_bom=strip_bom is not False, newline=newline or None, errors=errors or "strict")
+    for encoding in (transcoding.source_encoding, transcoding.target_encoding):
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            raise Exception(f"Unsupported encoding: {encoding}.")
+    if transcoding.newline not in NEWLINES:
+        raise Exception(f"newline must be one of {list(NEWLINES)}, got {newline!r}.")
+    try:
+        codecs.lookup_error(transcoding.errors)
+    except LookupError:
+        raise Exception(f"Unsupported encoding error handler: {errors}.")
+    return transcoding
+
+
+class TranscodingError(Exception):
+    """The data is not valid in the source encoding (or cannot be represented in the target encoding). Trying again
+    does not help, so this is not an `FtpTransferError`."""
+
+
+class Transcoder:
+    """Converts text from one encoding to another chunk by chunk. Characters (and "\\r\\n" line endings) that are split
+    across chunks are kept until the next chunk completes them."""
+
+    def __init__(self, transcoding: Transcoding):
+        self.transcoding = transcoding
+        self._decoder = codecs.getincrementaldecoder(transcoding.source_encoding)(errors=transcoding.errors)
+        self._encoder = codecs.getincrementalencoder(transcoding.target_encoding)(errors=transcoding.errors)
+        self._at_start = True  # no text has been decoded yet
+        self._pending_cr = ""  # "\r" at the end of the last chunk, if newlines are converted
+
+    def transcode(self, data: bytes, final: bool = False) -> bytes:
+        """Returns the converted `data` (as far as it can be converted yet). Pass `final=True` with the last chunk.
+        :raises TranscodingError: if `data` cannot be converted (with errors="strict")
+        """
+        try:
+            return self._transcode(data, final)
+        except UnicodeError as e:
+            raise TranscodingError(f"Cannot convert from {self.transcoding.source_encoding} to "
+                                   f"{self.transcoding.target_encoding}: {e}")
+
+    def _transcode(self, data: bytes, final: bool) -> bytes:
+        text = self._decoder.decode(data, final=final)
+        if self._at_start and text:
+            self._at_start = False
+            if self.transcoding.strip_bom and text.startswith("\ufeff"):
+                text = text[1:]
+        if self.transcoding.newline is not None:
+            text = self._pending_cr + text
+            self._pending_cr = ""
+            if text.endswith("\r") and not final:
+                text, self._pending_cr = text[:-1], "\r"  # might be the first half of "\r\n"
+            text = text.replace("\r\n", "\n").replace("\r", "\n")
+            if self.transcoding.newline != "\n":
+                text = text.replace("\n", self.transcoding.newline)
+        return self._encoder.encode(text, final=final)
+
+
+def transcode(data: bytes, transcoding: Transcoding) -> bytes:
+    """Converts `data` at once (for files that are in memory anyway)."""
+    return Transcoder(transcoding).transcode(data, final=True)
+
+
+class TranscodingWriter:
+    """Writable file-like object that converts the text written to it (see `Transcoder`) and writes the result to
+    `writer` (eg. a `gcs.ResumableUploadStream` or a `CompressingWriter`). Conversion runs inline in the thread that
+    writes, as the codecs are fast compared to the transfer itself."""
+
+    def __init__(self, writer, transcoding: Transcoding):
+        self.writer = writer
+        self._transcoder = Transcoder(transcoding)
+        self.bytes_written = 0  # source bytes written to this object
+
+    def write(self, data: bytes) -> int:
+        with metrics.phase("transcode", log=False) as transcode_phase:
+            transcode_phase.bytes = len(data)
+            transcoded = self._transcoder.transcode(bytes(data))
+        if transcoded:
+            self.writer.write(transcoded)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def close(self):
+        """Converts what is left and closes `writer`.
+        :return: whatever `writer.close()` returns
+        """
+        transcoded = self._transcoder.transcode(b"", final=True)
+        if transcoded:
+            self.writer.write(transcoded)
+        return self.writer.close()
+
+    def abort(self):
+        """Aborts `writer`."""
+        self.writer.abort()
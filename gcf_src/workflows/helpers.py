@@ -1,24 +1,96 @@
-import google.auth
-import google.auth.transport.requests
-import google.oauth2.credentials
+import threading
+from datetime import datetime, timedelta, timezone
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from gcf_src.config import cfg
+from gcf_src.monitoring import metrics
+
+# the access token is refreshed when it expires in less than this
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# HTTP status codes after which a callback request is retried (with exponential backoff)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class WorkflowCallbackClient:
+    """Sends requests to Workflow callback URLs.
+
+    Keeps the GCP credentials and only refreshes them shortly before their access token expires, and sends all
+    requests through one pooled `requests.Session` (keep-alive) that retries up to `max_retries` times with exponential
+    backoff on 429 and 5xx responses and connection errors. One client is shared per instance, see `callback_client()`,
+    so the jobs of a batch (see `script_runner.run_batch`) each send their callback as soon as they are done, over the
+    same pool of connections.
+    """
+
+    def __init__(self, max_retries: int = 3, backoff_factor: float = 0.5, pool_size: int = 10):
+        self._credentials = None
+        self._lock = threading.Lock()
+        retry = Retry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def access_token(self, force_refresh: bool = False) -> str:
+        """Returns a valid access token, refreshing the credentials only if the token is (about to be) expired."""
+        import google.auth
+        import google.auth.transport.requests
+
+        with self._lock:
+            if self._credentials is None:
+                self._credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+            expiry = self._credentials.expiry  # naive UTC datetime
+            if (force_refresh or self._credentials.token is None or expiry is None
+                    or expiry - datetime.now(timezone.utc).replace(tzinfo=None) < TOKEN_REFRESH_MARGIN):
+                self._credentials.refresh(google.auth.transport.requests.Request(session=self.session))
+            return self._credentials.token
+
+    def send(self, workflow_callback_url: str, request_type: str = "POST", headers: dict = None,
+             data: dict = None) -> requests.Response:
+        """Sends one request to `workflow_callback_url`. If the token was rejected (401), refreshes it and retries once.
+        :return: the response (check its status code)
+        """
+        if request_type.upper() not in ("GET", "POST"):
+            raise ValueError("request_type must be either 'GET' or 'POST'")
+        force_refresh = False
+        with metrics.phase("workflow_callback"):
+            for _ in range(2):
+                request_headers = dict(headers or {})
+                request_headers.update({'Authorization': f'Bearer {self.access_token(force_refresh=force_refresh)}'})
+                # json parameter is necessary, otherwise Workflow will not be able to read it and treat it as JSON
+                wf_response = self.session.request(request_type.upper(), workflow_callback_url,
+                                                   headers=request_headers,
+                                                   json=data if request_type.upper() == "POST" else None)
+                if wf_response.status_code != 401:
+                    break
+                force_refresh = True
+        return wf_response
+
+
+_callback_client = None
+_callback_client_lock = threading.Lock()
+
+
+def callback_client() -> WorkflowCallbackClient:
+    """Returns the callback client of this instance (created on first use and reused across invocations)."""
+    global _callback_client
+    with _callback_client_lock:
+        if _callback_client is None:
+            _callback_client = WorkflowCallbackClient()
+        return _callback_client
 
 
 def generate_gcp_access_token() -> str:
     """
     Authenticates a request to a google workflows callback from a cloud function. See
     https://stackoverflow.com/questions/76234915/trouble-authenticating-a-request-to-a-google-workflows-callback-from-a-cloud-fun
+    The credentials are cached and only refreshed shortly before the token expires.
         :return: access token
     """
-    credentials, project_id = google.auth.default(
-        scopes=["https://www.googleapis.com/auth/cloud-platform"]
-    )
-    request = google.auth.transport.requests.Request()
-    credentials.refresh(request)
-    access_token = credentials.token
-    return access_token
+    return callback_client().access_token()
 
 
 def trigger_workflow_callback(request_type: str = "POST", workflow_callback_url: str = None, headers: dict = None,
@@ -40,22 +112,19 @@ def trigger_workflow_callback(request_type: str = "POST", workflow_callback_url:
     Raises:
         Exception: If the request is unsuccessful and 'raise_error' is True, an Exception is raised.
     """
-    token = generate_gcp_access_token()
-    headers = headers or {}
-    headers.update({'Authorization': f'Bearer {token}'})
-
-    if request_type.upper() == 'GET':
-        wf_response = requests.get(workflow_callback_url, headers=headers)
-    elif request_type.upper() == 'POST':
-        wf_response = requests.post(workflow_callback_url, headers=headers,
-                                    json=data)  # json parameter is necessary, otherwise Workflow will not be able to read it and treat it as JSON
-    else:
-        raise ValueError("request_type must be either 'GET' or 'POST'")
+    wf_response = callback_client().send(workflow_callback_url=workflow_callback_url, request_type=request_type,
+                                         headers=headers, data=data)
+    check_callback_response(wf_response, workflow_callback_url=workflow_callback_url, request_type=request_type,
+                            data=data, raise_error=raise_error)
+    return wf_response
 
+
+def check_callback_response(wf_response: requests.Response, workflow_callback_url: str = None,
+                            request_type: str = "POST", data: dict = None, raise_error: bool = True):
+    """Logs the outcome of a callback request and raises an Exception if it was unsuccessful and `raise_error` is True."""
     if wf_response.status_code == 200:
         print(f"Workflow callback URL {workflow_callback_url} successfully triggered "
               f"\nvia {request_type}"
-              f"\nwith headers: {headers}"
               f"\nbody data (if POST): {data}."
               f"\nResponse: {wf_response}")
     else:
@@ -65,7 +134,6 @@ def trigger_workflow_callback(request_type: str = "POST", workflow_callback_url:
             raise Exception(msg)
         else:
             print(msg)
-    return wf_response
 
 
 def workflow_callback_after_run(workflow_callback_payload: dict = None):
@@ -3,7 +3,10 @@ from typing import Dict
 
 from google.cloud.functions.context import Context
 
-from gcf_src.script_runner import run
+from gcf_src.script_runner import run, prewarm
+
+# optional: import scripts and create their clients while the instance starts (see PREWARM_SCRIPTS env var)
+prewarm()
 
 
 def main_handler(event: Dict, context: Context):
@@ -24,7 +27,7 @@ def main_handler(event: Dict, context: Context):
         event_payload = base64.b64decode(event['data']).decode('utf-8')
         print(f"The event payload is: `{event_payload}`.")
 
-    return run(event_payload)
+    return run(event_payload, event_id=context.event_id)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,64 @@
+import asyncio
+import threading
+import unittest
+
+from gcf_src.storage import aio
+
+
+class BlockingWriter:
+    """Writer whose writes block until `release` is set, like an upload that stalls."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.writing = threading.Event()
+
+    def write(self, data: bytes) -> int:
+        self.writing.set()
+        self.release.wait(10)
+        return len(data)
+
+
+class EventLoopThreadTest(unittest.TestCase):
+
+    def test_close_cancels_transfer_with_full_queue(self):
+        """A transfer cancelled by `close` while its queue is full can still end its queue (see
+        `ftp_to_gcs.stream_file_async`), so closing does not hang."""
+        writer = BlockingWriter()
+        queue_full = threading.Event()
+        cleaned_up = threading.Event()
+
+        with aio.EventLoopThread(max_workers=4) as engine:
+            async def transfer():
+                blocks = aio.BlockQueue(asyncio.get_running_loop(), maxsize=1)
+                uploader = asyncio.create_task(blocks.drain(writer))
+
+                def download():
+                    blocks.write(b"first")  # taken by the uploader, which then stalls
+                    writer.writing.wait(10)
+                    blocks.write(b"second")  # fills the queue
+                    queue_full.set()
+                    blocks.write(b"third")  # waits for room in the queue
+
+                try:
+                    await asyncio.to_thread(download)
+                except BaseException as e:
+                    blocks.abort(e)
+                    await blocks.end()
+                    await asyncio.gather(uploader, return_exceptions=True)
+                    cleaned_up.set()
+                    raise
+
+            future = engine.submit(transfer())
+            self.assertTrue(queue_full.wait(10))
+            closing = threading.Thread(target=engine.close, daemon=True)
+            closing.start()
+            closing.join(0.5)
+            writer.release.set()  # the stalled upload goes on, the transfer has to clean up nevertheless
+            closing.join(5)
+            self.assertFalse(closing.is_alive(), "close() hangs")
+        self.assertTrue(cleaned_up.is_set())
+        self.assertTrue(future.cancelled())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+from gcf_src.storage import ftp
+
+NOW = datetime(2025, 6, 15, 12, 0, tzinfo=timezone.utc)
+
+
+class ParseListLineTest(unittest.TestCase):
+
+    def test_unix_file(self):
+        entry = ftp.parse_list_line("-rw-r--r--   1 owner group    1234 Jan 15 10:30 file.csv", now=NOW)
+        self.assertEqual(entry, ftp.FtpEntry(name="file.csv", type="file", size=1234,
+                                             modified=datetime(2025, 1, 15, 10, 30, tzinfo=timezone.utc),
+                                             source="LIST"))
+
+    def test_unix_without_group(self):
+        entry = ftp.parse_list_line("-rw-r--r--   1 owner    1234 Jan 15 10:30 file.csv", now=NOW)
+        self.assertEqual((entry.name, entry.size), ("file.csv", 1234))
+
+    def test_unix_dir(self):
+        entry = ftp.parse_list_line("drwxr-xr-x   2 owner group    4096 Mar  3  2023 folder", now=NOW)
+        self.assertEqual((entry.name, entry.type), ("folder", "dir"))
+
+    def test_unix_year(self):
+        """Older files are listed with the year instead of the time."""
+        entry = ftp.parse_list_line("-rw-r--r--   1 owner group    1234 Mar  3  2023 file.csv", now=NOW)
+        self.assertEqual(entry.modified, datetime(2023, 3, 3, tzinfo=timezone.utc))
+
+    def test_unix_time_is_in_the_last_year(self):
+        """A time without year that would be in the future is from the year before."""
+        entry = ftp.parse_list_line("-rw-r--r--   1 owner group    1234 Dec 24 18:00 file.csv", now=NOW)
+        self.assertEqual(entry.modified, datetime(2024, 12, 24, 18, 0, tzinfo=timezone.utc))
+        entry = ftp.parse_list_line("-rw-r--r--   1 owner group    1234 Jun 16 08:00 file.csv", now=NOW)
+        self.assertEqual(entry.modified, datetime(2025, 6, 16, 8, 0, tzinfo=timezone.utc))
+
+    def test_unix_leap_day(self):
+        """Feb 29 without year is from the last leap year, also if the current year is none."""
+        line = "-rw-r--r--   1 owner group    1234 Feb 29 10:30 file.csv"
+        self.assertEqual(ftp.parse_list_line(line, now=datetime(2025, 3, 10, tzinfo=timezone.utc)).modified,
+                         datetime(2024, 2, 29, 10, 30, tzinfo=timezone.utc))
+        self.assertEqual(ftp.parse_list_line(line, now=datetime(2024, 3, 10, tzinfo=timezone.utc)).modified,
+                         datetime(2024, 2, 29, 10, 30, tzinfo=timezone.utc))
+        self.assertIsNone(ftp.parse_list_line(line, now=datetime(2026, 3, 10, tzinfo=timezone.utc)))
+
+    def test_unix_invalid_date(self):
+        self.assertIsNone(ftp.parse_list_line("-rw-r--r--   1 owner group    1234 Feb 31 10:30 file.csv", now=NOW))
+        self.assertIsNone(ftp.parse_list_line("-rw-r--r--   1 owner group    1234 Foo 15  2023 file.csv", now=NOW))
+
+    def test_unix_name_with_spaces(self):
+        entry = ftp.parse_list_line("-rw-r--r--   1 owner group    1234 Jan 15 10:30 my  file.csv", now=NOW)
+        self.assertEqual(entry.name, "my  file.csv")
+
+    def test_unix_symlink(self):
+        entry = ftp.parse_list_line("lrwxrwxrwx   1 owner group      11 Jan 15 10:30 my link -> target.csv",
+                                    now=NOW)
+        self.assertEqual((entry.name, entry.type), ("my link", "link"))
+
+    def test_iis_file(self):
+        entry = ftp.parse_list_line("01-15-24  10:30AM       1234 file.csv", now=NOW)
+        self.assertEqual(entry, ftp.FtpEntry(name="file.csv", type="file", size=1234,
+                                             modified=datetime(2024, 1, 15, 10, 30, tzinfo=timezone.utc),
+                                             source="LIST"))
+
+    def test_iis_dir_with_four_digit_year(self):
+        entry = ftp.parse_list_line("01-15-2024  02:05PM       <DIR>          my folder", now=NOW)
+        self.assertEqual(entry, ftp.FtpEntry(name="my folder", type="dir", size=None,
+                                             modified=datetime(2024, 1, 15, 14, 5, tzinfo=timezone.utc),
+                                             source="LIST"))
+
+    def test_unparseable(self):
+        self.assertIsNone(ftp.parse_list_line("total 42", now=NOW))
+        self.assertIsNone(ftp.parse_list_line("13-45-24  10:30AM       1234 file.csv", now=NOW))
+
+
+class ParseMlsdLineTest(unittest.TestCase):
+
+    def test_file(self):
+        name, facts = ftp.parse_mlsd_line("type=file;size=123;modify=20240115103000; my file.csv")
+        self.assertEqual(name, "my file.csv")
+        self.assertEqual(ftp.mlsd_entry(name, facts), ftp.FtpEntry(
+            name="my file.csv", type="file", size=123, modified=datetime(2024, 1, 15, 10, 30, tzinfo=timezone.utc)))
+
+    def test_mixed_case_facts(self):
+        name, facts = ftp.parse_mlsd_line("Type=File;Size=123;Modify=20240115103000.123; file.csv")
+        self.assertEqual(facts, {"type": "File", "size": "123", "modify": "20240115103000.123"})
+        entry = ftp.mlsd_entry(name, facts)
+        self.assertEqual((entry.type, entry.size), ("file", 123))
+        self.assertEqual(entry.modified, datetime(2024, 1, 15, 10, 30, tzinfo=timezone.utc))
+
+    def test_dir_size(self):
+        """Folders may have their size in `sizd` instead of `size`."""
+        entry = ftp.mlsd_entry(*ftp.parse_mlsd_line("type=dir;sizd=4096;modify=20240115103000; folder"))
+        self.assertEqual((entry.type, entry.size), ("dir", 4096))
+
+    def test_symlink(self):
+        entry = ftp.mlsd_entry(*ftp.parse_mlsd_line("type=OS.unix=symlink;modify=20240115103000; link"))
+        self.assertEqual((entry.type, entry.size), ("link", None))
+
+    def test_cdir_and_pdir_are_skipped(self):
+        lines = ["type=cdir;modify=20240115103000; .", "Type=PDir;modify=20240115103000; ..",
+                 "type=file;size=1;modify=20240115103000; file.csv"]
+        session = SimpleNamespace(supports_mlsd=None, supports_list_glob=None, ftp_address="ftp.example.com")
+        with mock.patch.object(ftp, "_iter_lines", return_value=iter(lines)):
+            entries = list(ftp._iter_folder(mock.Mock(), session))
+        self.assertEqual([entry.name for entry in entries], ["file.csv"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import copy
+import json
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from gcf_src.storage import ftp, gcs, manifest
+
+MODIFIED = datetime(2024, 1, 15, 10, 30, tzinfo=timezone.utc)
+
+
+class FakeBucket:
+    """JSON files with generations, like GCS. `before_write` is called before each write (eg. to simulate another run
+    that writes the same file)."""
+
+    def __init__(self):
+        self.files = {}  # name -> (content as JSON, generation)
+        self.writes = 0  # write attempts
+        self.before_write = None
+
+    def read_json_with_generation(self, file_name: str, bucket_name: str = None) -> tuple:
+        if file_name not in self.files:
+            return None, 0
+        content, generation = self.files[file_name]
+        return json.loads(content), generation
+
+    def write_json(self, file_name: str, data: dict, bucket_name: str = None, if_generation_match: int = None) -> int:
+        self.writes += 1
+        if self.before_write is not None:
+            before_write, self.before_write = self.before_write, None
+            before_write()
+        generation = self.files.get(file_name, (None, 0))[1]
+        if if_generation_match is not None and if_generation_match != generation:
+            raise gcs.GenerationMismatch(f"{file_name} has generation {generation}, not {if_generation_match}.")
+        self.files[file_name] = (json.dumps(copy.deepcopy(data)), generation + 1)
+        return generation + 1
+
+
+def entry(name: str) -> ftp.FtpEntry:
+    return ftp.FtpEntry(name=name, type="file", size=len(name), modified=MODIFIED)
+
+
+class ManifestSaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        patches = [mock.patch.object(gcs, "read_json_with_generation", self.bucket.read_json_with_generation),
+                   mock.patch.object(gcs, "write_json", self.bucket.write_json),
+                   mock.patch("builtins.print")]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_concurrent_save_keeps_both_records(self):
+        """If another run saves the manifest in the meantime, the records of both runs are kept."""
+        first = manifest.Manifest("manifest.json").load()
+        second = manifest.Manifest("manifest.json").load()
+        first.record(entry("a.csv"), ["f/a.csv"])
+        second.record(entry("b.csv"), ["f/b.csv"])
+        self.bucket.before_write = second.save
+        first.save()
+
+        self.assertEqual(self.bucket.writes, 3)  # the first attempt failed because of the other run
+        saved = manifest.Manifest("manifest.json").load()
+        self.assertEqual(saved.generation, 2)
+        self.assertEqual(sorted(saved.files), ["a.csv", "b.csv"])
+        self.assertTrue(saved.is_imported(entry("a.csv"), ["f/a.csv"]))
+        self.assertTrue(saved.is_imported(entry("b.csv"), ["f/b.csv"]))
+
+    def test_gives_up(self):
+        """The save is given up after `MAX_SAVE_ATTEMPTS` conflicts."""
+        import_manifest = manifest.Manifest("manifest.json").load()
+        import_manifest.record(entry("a.csv"), ["f/a.csv"])
+        with mock.patch.object(gcs, "write_json", side_effect=gcs.GenerationMismatch("changed")) as write_json:
+            with self.assertRaisesRegex(Exception, f"after {manifest.MAX_SAVE_ATTEMPTS} attempts"):
+                import_manifest.save()
+        self.assertEqual(write_json.call_count, manifest.MAX_SAVE_ATTEMPTS)
+
+    def test_nothing_to_save(self):
+        manifest.Manifest("manifest.json").load().save()
+        self.assertEqual(self.bucket.writes, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
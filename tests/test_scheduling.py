@@ -0,0 +1,148 @@
+import asyncio
+import contextlib
+import random
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+from gcf_src.config import cfg
+from gcf_src.storage import ftp, ftp_to_gcs, scheduling
+
+MB = 1_000_000
+
+
+class TransferBudgetTest(unittest.TestCase):
+
+    def test_first_transfer_is_always_started(self):
+        """The first transfer is started even if it does not fit, so every invocation makes progress."""
+        budget = scheduling.TransferBudget(throughput=MB)
+        budget.plan([1000 * MB, 1000 * MB])
+        with mock.patch.object(cfg, "seconds_left", return_value=1):
+            self.assertTrue(budget.try_start(0))
+            self.assertFalse(budget.try_start(1))
+        self.assertTrue(budget.stopped)
+
+    def test_no_deadline(self):
+        budget = scheduling.TransferBudget(throughput=MB)
+        budget.plan([1000 * MB] * 3)
+        with mock.patch.object(cfg, "seconds_left", return_value=None):
+            self.assertEqual([budget.try_start(number) for number in range(3)], [True, True, True])
+        self.assertFalse(budget.stopped)
+
+    def test_estimate_uses_observed_throughput(self):
+        budget = scheduling.TransferBudget(throughput=MB)
+        self.assertEqual(budget.throughput, MB)
+        self.assertEqual(budget.estimate(10 * MB), 10 + scheduling.TRANSFER_OVERHEAD_SECONDS)
+        self.assertEqual(budget.estimate(None), scheduling.TRANSFER_OVERHEAD_SECONDS)
+        budget.record(8 * MB, 2)
+        budget.record(12 * MB, 3)
+        self.assertEqual(budget.throughput, 4 * MB)
+        self.assertEqual(budget.estimate(10 * MB), 2.5 + scheduling.TRANSFER_OVERHEAD_SECONDS)
+
+    def test_observed_throughput_decides(self):
+        """A file that does not fit with the assumed throughput is started once the transfers are faster."""
+        budget = scheduling.TransferBudget(reserve_seconds=0, throughput=MB)
+        budget.plan([MB, 100 * MB])
+        with mock.patch.object(cfg, "seconds_left", return_value=60):
+            self.assertTrue(budget.try_start(0))
+            budget.record(MB, 0.01)  # 100 MB/s
+            self.assertTrue(budget.try_start(1))
+
+    def test_no_transfer_after_stop(self):
+        """Once a transfer is refused, none of the later ones is started, also if they would fit."""
+        budget = scheduling.TransferBudget(reserve_seconds=30, throughput=MB)
+        budget.plan([MB, MB, 100 * MB, MB, MB])
+        with mock.patch.object(cfg, "seconds_left", return_value=60):
+            self.assertEqual([budget.try_start(number) for number in range(5)], [True, True, False, False, False])
+
+    def test_out_of_order(self):
+        """Transfers are decided in number order, whichever of them asks first."""
+        budget = scheduling.TransferBudget(reserve_seconds=30, throughput=MB)
+        budget.plan([MB, MB, 100 * MB, MB, MB])
+        with mock.patch.object(cfg, "seconds_left", return_value=60):
+            self.assertFalse(budget.try_start(3))
+            self.assertFalse(budget.try_start(4))
+            self.assertTrue(budget.try_start(1))
+            self.assertFalse(budget.try_start(2))
+            self.assertTrue(budget.try_start(0))
+
+
+class FakeSession:
+
+    def call(self, operation):
+        return operation(self)
+
+
+class FakeSessionPool:
+
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    @contextlib.contextmanager
+    def session(self, host: str, user: str, passwd: str):
+        yield FakeSession()
+
+
+class ContinuationTest(unittest.TestCase):
+
+    def run_import(self, entries: list, engine: str) -> (dict, list):
+        """Imports `entries` with transfers that finish in random order and returns the result and the committed
+        files."""
+        committed = []
+
+        def transfer_file(entry: ftp.FtpEntry, **kwargs) -> dict:
+            time.sleep(random.random() / 100)
+            # no bytes, so the assumed throughput is used for all estimates
+            return {"size": 0, "gcs_locations": [f"f/{entry.name}"], "checksums": {}}
+
+        async def transfer_file_async(entry: ftp.FtpEntry, **kwargs) -> dict:
+            await asyncio.sleep(random.random() / 100)
+            return {"size": 0, "gcs_locations": [f"f/{entry.name}"], "checksums": {}}
+
+        def commit_file(entry: ftp.FtpEntry, **kwargs):
+            committed.append(entry.name)
+
+        ftp_config = cfg.FtpConfig(name="test_ftp", address="ftp.example.com", user="user", passwd="passwd",
+                                   folder="in")
+        with mock.patch.object(ftp, "FtpSessionPool", FakeSessionPool), \
+                mock.patch.object(ftp, "iter_entries", return_value=entries), \
+                mock.patch.object(cfg, "get_ftp_config", return_value=ftp_config), \
+                mock.patch.object(cfg, "seconds_left", return_value=60), \
+                mock.patch.object(ftp_to_gcs, "transfer_file", transfer_file), \
+                mock.patch.object(ftp_to_gcs, "transfer_file_async", transfer_file_async), \
+                mock.patch.object(ftp_to_gcs, "commit_file", commit_file), \
+                mock.patch("builtins.print"):
+            result = ftp_to_gcs.run_script(payload={
+                "source_ftp": "test_ftp", "source_file_name_re": ".*", "gcs_bucket": "bucket", "gcs_folders": ["f"],
+                "engine": engine, "max_parallel_transfers": 4, "continuation": {
+                    "cursor": {"last_file": None, "files_done": 0, "after": None}, "throughput": MB}})
+        return result, committed
+
+    def test_files_left_are_a_suffix(self):
+        """The continuation always has the last files, and only the files before them are committed."""
+        modified = datetime.now(timezone.utc) - timedelta(hours=1)
+        for engine in ("threads", "asyncio"):
+            for stop_at in (1, 3, 7):
+                with self.subTest(engine=engine, stop_at=stop_at):
+                    # with 60s left, 30s of them reserved, only files up to 28 MB fit at 1 MB/s
+                    entries = [ftp.FtpEntry(name=f"file_{number:02}.csv", type="file",
+                                            size=100 * MB if number == stop_at else MB,
+                                            modified=modified + timedelta(seconds=number))
+                               for number in range(12)]
+                    result, committed = self.run_import(entries, engine)
+                    names = [entry.name for entry in entries]
+                    self.assertEqual(result["result"], "continue")
+                    self.assertEqual(result["workflow_instructions"]["continuation"]["files"], names[stop_at:])
+                    self.assertEqual(committed, names[:stop_at])
+                    self.assertEqual([file_result["file"] for file_result in result["files"]], names[:stop_at])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+from gcf_src.storage import transcoding
+from gcf_src.storage.transcoding import Transcoder, Transcoding
+
+
+def transcode_in_chunks(data: bytes, settings: Transcoding, chunk_size: int) -> bytes:
+    transcoder = Transcoder(settings)
+    transcoded = b"".join(transcoder.transcode(data[start:start + chunk_size])
+                          for start in range(0, len(data), chunk_size))
+    return transcoded + transcoder.transcode(b"", final=True)
+
+
+class TranscoderTest(unittest.TestCase):
+
+    def assert_transcodes(self, data: bytes, settings: Transcoding, expected: bytes):
+        """Checks that `data` is converted to `expected` at once and in chunks of 1, 2 and all bytes."""
+        self.assertEqual(transcoding.transcode(data, settings), expected)
+        for chunk_size in (1, 2, len(data)):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(transcode_in_chunks(data, settings, chunk_size), expected)
+
+    def test_split_multi_byte_characters(self):
+        text = "Grüße, €100 und 😀\n"
+        self.assert_transcodes(text.encode("utf-8"), Transcoding(source_encoding="utf-8", target_encoding="cp1252",
+                                                                 errors="replace"),
+                               text.encode("cp1252", errors="replace"))
+        self.assert_transcodes(text.encode("utf-16-le"), Transcoding(source_encoding="utf-16-le"),
+                               text.encode("utf-8"))
+
+    def test_split_bom(self):
+        data = "\ufeffa;b\n".encode("utf-8")
+        self.assert_transcodes(data, Transcoding(source_encoding="utf-8"), b"a;b\n")
+        self.assert_transcodes(data, Transcoding(source_encoding="utf-8", strip_bom=False), data)
+        self.assert_transcodes("\ufeffa;b\n".encode("utf-16"), Transcoding(source_encoding="utf-16"), b"a;b\n")
+
+    def test_bom_only_at_start(self):
+        data = "a\ufeffb".encode("utf-8")
+        self.assert_transcodes(data, Transcoding(source_encoding="utf-8"), data)
+
+    def test_split_crlf(self):
+        """A "\\r" at the end of a chunk is kept until the next chunk shows if it is part of "\\r\\n"."""
+        data = b"a\r\nb\rc\n\r\nd"
+        self.assert_transcodes(data, Transcoding(source_encoding="latin-1", newline="\n"), b"a\nb\nc\n\nd")
+        self.assert_transcodes(data, Transcoding(source_encoding="latin-1", newline="\r\n"),
+                               b"a\r\nb\r\nc\r\n\r\nd")
+
+    def test_trailing_cr(self):
+        self.assert_transcodes(b"a\r", Transcoding(source_encoding="latin-1", newline="\n"), b"a\n")
+        self.assert_transcodes(b"a\r\r", Transcoding(source_encoding="latin-1", newline="\r\n"), b"a\r\n\r\n")
+
+    def test_newlines_kept(self):
+        data = b"a\r\nb\rc\n"
+        self.assert_transcodes(data, Transcoding(source_encoding="latin-1"), data)
+
+    def test_invalid_data(self):
+        with self.assertRaises(transcoding.TranscodingError):
+            transcode_in_chunks(b"a\xff", Transcoding(source_encoding="utf-8"), 1)
+        # a character that is cut off at the end of the file
+        with self.assertRaises(transcoding.TranscodingError):
+            transcode_in_chunks("aü".encode("utf-8")[:-1], Transcoding(source_encoding="utf-8"), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()